@@ -5,51 +5,89 @@ This program updates the Case Dispatcher Google Sheet with the latest cases, mov
 """
 
 import pandas as pd
+import api_meter as apm
 import arrest_module as am
+import backup_store as bs
+import case_ids as ci
+import col_manifest as cm
 import db_connect as dc
+import fake_google as fg
 import gsheets as gs
 import net_db.network_db as ndb
+import query_cache as qc
+import snapshot_store as ss
+import sheet_schema as sc
 import soc_pipe as sp
+import synth_data as sd
 import entity_groups as eg
 import priority_calc as pc
 import argparse
+import os
 from copy import deepcopy
 import schedule
 import time
 pd.options.mode.chained_assignment = None
 
 
-def main(db_cred='database.ini', gs_cred='creds.json', gs_name='Case Dispatcher 2.0'):
-    """Update Case Dispatcher Google Sheet """
-    dbc = dc.DB_Conn(db_cred)
+def main(db_cred='database.ini', gs_cred='creds.json', gs_name='Case Dispatcher 2.0',
+         snapshot_dir='snapshots', cache_dir=None, offline=False, full_upload=False,
+         n_relationship_sheets=3, api_report='api_report.json', api_budget=None,
+         backup_dir='backups', arrest_index='arrest_index.pkl', sheet_ids='sheet_ids.json',
+         fake_google_dir='fake_google'):
+    """Update Case Dispatcher Google Sheet. If offline, use 'searchlight.db' in the working
+    directory as the database and a fake Google backend kept in fake_google_dir, which is
+    first filled from 'sheets/' (see synth_data.make_offline_env). Only changed cells are
+    uploaded unless full_upload is set. Relationship sheets are created for the top
+    n_relationship_sheets suspects. Google API calls are recorded per step in api_report, with
+    warnings when they approach the per-minute quota or the api_budget calls per run.
+    Downloaded and uploaded sheets are backed up in backup_dir, arrests are indexed in the
+    arrest_index file and the ids of the spreadsheets uploaded to are kept in sheet_ids."""
+    if offline:
+        dbc = dc.SQLite_Conn('searchlight.db')
+    else:
+        dbc = dc.DB_Pool(db_cred, size=len(ss.CD_SNAPSHOTS))
+    if cache_dir is not None:
+        dbc = qc.Query_Cache(dbc, cache_dir)
+    store = ss.Snapshot_Store(snapshot_dir)
+    db_frames = store.update_all(dbc, queries=cm.get_queries(dbc))
+    if cache_dir is not None:
+        dbc.report()
+    dbc.close_conn()
 
-    db_cif = dbc.ex_query("SELECT * FROM dataentry_cifnepal as CIF inner join \
-    dataentry_personboxnepal as PB on CIF.id = PB.cif_id;")
+    db_cif = db_frames['cif']
+    db_vics = db_frames['vics']
+    db_sus = db_frames['sus']
+    db_add = db_frames['add']
 
     soc_df = sp.pre_proc(db_cif)
 
-    db_vics = dbc.ex_query("SELECT * FROM public.dataentry_person as p inner join \
-    dataentry_cifnepal as CIF on p.id = CIF.main_pv_id;")
-
-    db_sus = dbc.ex_query("SELECT * FROM public.dataentry_personboxnepal as pb inner join \
-    public.dataentry_person as p on pb.person_id = p.id;")
-
-    db_add = dbc.ex_query("SELECT * FROM public.dataentry_address1 as ad1 inner join \
-    public.dataentry_address2 as ad2 on ad1.id = ad2.address1_id;")
-
-    dbc.close_conn()
-
-    credentials = gs.get_gs_cred(gs_cred)
+    meter = apm.API_Meter(api_report, per_run=api_budget).start()
+    if offline:
+        if os.path.isdir(fake_google_dir):
+            google = fg.Fake_Google.load(fake_google_dir)
+        else:
+            google = fg.Fake_Google.from_dfs(gs_name, sd.read_worksheets('sheets'))
+        google.install(gs)
+        credentials = None
+        if not os.path.exists('test_db.db'):
+            ndb.setup_database()
+    else:
+        credentials = gs.get_gs_cred(gs_cred)
     auth = gs.get_auth(credentials)
-    cdws = gs.get_gsheets(gs_name, auth)
-    dfs = gs.get_dfs(cdws)
-    gs.save_backups(dfs)
-    #locals().update(dfs)
-
-    arrests = am.get_arrests(dfs['Arrests']) #'Arrests' is Google Sheet with latest arrest data
-
-    soc_df = pd.merge(soc_df, arrests, how='outer', on='suspect_id', sort=True,
-                      suffixes=('x', 'y'))
+    meter.attach(auth)
+    dfs, _ = gs.get_dfs_batched(gs_name, auth)
+    backups = bs.Backup_Store(backup_dir)
+    gs.save_backups(dfs, backups)
+    # The downloaded strings are kept for comparison with the sheets to upload
+    sheets = sc.parse_sheets(dfs)
+    # Sheets written by runs before case_ids may hold IDs derived the old way
+    id_maps = ci.legacy_id_maps(db_vics['cif_number'], db_cif['cif_number'], db_cif['pb_number'])
+    sheets = {title: ci.remap_legacy_ids(title, df, id_maps) for title, df in sheets.items()}
+
+    #'Arrests' is Google Sheet with latest arrest data
+    arrests = am.Arrest_Index(arrest_index).update(sheets['Arrests'])
+
+    soc_df = arrests.join(soc_df)
     soc_df.Arrest = soc_df.Arrest.fillna('0').astype(int)
     soc_df = soc_df.dropna(axis=0, subset=['cif_number'])
 
@@ -64,72 +102,81 @@ def main(db_cred='database.ini', gs_cred='creds.json', gs_name='Case Dispatcher
 
     soc_df = sp.make_new_predictions(soc_df, 'soc_model.sav')
 
-    new_victims = db_vics
-    victims = eg.Entity_Group('Victim_ID',
-                              new_victims,
-                              dfs['Victims'],
-                              dfs['Closed_Vic'],
-                              'victims')
-    new_suspects = db_sus
-    suspects = eg.Entity_Group('Suspect_ID',
-                               new_suspects,
-                               dfs['Suspects'],
-                               dfs['Closed_Sus'],
-                               'suspects')
-    addr = eg.subset_addresses(db_add)
-
-    eg.Entity_Group.merge_addresses(addr)
-
-    victims.new = eg.set_vic_id(victims.new)
-    suspects.new = eg.set_sus_id(suspects.new, db_cif)
-    eg.Entity_Group.set_case_id()
-
-    new_police = deepcopy(x=suspects.new)
-    new_police.rename(columns={'Name': 'Suspect_Name'}, inplace=True)
-    police = eg.Entity_Group('Suspect_ID',
-                             new_police,
-                             dfs['Police'],
-                             dfs['Closed_Pol'],
-                             'police')
-    eg.Entity_Group.combine_sheets()
-
-    eg.Entity_Group.move_closed(arrests)
-
-    eg.Entity_Group.move_other_closed(suspects, police, victims)
-
-    vics_willing = pc.get_vics_willing_to_testify(victims.active)
-    police.active = pc.add_vic_names_to_pol(police.active, vics_willing)
-
-    suspects.active = pc.calc_all_sus_scores(suspects.active,
-                                             vics_willing,
-                                             dfs['Parameters'],
-                                             arrests,
-                                             police.active,
-                                             db_cif,
-                                             soc_df,
-                                             dfs['Suspects'])
-    victims.active = pc.add_priority_to_others(suspects.active,
-                                               victims.active,
-                                               'Case_ID',
-                                               dfs['Victims'],
-                                               'Victim_ID')
-    police.active = pc.add_priority_to_others(suspects.active,
-                                              police.active,
-                                              'Suspect_ID',
-                                              dfs['Police'],
-                                              'Suspect_ID')
-
-    suspects.active = gs.new_relationship_gsheets(suspects.active, 3, credentials)
-
-    new_links_dict = gs.get_sheets_for_network_db(suspects, auth)
-    ndb.add_entries_dict(new_links_dict)
-    ndb.update_links()
-
-    new_gsheets = eg.Entity_Group.save_csvs()
-
-    gs.upload_sheets(new_gsheets, auth)
-
-    gs.upload_stats_sheet(auth)
+    with eg.Dispatch_Run(backup_dir) as run:
+        new_victims = db_vics
+        victims = run.add_group('Victim_ID',
+                                new_victims,
+                                sheets['Victims'],
+                                sheets['Closed_Vic'],
+                                'victims')
+        new_suspects = db_sus
+        suspects = run.add_group('Suspect_ID',
+                                 new_suspects,
+                                 sheets['Suspects'],
+                                 sheets['Closed_Sus'],
+                                 'suspects')
+        addr = eg.subset_addresses(db_add)
+
+        run.merge_addresses(addr)
+
+        victims.new = eg.set_vic_id(victims.new)
+        suspects.new = eg.set_sus_id(suspects.new, db_cif)
+
+        new_police = deepcopy(x=suspects.new)
+        new_police.rename(columns={'Name': 'Suspect_Name'}, inplace=True)
+        police = run.add_group('Suspect_ID',
+                               new_police,
+                               sheets['Police'],
+                               sheets['Closed_Pol'],
+                               'police')
+        [soc_df] = run.encode_ids(soc_df)
+        run.combine_sheets()
+
+        run.move_closed(arrests)
+
+        run.move_other_closed(suspects, police, victims)
+
+        vics_willing = pc.get_vics_willing_to_testify(victims.active)
+        police.active = pc.add_vic_names_to_pol(police.active, vics_willing)
+
+        suspects.active = pc.calc_all_sus_scores(suspects.active,
+                                                 vics_willing,
+                                                 sheets['Parameters'],
+                                                 arrests,
+                                                 police.active,
+                                                 db_cif,
+                                                 soc_df,
+                                                 sheets['Suspects'])
+        victims.active = pc.add_priority_to_others(suspects.active,
+                                                   victims.active,
+                                                   'Case_ID',
+                                                   sheets['Victims'],
+                                                   'Victim_ID')
+        police.active = pc.add_priority_to_others(suspects.active,
+                                                  police.active,
+                                                  'Suspect_ID',
+                                                  sheets['Police'],
+                                                  'Suspect_ID')
+
+        suspects.active = gs.new_relationship_gsheets(suspects.active, n_relationship_sheets,
+                                                      credentials, auth)
+
+        new_links_dict = gs.get_sheets_for_network_db(suspects, auth)
+        ndb.add_entries_dict(new_links_dict)
+        ndb.update_links()
+
+        new_gsheets = run.save_csvs()
+        backups.save('uploads', dict(zip(gs.SHEET_TITLES, new_gsheets)))
+
+        gs.upload_sheets(new_gsheets, auth, dfs=None if full_upload else dfs, id_cache=sheet_ids)
+
+        gs.upload_stats_sheet(auth)
+    meter.report()
+
+    if offline:
+        google.save(fake_google_dir)
+        google.report()
+        google.uninstall()
 
 
 if __name__ == '__main__':
@@ -140,12 +187,46 @@ if __name__ == '__main__':
                         help="File containing credentials for Google Drive/Sheets")
     parser.add_argument('--name_of_sheet', dest='gs_name', default='Case Dispatcher 2.0',
                         help="Name of Google Sheet functioning as Case Dispatcher interface")
+    parser.add_argument('--snapshot_dir', dest='snapshot_dir', default='snapshots',
+                        help="Directory where incrementally updated database extracts are kept")
+    parser.add_argument('--cache_dir', dest='cache_dir', default=None,
+                        help="Directory for caching query results between runs (no caching if omitted)")
+    parser.add_argument('--offline', dest='offline', action='store_true',
+                        help="Run against 'searchlight.db' and a fake Google backend in the working "
+                             "directory (see synth_data.make_offline_env)")
+    parser.add_argument('--full_upload', dest='full_upload', action='store_true',
+                        help="Re-import every sheet in full instead of uploading changed cells")
+    parser.add_argument('--relationship_sheets', dest='n_relationship_sheets', type=int, default=3,
+                        help="Number of top priority suspects to create relationship sheets for")
+    parser.add_argument('--api_report', dest='api_report', default='api_report.json',
+                        help="File the per-run report of Google API calls is written to")
+    parser.add_argument('--api_budget', dest='api_budget', type=int, default=None,
+                        help="Google API requests per run above which to warn (no budget if omitted)")
+    parser.add_argument('--backup_dir', dest='backup_dir', default='backups',
+                        help="Directory where downloaded and uploaded sheets are backed up")
+    parser.add_argument('--arrest_index', dest='arrest_index', default='arrest_index.pkl',
+                        help="File the index of arrests from the Arrests sheet is kept in")
+    parser.add_argument('--sheet_ids', dest='sheet_ids', default='sheet_ids.json',
+                        help="File the ids of the spreadsheets uploaded to are kept in")
+    parser.add_argument('--fake_google_dir', dest='fake_google_dir', default='fake_google',
+                        help="Directory the fake Google backend of offline runs is kept in")
     args = parser.parse_args()
 
     schedule.every().day.at("12:00").do(main,
                                         db_cred=args.db_cred,
                                         gs_cred=args.gs_cred,
-                                        gs_name=args.gs_name)
+                                        gs_name=args.gs_name,
+                                        snapshot_dir=args.snapshot_dir,
+                                        cache_dir=args.cache_dir,
+                                        offline=args.offline,
+                                        full_upload=args.full_upload,
+                                        n_relationship_sheets=args.n_relationship_sheets,
+                                        api_report=args.api_report,
+                                        api_budget=args.api_budget,
+                                        backup_dir=args.backup_dir,
+                                        arrest_index=args.arrest_index,
+                                        sheet_ids=args.sheet_ids,
+                                        fake_google_dir=args.fake_google_dir)
 
     while True:
         schedule.run_pending()
@@ -0,0 +1,242 @@
+'''
+This is a module for recording the Google API calls made by each step of the Case Dispatcher,
+so that the steps spending the Sheets/Drive quota can be found and runs kept within budget.
+'''
+
+import json
+import logging
+from bisect import bisect_left
+from collections import deque
+from contextvars import ContextVar, copy_context
+from datetime import datetime
+from functools import wraps
+from threading import Lock
+from time import monotonic, time
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf')]
+
+# The meter of the run in the current context, if any; set by API_Meter.start. Each run
+# sees only its own meter, so runs in several threads are metered separately.
+current = ContextVar('api_meter', default=None)
+
+
+def track(fn):
+    """Decorator recording the API calls made during a function under its name.
+
+    Calls made by helpers or worker threads while the function runs are attributed to
+    the outermost tracked function, since a run goes through its steps one at a time.
+    """
+    @wraps(fn)
+    def tracked(*args, **kwargs):
+        meter = current.get()
+        if meter is None or meter.step is not None:
+            return fn(*args, **kwargs)
+        meter.step = fn.__name__
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            meter.step = None
+    return tracked
+
+
+def submit(executor, fn, *args, **kwargs):
+    """Submit fn to an executor to run in a copy of the current context, so that the calls
+    it makes in a worker thread are recorded by the meter of the run submitting it."""
+    return executor.submit(copy_context().run, fn, *args, **kwargs)
+
+
+def record_retry():
+    """Record a retried call against the current step of the run's meter."""
+    meter = current.get()
+    if meter is not None:
+        meter.retry()
+
+
+def wrap_drive(drive_api):
+    """Return a Drive service which records its requests if the run has a meter."""
+    meter = current.get()
+    if meter is None:
+        return drive_api
+    return Metered_Proxy(drive_api, meter)
+
+
+def hook(response, *args, **kwargs):
+    """Response hook recording a gspread HTTP call with the meter of the run making it.
+    Clients are shared between runs, so the hook is installed once per client."""
+    meter = current.get()
+    if meter is not None:
+        meter.record_response(response)
+
+
+class Metered_Proxy:
+    """This is a class wrapping a googleapiclient service so that executed requests are
+    recorded. Resources, requests and batches it returns are wrapped in turn."""
+    def __init__(self, obj, meter):
+        self._obj = obj
+        self._meter = meter
+        self._added = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if name == 'execute':
+            return self._execute
+        if name == 'add':
+            return self._add
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return Metered_Proxy(attr(*args, **kwargs), self._meter)
+        return call
+
+    def _add(self, request, *args, **kwargs):
+        """Add a request to a batch, unwrapping it first."""
+        self._added += 1
+        if isinstance(request, Metered_Proxy):
+            request = request._obj
+        return self._obj.add(request, *args, **kwargs)
+
+    def _execute(self, *args, **kwargs):
+        t0 = time()
+        status = 200
+        response = None
+        try:
+            response = self._obj.execute(*args, **kwargs)
+            return response
+        except Exception as e:
+            status = getattr(getattr(e, 'resp', None), 'status', 500)
+            raise
+        finally:
+            body = getattr(self._obj, 'body', None) or ''
+            self._meter.record(time() - t0, len(body),
+                               len(json.dumps(response)) if response is not None else 0,
+                               int(status), requests=max(self._added, 1))
+
+
+class API_Meter:
+    """This is a class for counting Google API calls, bytes, latencies and retries per step.
+
+    Args:
+        report_file: JSON file the report is written to at the end of a run. The previous
+        run's report is read from it to warn at the start of a run likely to exceed per_run.
+        per_minute: Quota of requests per minute; a warning is logged when the calls in
+        the last minute reach warn_ratio of it.
+        per_run: Budget of requests per run, or None for no budget.
+        warn_ratio: Share of a quota or budget at which to warn.
+    """
+    def __init__(self, report_file='api_report.json', per_minute=60, per_run=None,
+                 warn_ratio=0.8):
+        self.report_file = report_file
+        self.per_minute = per_minute
+        self.per_run = per_run
+        self.warn_ratio = warn_ratio
+        self.steps = {}
+        self.step = None
+        self.recent = deque()
+        self.peak_per_minute = 0
+        self.warned = set()
+        self.started = None
+        self.lock = Lock()
+
+    def start(self):
+        """Make this the meter of the run in the current context and warn if the last run
+        came close to the budget."""
+        current.set(self)
+        self.started = datetime.now()
+        try:
+            with open(self.report_file) as f:
+                previous = json.load(f)['total']['requests']
+        except (OSError, ValueError, KeyError):
+            previous = None
+        if previous is not None and self.per_run is not None \
+                and previous >= self.warn_ratio * self.per_run:
+            logger.warning("The last run made %d Google API requests, %d%% of the budget of "
+                           "%d per run", previous, 100 * previous / self.per_run, self.per_run)
+        return self
+
+    def attach(self, auth):
+        """Record every HTTP call made by a gspread client during the run."""
+        if hook not in auth.session.hooks['response']:
+            auth.session.hooks['response'].append(hook)
+
+    def record_response(self, response):
+        """Record one gspread HTTP call."""
+        request = getattr(response, 'request', None)
+        body = getattr(request, 'body', None) or ''
+        self.record(response.elapsed.total_seconds(), len(body),
+                    len(getattr(response, 'content', b'') or b''), response.status_code)
+
+    def get_step(self):
+        """Return the stats of the current step, creating them if needed. Hold the lock."""
+        step = self.step or 'untracked'
+        if step not in self.steps:
+            self.steps[step] = {'calls': 0, 'requests': 0, 'errors': 0, 'retries': 0,
+                                'bytes_sent': 0, 'bytes_received': 0, 'latency': 0.0,
+                                'latency_hist': [0] * len(LATENCY_BUCKETS)}
+        return self.steps[step]
+
+    def record(self, latency, bytes_sent, bytes_received, status, requests=1):
+        """Record an HTTP call, which may be a batch of several requests."""
+        with self.lock:
+            stats = self.get_step()
+            stats['calls'] += 1
+            stats['requests'] += requests
+            stats['errors'] += status >= 400
+            stats['bytes_sent'] += bytes_sent
+            stats['bytes_received'] += bytes_received
+            stats['latency'] += latency
+            stats['latency_hist'][bisect_left(LATENCY_BUCKETS, latency)] += 1
+            now = monotonic()
+            self.recent.extend([now] * requests)
+            while self.recent and now - self.recent[0] > 60:
+                self.recent.popleft()
+            self.peak_per_minute = max(self.peak_per_minute, len(self.recent))
+            per_minute = len(self.recent)
+            total = sum(s['requests'] for s in self.steps.values())
+        if self.per_minute and per_minute >= self.warn_ratio * self.per_minute \
+                and 'minute' not in self.warned:
+            self.warned.add('minute')
+            logger.warning("%d Google API requests in the last minute, close to the quota "
+                           "of %d", per_minute, self.per_minute)
+        if self.per_run and total >= self.warn_ratio * self.per_run and 'run' not in self.warned:
+            self.warned.add('run')
+            logger.warning("%d Google API requests so far this run, close to the budget of %d",
+                           total, self.per_run)
+
+    def retry(self):
+        """Record that a call is being retried."""
+        with self.lock:
+            self.get_step()['retries'] += 1
+
+    def report(self):
+        """Write the report to report_file, log a summary, stop recording and return it."""
+        with self.lock:
+            steps = {k: dict(v, latency_hist=dict(zip(
+                ['le_%g' % b for b in LATENCY_BUCKETS], v['latency_hist'])))
+                for k, v in self.steps.items()}
+        total = {k: sum(s[k] for s in steps.values()) for k in
+                 ['calls', 'requests', 'errors', 'retries', 'bytes_sent', 'bytes_received',
+                  'latency']}
+        report = {'started': self.started.isoformat() if self.started else None,
+                  'duration': (datetime.now() - self.started).total_seconds()
+                  if self.started else None,
+                  'total': total,
+                  'peak_per_minute': self.peak_per_minute,
+                  'budget': {'per_minute': self.per_minute, 'per_run': self.per_run},
+                  'steps': steps}
+        with open(self.report_file, 'w') as f:
+            json.dump(report, f, indent=2)
+        summary = ["Google API: %d requests in %d HTTP calls, %d errors, %d retries, "
+                   "%d bytes sent, %d received, peak %d requests per minute" % (
+                       total['requests'], total['calls'], total['errors'], total['retries'],
+                       total['bytes_sent'], total['bytes_received'], self.peak_per_minute)]
+        for name, s in sorted(steps.items(), key=lambda kv: -kv[1]['requests']):
+            summary.append("  %s: %d requests, %d errors, %d retries, %0.2fs" % (
+                name, s['requests'], s['errors'], s['retries'], s['latency']))
+        print('\n'.join(summary))
+        if current.get() is self:
+            current.set(None)
+        return report
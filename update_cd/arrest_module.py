@@ -2,44 +2,151 @@
 This module extracts and processes the latest arrest related data for the Case Dispatcher.
 '''
 
-
+import os
+import re
+import numpy as np
 import pandas as pd
+import case_ids as ci
+
+# Person Box column groups of the Arrests sheet, e.g. 'PB1 Name', 'PB1 Arrested', ...
+PB_COLUMN = re.compile(r'^PB(\d+)\b')
+
+# Fields of each Person Box column group, in the order of its columns
+PB_FIELDS = ['Name', 'Arrested', 'Arrest_Date']
+
+
+def get_pb_columns(columns):
+    """Return the Person Box numbers in a list of columns and the columns of each field,
+    as lists ordered by Person Box number."""
+    groups = {}
+    for col in columns:
+        match = PB_COLUMN.match(str(col))
+        if match:
+            groups.setdefault(int(match.group(1)), []).append(col)
+    pbs = sorted(n for n, cols in groups.items() if len(cols) >= len(PB_FIELDS))
+    return pbs, {field: [groups[n][i] for n in pbs] for i, field in enumerate(PB_FIELDS)}
+
+
+def contains_yes(col):
+    """Return a boolean array of whether each value of a column contains 'Yes'."""
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        # Test each category once; missing values have code -1, the appended False
+        yes = np.asarray(col.cat.categories.astype(str).str.contains('Yes', regex=False))
+        return np.append(yes, False)[col.cat.codes.to_numpy()]
+    return col.astype(str).str.contains('Yes', regex=False).to_numpy()
+
 
 def get_arrests(a_df):
-    """Extracts relevant arrest data and reformats them."""
+    """Extracts relevant arrest data and reformats them.
+
+    The Arrests sheet has a row per case with a group of Name, Arrested and Arrest Date
+    columns for each Person Box. Arrested Person Boxes of cases with an arrest outcome
+    are returned a row each, in Person Box order, for as many Person Boxes as the sheet has.
+    Rows without an IRF# can't be matched to suspects and are left out.
+    """
     arrests = pd.DataFrame(a_df)
-    arrests.infer_objects()
-    arrests['Outcome (Arrest)'] = arrests['Outcome (Arrest)'].fillna(0).astype(int)
-    arrests = arrests.loc[arrests['Outcome (Arrest)'] == 1]
-
-    pbs = ['PB' + str(n) for n in range(1, 8)]
-    for p in pbs:
-        arrests[p + '_ID'] = arrests['IRF#'] + '.' + p
-    for p in pbs:
-        arrests[p + '_Case_ID'] = arrests['IRF#']
-    dpb = {}
-    for p in pbs:
-        cnames = [col for col in arrests.columns if p in col]
-        dpb['df_{0}'.format(p)] = pd.DataFrame(arrests[cnames])
-    locals().update(dpb)
-
-    df_list = []
-    for k, v in dpb.items():
-        df_list.append(v)
-
-    new_col_names = ['Name',
-                     'Arrested',
-                     'Arrest_Date',
-                     'suspect_id',
-                     'Case_ID']
-
-    for i, df in enumerate(df_list, 1):
-        df.columns = new_col_names
-
-    df_pb_all = pd.concat(df_list)
-
-    arrests = df_pb_all[df_pb_all.Arrested.str.contains("Yes")]
-    arrests['Total_Arrests'] = arrests.groupby(['Case_ID'])['Case_ID'].transform('count')
-    arrests['Arrest'] = 1
-
-    return arrests
+    arrests = arrests.loc[arrests['Outcome (Arrest)'].eq(1) & arrests['IRF#'].notna()]
+    pbs, cols = get_pb_columns(arrests.columns)
+    arrested = np.column_stack([contains_yes(arrests[c]) for c in cols['Arrested']]) \
+        if pbs else np.empty((len(arrests), 0), dtype=bool)
+    # Transposed so that the rows come out grouped by Person Box
+    pb_pos, row_pos = np.nonzero(arrested.T)
+    case_ids = arrests['IRF#'].to_numpy()[row_pos]
+    result = pd.DataFrame({
+        'Name': arrests[cols['Name']].to_numpy()[row_pos, pb_pos],
+        'Arrested': arrests[cols['Arrested']].to_numpy()[row_pos, pb_pos],
+        'Arrest_Date': arrests[cols['Arrest_Date']].to_numpy()[row_pos, pb_pos],
+        'suspect_id': ci.suspect_ids(case_ids, np.array(pbs, dtype=np.int64)[pb_pos]),
+        'Case_ID': case_ids},
+        index=arrests.index[row_pos])
+    # Arrested Person Boxes per case, summed over any rows repeating an IRF#
+    case_codes = pd.factorize(arrests['IRF#'])[0]
+    per_case = np.bincount(case_codes, weights=arrested.sum(axis=1), minlength=1)
+    result['Total_Arrests'] = per_case[case_codes[row_pos]].astype(np.int64)
+    result['Arrest'] = 1
+    return result
+
+
+class Arrest_Index:
+    """This is a class for the arrests in the Arrests sheet, kept on disk between runs and
+    updated only for the cases whose rows changed.
+
+    Lookups by suspect id and by case go through the hash tables of pandas indexes, so
+    each costs O(1) however many arrests there are.
+
+    Args:
+        index_file: Pickle file the index is kept in, or None to keep it in memory only.
+    """
+    def __init__(self, index_file='arrest_index.pkl'):
+        self.index_file = index_file
+        self.columns = None
+        self.hashes = pd.Series(dtype=np.uint64)
+        self.arrests = get_arrests(pd.DataFrame({'IRF#': [], 'Outcome (Arrest)': []}))
+        if index_file is not None and os.path.exists(index_file):
+            stored = pd.read_pickle(index_file)
+            self.columns, self.hashes, self.arrests = \
+                stored['columns'], stored['hashes'], stored['arrests']
+        self.build_lookups()
+
+    def build_lookups(self):
+        """Index the arrests by suspect id and the total arrests by case."""
+        self.by_suspect = self.arrests.drop_duplicates('suspect_id').set_index('suspect_id')
+        self.totals = self.arrests.drop_duplicates('Case_ID').set_index('Case_ID')['Total_Arrests']
+
+    def update(self, a_df):
+        """Bring the index up to date with the Arrests sheet and return it.
+
+        Only the cases with a new, changed or removed row are reshaped again. If the
+        sheet's columns change the whole index is rebuilt.
+        """
+        sheet = pd.DataFrame(a_df)
+        # A case's hash combines the hashes of its rows, so a change to any row is seen
+        hashes = pd.Series(pd.util.hash_pandas_object(sheet, index=False).to_numpy(),
+                           index=sheet['IRF#'].to_numpy())
+        if not hashes.index.is_unique:
+            hashes = hashes.groupby(level=0).sum()
+        columns = [str(c) for c in sheet.columns]
+        if columns != self.columns:
+            changed, removed = hashes.index, self.hashes.index
+        else:
+            pos = self.hashes.index.get_indexer(hashes.index)
+            old = np.append(self.hashes.to_numpy(), np.uint64(0))[pos]
+            changed = hashes.index[(pos < 0) | (old != hashes.to_numpy())]
+            removed = self.hashes.index.difference(hashes.index)
+        stale = changed.union(removed)
+        if len(stale):
+            kept = self.arrests[~self.arrests['Case_ID'].isin(stale)]
+            fresh = get_arrests(sheet[sheet['IRF#'].isin(changed)])
+            self.arrests = pd.concat([kept, fresh], sort=False)
+            self.build_lookups()
+        self.columns, self.hashes = columns, hashes
+        if self.index_file is not None:
+            pd.to_pickle({'columns': self.columns, 'hashes': self.hashes,
+                          'arrests': self.arrests}, self.index_file)
+        print("Arrest index: %d cases changed, %d removed, %d arrests" % (
+            len(changed), len(removed), len(self.arrests)))
+        return self
+
+    def __contains__(self, suspect_id):
+        return suspect_id in self.by_suspect.index
+
+    def arrested(self, suspect_ids):
+        """Return a boolean array of whether each suspect id has been arrested."""
+        return self.by_suspect.index.get_indexer(pd.Index(suspect_ids)) >= 0
+
+    def arrest_dates(self, suspect_ids):
+        """Return the arrest date of each suspect id, missing for those not arrested."""
+        return self.by_suspect['Arrest_Date'].reindex(suspect_ids).to_numpy()
+
+    def total_arrests(self, case_ids):
+        """Return the number of suspects arrested in each case as an integer array."""
+        return self.totals.reindex(case_ids).fillna(0).to_numpy(dtype=np.int64)
+
+    def join(self, df, on='suspect_id'):
+        """Return a copy of df with the arrest columns of each row's suspect id added, as a
+        left merge on suspect_id would add them. Clashing names get the suffix 'y'."""
+        rows = self.by_suspect.reindex(df[on])
+        joined = df.copy()
+        for col in rows.columns:
+            joined[col + 'y' if col in df.columns else col] = rows[col].to_numpy()
+        return joined
@@ -0,0 +1,230 @@
+'''
+This is a module for keeping daily backups of the Case Dispatcher sheets. Sheets are split
+into blocks of rows which are stored once each, by a hash of their content, so a day's
+backup only adds the blocks that changed since earlier backups. Rows are stored in the
+order of their hashes and split where the content says, so that blocks of unchanged rows
+are found again however the sheet has been re-sorted.
+'''
+
+import hashlib
+import json
+import os
+from datetime import date, timedelta
+import numpy as np
+import pandas as pd
+
+
+def block_hash(block):
+    """Return a hex digest identifying the content of a block of string columns."""
+    row_hashes = pd.util.hash_pandas_object(block, index=False).to_numpy()
+    digest = hashlib.sha1(str(block.shape[1]).encode())
+    digest.update(np.ascontiguousarray(row_hashes).tobytes())
+    return digest.hexdigest()
+
+
+def block_ends(row_hashes, block_rows):
+    """Return the end positions of the blocks of rows sorted by their hashes.
+
+    A block ends after a row whose hash is a multiple of block_rows, so blocks hold
+    block_rows rows on average and a changed row only changes the block it is in. Blocks
+    are cut at no more than 4 * block_rows rows.
+    """
+    last = np.append(row_hashes[1:] != row_hashes[:-1], True)
+    ends, start = [], 0
+    for end in np.flatnonzero((row_hashes % np.uint64(block_rows) == 0) & last) + 1:
+        ends.extend(range(start + 4 * block_rows, end, 4 * block_rows))
+        ends.append(end)
+        start = end
+    ends.extend(range(start + 4 * block_rows, len(row_hashes), 4 * block_rows))
+    if start < len(row_hashes):
+        ends.append(len(row_hashes))
+    return [int(end) for end in ends]
+
+
+def to_block_frame(df):
+    """Return a copy of df with positional column names and every value as a string or NA,
+    as stored in a block. Worksheet headers needn't be unique, so they are kept in the
+    manifest instead."""
+    block = pd.DataFrame({'c%d' % i: df.iloc[:, i].to_numpy() for i in range(df.shape[1])},
+                         index=pd.RangeIndex(len(df)))
+    return block.astype('string')
+
+
+class Backup_Store:
+    """This is a class for content addressed backups of dataframes with a manifest per day.
+
+    Args:
+        store_dir: Directory holding 'blocks/' and 'manifests/'.
+        block_rows: Average number of rows in each stored block.
+        keep_daily: Number of most recent days whose backups are all kept by prune.
+        keep_weekly: Number of weeks before those for which the last backup of the week is kept.
+        keep_monthly: Number of months for which the last backup of the month is kept.
+    """
+    def __init__(self, store_dir='backups', block_rows=500, keep_daily=14, keep_weekly=8,
+                 keep_monthly=12):
+        self.store_dir = store_dir
+        self.block_dir = os.path.join(store_dir, 'blocks')
+        self.manifest_dir = os.path.join(store_dir, 'manifests')
+        os.makedirs(self.block_dir, exist_ok=True)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        self.block_rows = block_rows
+        self.keep_daily = keep_daily
+        self.keep_weekly = keep_weekly
+        self.keep_monthly = keep_monthly
+
+    def block_path(self, h, ext='.parquet'):
+        return os.path.join(self.block_dir, h[:2], h + ext)
+
+    def find_block(self, h):
+        """Return the path of a stored block, or None if it isn't stored."""
+        for ext in ['.parquet', '.pkl']:
+            if os.path.exists(self.block_path(h, ext)):
+                return self.block_path(h, ext)
+        return None
+
+    def write_block(self, part):
+        """Store a block unless it is already stored and return its hash and whether it
+        was written."""
+        h = block_hash(part)
+        if self.find_block(h) is not None:
+            return h, False
+        path = self.block_path(h)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            part.to_parquet(path + '.tmp', compression='zstd', index=False)
+        except ImportError:
+            # No parquet engine is installed
+            path = self.block_path(h, '.pkl')
+            part.to_pickle(path + '.tmp')
+        os.replace(path + '.tmp', path)
+        return h, True
+
+    def read_block(self, h):
+        path = self.find_block(h)
+        if path is None:
+            raise Exception('Backup block {0} is missing'.format(h))
+        if path.endswith('.parquet'):
+            return pd.read_parquet(path)
+        return pd.read_pickle(path)
+
+    def manifest_path(self, day):
+        return os.path.join(self.manifest_dir, day.isoformat() + '.json')
+
+    def days(self):
+        """Return the dates with a backup, oldest first."""
+        return sorted(date.fromisoformat(f[:-5]) for f in os.listdir(self.manifest_dir)
+                      if f.endswith('.json'))
+
+    def read_manifest(self, day):
+        path = self.manifest_path(day)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def save(self, group, dfs, day=None):
+        """Back up a dictionary of dataframes under a group name, e.g. 'sheets', for a day.
+
+        Only blocks not already in the store are written. Saving a group again on the same
+        day replaces that group in the day's manifest.
+
+        Returns:
+            A dictionary with the number of blocks in the backup and the number written.
+        """
+        day = day or date.today()
+        stats = {'blocks': 0, 'written': 0}
+        entries = {}
+        for name, df in dfs.items():
+            df = pd.DataFrame(df)
+            block = to_block_frame(df)
+            row_hashes = pd.util.hash_pandas_object(block, index=False).to_numpy()
+            order = np.argsort(row_hashes, kind='stable')
+            block = block.take(order)
+            hashes, start = [], 0
+            for end in block_ends(row_hashes[order], self.block_rows):
+                h, written = self.write_block(block.iloc[start:end].reset_index(drop=True))
+                hashes.append(h)
+                stats['written'] += written
+                start = end
+            # The sheet's row order is kept as a block of its own
+            order_hash, written = self.write_block(pd.DataFrame({'row': order}))
+            stats['written'] += written
+            stats['blocks'] += len(hashes) + 1
+            entries[name] = {'columns': [str(c) for c in df.columns], 'rows': len(df),
+                             'blocks': hashes, 'order': order_hash}
+        manifest = self.read_manifest(day)
+        manifest[group] = entries
+        with open(self.manifest_path(day) + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(self.manifest_path(day) + '.tmp', self.manifest_path(day))
+        print("Backed up %d %s in %d blocks, %d new" % (
+            len(entries), group, stats['blocks'], stats['written']))
+        return stats
+
+    def restore(self, group, day=None):
+        """Return the dataframes of a group as backed up on a day, by default the latest.
+
+        Values are restored as strings, with missing values as None.
+        """
+        days = self.days()
+        if day is None and days:
+            day = days[-1]
+        manifest = self.read_manifest(day) if day is not None else {}
+        if group not in manifest:
+            raise Exception('No backup of {0} for {1}'.format(group, day))
+        dfs = {}
+        for name, entry in manifest[group].items():
+            parts = [self.read_block(h) for h in entry['blocks']]
+            if parts:
+                df = pd.concat(parts, ignore_index=True)
+            else:
+                df = pd.DataFrame(columns=range(len(entry['columns'])), dtype='string')
+            if 'order' in entry:
+                order = self.read_block(entry['order'])['row'].to_numpy()
+                df = df.iloc[np.argsort(order)].reset_index(drop=True)
+            df = df.astype(object).where(df.notna(), None)
+            df.columns = entry['columns']
+            dfs[name] = df
+        return dfs
+
+    def retained_days(self, today=None):
+        """Return the set of backup days kept under the retention policy."""
+        today = today or date.today()
+        days = self.days()
+        keep = {d for d in days if (today - d).days < self.keep_daily}
+        weeks, months = {}, {}
+        for d in days:
+            weeks[d.isocalendar()[:2]] = d
+            months[(d.year, d.month)] = d
+        first_week = today - timedelta(days=self.keep_daily + 7 * self.keep_weekly)
+        keep.update(d for d in weeks.values() if d >= first_week)
+        keep.update(d for (year, month), d in months.items()
+                    if (today.year - year) * 12 + today.month - month < self.keep_monthly)
+        return keep
+
+    def prune(self, today=None):
+        """Delete backups outside the retention policy and blocks no backup refers to.
+
+        Returns:
+            A dictionary with the number of manifests and blocks deleted.
+        """
+        keep = self.retained_days(today)
+        stats = {'manifests': 0, 'blocks': 0}
+        for d in self.days():
+            if d not in keep:
+                os.remove(self.manifest_path(d))
+                stats['manifests'] += 1
+        used = set()
+        for d in self.days():
+            for entries in self.read_manifest(d).values():
+                for entry in entries.values():
+                    used.update(entry['blocks'])
+                    used.add(entry.get('order'))
+        for sub in os.listdir(self.block_dir):
+            for f in os.listdir(os.path.join(self.block_dir, sub)):
+                if f.split('.')[0] not in used:
+                    os.remove(os.path.join(self.block_dir, sub, f))
+                    stats['blocks'] += 1
+        if stats['manifests'] or stats['blocks']:
+            print("Pruned %(manifests)d backups and %(blocks)d blocks" % stats)
+        return stats
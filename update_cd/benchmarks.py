@@ -0,0 +1,204 @@
+'''
+This is a module for benchmarking steps of the Case Dispatcher on synthetic data against
+the implementations they replaced, e.g. python benchmarks.py arrests --rows 200000
+'''
+
+import argparse
+import os
+import tracemalloc
+from copy import deepcopy
+from time import perf_counter
+import numpy as np
+import pandas as pd
+import arrest_module as am
+import case_ids as ci
+import col_manifest as cm
+import db_connect as dc
+import entity_groups as eg
+import priority_calc as pc
+import sheet_schema as sc
+import synth_data as sd
+
+
+def measure(fn, repeat=3):
+    """Return the best time in seconds of calling fn and the peak memory it allocated."""
+    times = []
+    for _ in range(repeat):
+        t0 = perf_counter()
+        fn()
+        times.append(perf_counter() - t0)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def report(name, baseline, candidate, repeat=3):
+    """Measure and print a baseline and a candidate implementation of a step."""
+    base_time, base_peak = measure(baseline, repeat)
+    cand_time, cand_peak = measure(candidate, repeat)
+    print("%s: %0.3fs, %0.1f MB peak before; %0.3fs, %0.1f MB peak after (%0.1fx faster)" % (
+        name, base_time, base_peak / 2**20, cand_time, cand_peak / 2**20,
+        base_time / cand_time))
+    return {'baseline': (base_time, base_peak), 'candidate': (cand_time, cand_peak)}
+
+
+def get_arrests_per_pb(a_df):
+    """get_arrests as it was, building a frame per Person Box for PB1 to PB7."""
+    arrests = pd.DataFrame(a_df)
+    arrests = arrests.loc[arrests['Outcome (Arrest)'].eq(1)]
+    pbs = ['PB' + str(n) for n in range(1, 8)]
+    for p in pbs:
+        arrests[p + '_ID'] = arrests['IRF#'] + '.' + p
+    for p in pbs:
+        arrests[p + '_Case_ID'] = arrests['IRF#']
+    dpb = {}
+    for p in pbs:
+        cnames = [col for col in arrests.columns if p in col]
+        dpb['df_{0}'.format(p)] = pd.DataFrame(arrests[cnames])
+    df_list = list(dpb.values())
+    for df in df_list:
+        df.columns = ['Name', 'Arrested', 'Arrest_Date', 'suspect_id', 'Case_ID']
+    df_pb_all = pd.concat(df_list)
+    arrests = df_pb_all[df_pb_all.Arrested.astype(str).str.contains("Yes")]
+    arrests['Total_Arrests'] = arrests.groupby(['Case_ID'])['Case_ID'].transform('count')
+    arrests['Arrest'] = 1
+    return arrests
+
+
+def bench_arrests(rows, seed=0):
+    """Benchmark get_arrests on an Arrests sheet of rows cases with seven Person Boxes."""
+    rng = np.random.default_rng(seed)
+    cases = pd.DataFrame({'Case_ID': np.char.add('C', np.arange(rows).astype(str))})
+    sheet = sc.parse_sheet('Arrests', sd.make_arrests(rng, cases, share=1))
+    pd.testing.assert_frame_equal(get_arrests_per_pb(sheet.copy()), am.get_arrests(sheet),
+                                  check_dtype=False, check_categorical=False)
+    return report('get_arrests, %d rows' % rows,
+                  lambda: get_arrests_per_pb(sheet.copy()),
+                  lambda: am.get_arrests(sheet.copy()))
+
+
+def combine_deepcopy(sheet):
+    """Entity_Group.combine as it was, aligning a deep copy of all the new data."""
+    sheet.newcopy = deepcopy(sheet.new)
+    sheet.newcopy = sheet.newcopy.reindex(
+        columns=sheet.new.columns.tolist() + list(sheet.gsheet.columns))
+    sheet.newcopy = sheet.newcopy.iloc[:, 5:len(sheet.newcopy.columns)]
+    sheet.active = pd.concat([sheet.gsheet, sheet.newcopy], sort=False)
+    sheet.active.drop_duplicates(subset=sheet.uid, inplace=True)
+
+
+def make_entity_groups(rows, seed=0):
+    """Make Victims, Suspects and Police Entity Groups for rows cases, with new data shaped
+    like that of set_vic_id and set_sus_id."""
+    tables = sd.make_searchlight_tables(rows, seed)
+    sheets = sc.parse_sheets(sd.make_worksheet_dfs(tables, seed))
+    sus, vics = sd.get_entity_ids(tables)
+    sus['Address'] = vics['Address'] = ''
+    new_sus = sus[['Name', 'Phone_Number(s)', 'Address', 'Case_ID', 'Suspect_ID']]
+    new_vics = vics[['Case_ID', 'Name', 'Phone_Number(s)', 'Address', 'Victim_ID']]
+    return [eg.Entity_Group('Victim_ID', new_vics, sheets['Victims'], sheets['Closed_Vic'],
+                            'victims'),
+            eg.Entity_Group('Suspect_ID', new_sus, sheets['Suspects'], sheets['Closed_Sus'],
+                            'suspects'),
+            eg.Entity_Group('Suspect_ID', new_sus.rename(columns={'Name': 'Suspect_Name'}),
+                            sheets['Police'], sheets['Closed_Pol'], 'police')]
+
+
+def bench_combine(rows, seed=0):
+    """Benchmark combining new data with the Victims, Suspects and Police sheets of rows cases."""
+    groups = make_entity_groups(rows, seed)
+    for sheet in groups:
+        combine_deepcopy(sheet)
+        expected = sheet.active
+        sheet.combine()
+        pd.testing.assert_frame_equal(expected, sheet.active)
+    return report('combine_sheets, %d cases' % rows,
+                  lambda: [combine_deepcopy(sheet) for sheet in groups],
+                  lambda: [sheet.combine() for sheet in groups])
+
+
+def merge_ids(victims, suspects, police):
+    """Merges and isin tests between ID columns of the active sheets, as priority_calc and
+    Dispatch_Run.move_other_closed make them."""
+    pc.add_priority_to_others(suspects, victims, 'Case_ID', victims, 'Victim_ID')
+    pc.add_priority_to_others(suspects, police, 'Suspect_ID', police, 'Suspect_ID')
+    pd.merge(suspects, police[['Suspect_ID', 'Victims_Willing_to_Testify']], how='left',
+             on='Suspect_ID')
+    suspects['Suspect_ID'].isin(police['Suspect_ID'])
+    victims['Case_ID'].isin(suspects['Case_ID'])
+    return suspects.drop_duplicates(subset='Suspect_ID')
+
+
+def id_memory(frames):
+    """Return the bytes taken by the ID columns of frames, counting shared categories once."""
+    total, categories = 0, {}
+    for df in frames:
+        for col in df.columns.intersection(list(ci.ID_COLUMNS)):
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                total += df[col].cat.codes.nbytes
+                cats = df[col].cat.categories
+                categories[id(cats)] = cats.memory_usage(deep=True)
+            else:
+                total += df[col].memory_usage(index=False, deep=True)
+    return total + sum(categories.values())
+
+
+def bench_ids(rows, seed=0):
+    """Benchmark merges and isin on string IDs against IDs encoded by an ID_Dictionary, on
+    the active Victims, Police and Suspects sheets of rows cases."""
+    groups = make_entity_groups(rows, seed)
+    for sheet in groups:
+        sheet.combine()
+    frames = [sheet.active for sheet in groups]
+    encoded = ci.ID_Dictionary().encode(*frames)
+    pd.testing.assert_frame_equal(merge_ids(*frames),
+                                  ci.ID_Dictionary().decode(merge_ids(*encoded)))
+    print("ID columns: %0.1f MB as strings, %0.1f MB encoded" % (
+        id_memory(frames) / 2**20, id_memory(encoded) / 2**20))
+    return report('ID merges and isin, %d cases' % rows,
+                  lambda: merge_ids(*frames),
+                  lambda: merge_ids(*encoded))
+
+
+def bench_copy(rows, seed=0, db_cred='database.ini'):
+    """Benchmark extracting the CIF query of rows cases with copy_query against ex_query.
+
+    The synthetic Searchlight tables are loaded into the Postgres database in db_cred, which
+    should be a scratch database since tables of the same names are replaced.
+    """
+    if not os.path.exists(db_cred):
+        print("copy: skipped, no database credentials in %s" % db_cred)
+        return None
+    sd.load_postgres(sd.make_searchlight_tables(rows, seed), db_cred)
+    dbc = dc.DB_Conn(db_cred)
+    query = cm.get_queries(dbc)['cif'].format(changed='TRUE')
+    pd.testing.assert_frame_equal(dbc.ex_query(query), dbc.copy_query(query))
+    result = report('CIF extract, %d cases' % rows,
+                    lambda: dbc.ex_query(query),
+                    lambda: dbc.copy_query(query))
+    dbc.close_conn()
+    return result
+
+
+BENCHMARKS = {'arrests': bench_arrests, 'combine': bench_combine, 'ids': bench_ids,
+              'copy': bench_copy}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Case Dispatcher steps')
+    parser.add_argument('benchmarks', nargs='*', default=list(BENCHMARKS),
+                        help="Benchmarks to run: %s (all if omitted)" % ', '.join(BENCHMARKS))
+    parser.add_argument('--rows', type=int, default=100000,
+                        help="Number of rows of synthetic data")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed for the synthetic data")
+    parser.add_argument('--db_cred', default='database.ini',
+                        help="Credentials of a scratch Postgres database for the copy benchmark")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name == 'copy':
+            bench_copy(args.rows, args.seed, args.db_cred)
+        else:
+            BENCHMARKS[name](args.rows, args.seed)
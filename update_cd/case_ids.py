@@ -0,0 +1,236 @@
+'''
+This is a module for deriving the Case, Victim and Suspect IDs used throughout the Case
+Dispatcher from the form numbers (cif_number) stored in the database.
+'''
+
+from threading import Lock
+import numpy as np
+import pandas as pd
+
+# A cif_number is a case number followed by the victim, either as a letter counting from A or
+# as a dotted number, e.g. BHD123A or BHD123.1 for the first victim of case BHD123.
+CIF_NUMBER = r'^(?P<case>.*?)(?:\.(?P<number>\d+)|(?P<letter>[A-Za-z]))$'
+
+
+def parse_unique(cif_numbers):
+    """Parse unique cif_numbers into a dataframe of their Case_ID and Victim_ID.
+
+    Dots are removed from case numbers. A cif_number not ending in a victim keeps the Case_ID
+    of its characters but the last, with dots removed, and is its own Victim_ID.
+    """
+    values = pd.Series(cif_numbers, dtype=object)
+    parts = values.str.extract(CIF_NUMBER)
+    matched = parts['case'].notna()
+    letters = parts['letter'].str.upper().map(ord, na_action='ignore') - ord('A') + 1
+    numbers = pd.to_numeric(parts['number']).fillna(letters)
+    case_ids = parts['case'].str.replace('.', '', regex=False)
+    fallback = values.str.replace('.', '', regex=False).str[:-1]
+    victim_ids = case_ids + '.V' + numbers.astype('Int64').astype(str)
+    return pd.DataFrame({'Case_ID': case_ids.where(matched, fallback).to_numpy(),
+                         'Victim_ID': victim_ids.where(matched, values).to_numpy()},
+                        index=pd.Index(values, dtype=object))
+
+
+class CIF_Parser:
+    """This is a class for parsing cif_numbers, which remembers every cif_number it has parsed
+    so that each is only parsed once however many times, and by however many steps, it is
+    looked up. Parsing is guarded by a lock so that runs in several threads can share one
+    parser."""
+    def __init__(self):
+        self.parsed = parse_unique([])
+        self.lock = Lock()
+
+    def parse(self, cif_numbers):
+        """Return arrays of the Case_ID and Victim_ID of each cif_number, missing for missing
+        cif_numbers."""
+        codes, uniques = pd.factorize(pd.Series(cif_numbers, dtype=object))
+        with self.lock:
+            new = uniques[self.parsed.index.get_indexer(uniques) < 0]
+            if len(new):
+                self.parsed = pd.concat([self.parsed, parse_unique(new)])
+            parsed = self.parsed
+        pos = np.append(parsed.index.get_indexer(uniques), -1)[codes]
+        table = parsed.to_numpy()
+        ids = np.append(table, np.full((1, 2), np.nan, dtype=object), axis=0)[pos]
+        return ids[:, 0], ids[:, 1]
+
+
+# Shared by every step, and every run, so a cif_number is parsed once per process
+parser = CIF_Parser()
+
+
+def suspect_ids(case_ids, pb_numbers):
+    """Return an array of the Suspect IDs of Person Boxes, e.g. BHD123.PB2, from their Case
+    IDs and integer Person Box numbers."""
+    codes, numbers = pd.factorize(pd.Series(pb_numbers))
+    labels = np.array(['.PB%d' % n for n in numbers] + [np.nan], dtype=object)
+    return (pd.Series(case_ids, dtype=object).reset_index(drop=True) +
+            pd.Series(labels[codes])).to_numpy()
+
+
+def get_ids(cif_numbers, pb_numbers=None):
+    """Derive IDs from cif_numbers in a single pass.
+
+    Args:
+        cif_numbers: Series or array of cif_numbers.
+        pb_numbers: Integer Person Box number of each cif_number, or None for victims.
+
+    Returns:
+        A dataframe, aligned with cif_numbers, of the Case_ID and Victim_ID of each
+        cif_number, and its Suspect_ID if pb_numbers are given.
+    """
+    index = cif_numbers.index if isinstance(cif_numbers, pd.Series) else None
+    case_ids, victim_ids = parser.parse(cif_numbers)
+    ids = pd.DataFrame({'Case_ID': case_ids, 'Victim_ID': victim_ids}, index=index)
+    if pb_numbers is not None:
+        ids['Suspect_ID'] = suspect_ids(case_ids, pb_numbers)
+    return ids
+
+
+def case_ids(cif_numbers):
+    """Return the Case_ID of each cif_number, aligned with cif_numbers."""
+    return get_ids(cif_numbers)['Case_ID']
+
+
+# Victim letters and numbers replaced in cif_numbers to give Victim IDs before this module
+LEGACY_VICTIMS = {r'(\.1|A$)': '.V1', r'B$': '.V2', r'C$': '.V3', r'D$': '.V4', r'E$': '.V5',
+                  r'F$': '.V6', r'G$': '.V7', r'H$': '.V8', r'I$': '.V9', r'J$': '.V10'}
+
+
+def legacy_ids(cif_numbers, pb_numbers=None):
+    """Return a dataframe, like get_ids, of the IDs derived from cif_numbers before this
+    module, which the sheets of earlier runs may hold.
+
+    The Case_ID was the cif_number without dots or its last character and the Victim_ID the
+    cif_number with the victims in LEGACY_VICTIMS replaced, so Victim IDs after J, of
+    lowercase letters or of dotted numbers other than 1 were left as cif_numbers.
+    """
+    values = pd.Series(cif_numbers, dtype=object).reset_index(drop=True)
+    case_ids = values.str.replace('.', '', regex=False).str[:-1]
+    ids = pd.DataFrame({'Case_ID': case_ids, 'Victim_ID': values.replace(LEGACY_VICTIMS,
+                                                                          regex=True)})
+    if pb_numbers is not None:
+        pbs = pd.Series(pb_numbers).reset_index(drop=True).fillna(0).astype(int)
+        ids['Suspect_ID'] = case_ids + '.PB' + pbs.map(str)
+    return ids
+
+
+def legacy_id_maps(vic_cif_numbers, sus_cif_numbers, pb_numbers):
+    """Return a dictionary, by kind of ID, of Series mapping IDs derived before this module
+    to the current IDs of the same victims and suspects.
+
+    IDs derived the same way by both are left out, as are old IDs which are also current
+    IDs or which became more than one current ID, so that no ID is remapped ambiguously.
+    """
+    derived = [(legacy_ids(vic_cif_numbers), get_ids(vic_cif_numbers), ['Case_ID', 'Victim_ID']),
+               (legacy_ids(sus_cif_numbers, pb_numbers), get_ids(sus_cif_numbers, pb_numbers),
+                ['Case_ID', 'Suspect_ID'])]
+    pairs = {'Case_ID': [], 'Victim_ID': [], 'Suspect_ID': []}
+    for old, new, kinds in derived:
+        for kind in kinds:
+            pairs[kind].append(pd.DataFrame({'old': old[kind].to_numpy(),
+                                             'new': new[kind].to_numpy()}))
+    maps = {}
+    for kind, frames in pairs.items():
+        kind_pairs = pd.concat(frames, ignore_index=True).dropna().drop_duplicates()
+        current = kind_pairs['new']
+        kind_pairs = kind_pairs[kind_pairs['old'] != kind_pairs['new']]
+        ambiguous = kind_pairs['old'].duplicated(keep=False) | kind_pairs['old'].isin(current)
+        kind_pairs = kind_pairs[~ambiguous]
+        maps[kind] = pd.Series(kind_pairs['new'].to_numpy(),
+                               index=pd.Index(kind_pairs['old'], dtype=object))
+    return maps
+
+
+def remap_legacy_ids(title, df, maps):
+    """Return a worksheet dataframe with IDs derived before this module, found in maps from
+    legacy_id_maps, replaced by the current IDs. Once the sheet is uploaded no old IDs are
+    left, so later runs find nothing to remap."""
+    remapped = 0
+    df = df.copy()
+    for i, col in enumerate(df.columns):
+        if col not in ID_COLUMNS or not len(maps[ID_COLUMNS[col]]):
+            continue
+        values = df.iloc[:, i].to_numpy(dtype=object)
+        new = maps[ID_COLUMNS[col]].reindex(values).to_numpy()
+        found = pd.notna(new)
+        if found.any():
+            remapped += int(found.sum())
+            df.isetitem(i, np.where(found, new, values))
+    if remapped:
+        print("%s: %d IDs derived by earlier runs replaced by current IDs" % (title, remapped))
+    return df
+
+
+# Columns holding IDs, with the kind of ID each holds
+ID_COLUMNS = {'Case_ID': 'Case_ID',
+              'Victim_ID': 'Victim_ID',
+              'Suspect_ID': 'Suspect_ID',
+              'suspect_id': 'Suspect_ID'}
+
+
+class ID_Dictionary:
+    """This is a class for the IDs of a run, encoded as categoricals with one shared set of
+    categories for each kind of ID. Merges, isin, drop_duplicates and index lookups between
+    ID columns encoded by the same dictionary then work on their integer codes rather than
+    on strings. Categories are only ever appended to, and always include '' so that blank
+    IDs can be filled in as the sheets show them.
+    """
+    def __init__(self):
+        self.categories = {kind: pd.Index([''], dtype=object) for kind in ID_COLUMNS.values()}
+        self.dtypes = {}
+
+    def id_columns(self, df):
+        """Return the positions of the ID columns of a dataframe with the kind of each."""
+        return [(i, ID_COLUMNS[col]) for i, col in enumerate(df.columns) if col in ID_COLUMNS]
+
+    def add(self, kind, values):
+        """Add the IDs in values which aren't in the dictionary yet."""
+        values = pd.Series(values)
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.cat.categories.to_series()
+        values = pd.unique(values.dropna().astype(object))
+        new = values[self.categories[kind].get_indexer(values) < 0]
+        if len(new):
+            self.categories[kind] = self.categories[kind].append(pd.Index(new, dtype=object))
+            self.dtypes.pop(kind, None)
+
+    def dtype(self, kind):
+        """Return the categorical dtype of a kind of ID."""
+        if kind not in self.dtypes:
+            self.dtypes[kind] = pd.CategoricalDtype(self.categories[kind])
+        return self.dtypes[kind]
+
+    def encode(self, *frames):
+        """Return copies of dataframes with their ID columns encoded.
+
+        The IDs of all the frames are added before any is encoded, so frames encoded in one
+        call share dtypes and are merged on codes. Frames encoded earlier are brought up to
+        the current dtypes by encoding them again.
+        """
+        for df in frames:
+            for i, kind in self.id_columns(df):
+                self.add(kind, df.iloc[:, i])
+        encoded = []
+        for df in frames:
+            df = df.copy()
+            for i, kind in self.id_columns(df):
+                df.isetitem(i, df.iloc[:, i].astype(self.dtype(kind)))
+            encoded.append(df)
+        return encoded
+
+    def decode(self, df):
+        """Return a copy of a dataframe with its encoded ID columns as strings."""
+        df = df.copy()
+        for i, kind in self.id_columns(df):
+            if isinstance(df.iloc[:, i].dtype, pd.CategoricalDtype):
+                df.isetitem(i, df.iloc[:, i].astype(object))
+        return df
+
+
+def encode_like(values, ids):
+    """Return values as IDs of the same dtype as ids when ids are encoded, so that the two can
+    be merged on codes. Values not in the dictionary become missing."""
+    if isinstance(ids.dtype, pd.CategoricalDtype):
+        return pd.Series(values).astype(ids.dtype)
+    return values
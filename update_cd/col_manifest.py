@@ -0,0 +1,129 @@
+'''
+This is a module for building the list of database columns used by the Case Dispatcher
+and turning it into projected select queries, so that unused columns are never fetched.
+'''
+
+CIF_TABLE = 'dataentry_cifnepal'
+PB_TABLE = 'dataentry_personboxnepal'
+PERSON_TABLE = 'dataentry_person'
+ADDRESS1_TABLE = 'dataentry_address1'
+ADDRESS2_TABLE = 'dataentry_address2'
+
+# Features which soc_pipe.organize_dtypes one-hot encodes, named '<feature>_<value>' in X_cols
+CAT_FEATURES = ['pv_occupation', 'occupation', 'education', 'station_id', 'role']
+
+# Features in X_cols which are derived from other columns or come from the Arrests sheet
+DERIVED_PREFIXES = ['destination_']
+ARREST_FEATURES = ['Name', 'Arrested', 'Case_ID', 'Total_Arrests']
+
+# Columns used by soc_pipe, entity_groups and priority_calc in addition to the model features
+CIF_ID_COLS = ['cif_number', 'pb_number', 'person_id', 'cif_id', 'interview_date',
+               'planned_destination']
+VICTIM_COLS = ['cif_number', 'full_name', 'phone_contact', 'address1_id', 'address2_id']
+SUSPECT_COLS = ['cif_id', 'person_id', 'full_name', 'phone_contact', 'address1_id', 'address2_id']
+
+# Columns of the address1/address2 join which entity_groups.subset_addresses uses, as
+# (table alias, column, name selected as)
+ADDRESS_COLUMNS = [('ad1', 'name', 'address_1'),
+                   ('ad2', 'id', 'address2_id'),
+                   ('ad2', 'name', 'address_2')]
+
+
+def get_feature_columns(x_cols_file='X_cols.txt'):
+    """Return the raw CIF and Person Box columns needed to engineer the model features.
+
+    Args:
+        x_cols_file: File listing the model's feature columns, written by soc_pipe.save_results.
+
+    Returns:
+        A list of database column names, with the victim's occupation as 'pv_occupation'.
+    """
+    x_cols = [line.rstrip('\n') for line in open(x_cols_file)]
+    cols = list(CIF_ID_COLS)
+    for x in x_cols:
+        if x in ARREST_FEATURES or any(x.startswith(p) for p in DERIVED_PREFIXES):
+            continue
+        cat = [c for c in CAT_FEATURES if x.startswith(c + '_')]
+        if cat:
+            col = cat[0]
+        elif x.endswith('_pb2'):
+            # en_features adds '2' to each Person Box field after matching the PB number
+            col = x[:-1]
+        else:
+            col = x
+        if col not in cols:
+            cols.append(col)
+    return cols
+
+
+def project(needed, sources):
+    """Attribute each needed column to the first source table which has it.
+
+    Args:
+        needed: Column names to select.
+        sources: List of (alias, table columns) tuples in order of preference.
+
+    Returns:
+        A list of select expressions ordered as the columns are in the tables.
+    """
+    needed = set(needed)
+    select_list = []
+    for alias, table_cols in sources:
+        for col in table_cols:
+            if col in needed:
+                select_list.append('{0}.{1}'.format(alias, col))
+                needed.discard(col)
+    if needed:
+        print("Columns not found in database: %s" % ', '.join(sorted(needed)))
+    return select_list
+
+
+def cif_select(table_cols, x_cols_file='X_cols.txt'):
+    """Build the select list for the CIF/Person Box join used by soc_pipe."""
+    needed = get_feature_columns(x_cols_file)
+    select_list = []
+    if 'pv_occupation' in needed:
+        # The CIF's occupation column describes the potential victim
+        select_list.append('CIF.occupation AS pv_occupation')
+        needed.remove('pv_occupation')
+    if 'occupation' in needed:
+        needed.remove('occupation')
+        select_list += project(['occupation'], [('PB', table_cols[PB_TABLE])])
+    return select_list + project(needed, [('CIF', table_cols[CIF_TABLE]),
+                                          ('PB', table_cols[PB_TABLE])])
+
+
+def address_select(table_cols):
+    """Build the select list for the address join, matching entity_groups.subset_addresses."""
+    tables = {'ad1': table_cols[ADDRESS1_TABLE], 'ad2': table_cols[ADDRESS2_TABLE]}
+    missing = ['{0}.{1}'.format(alias, col) for alias, col, _ in ADDRESS_COLUMNS
+               if col not in tables[alias]]
+    if missing:
+        raise Exception('Address columns not found in database: {0}'.format(', '.join(missing)))
+    return ['{0}.{1} AS {2}'.format(alias, col, name) for alias, col, name in ADDRESS_COLUMNS]
+
+
+def get_queries(dbc, x_cols_file='X_cols.txt'):
+    """Return projected versions of the Case Dispatcher's Searchlight queries.
+
+    The CIF, victim and suspect queries end with 'WHERE {changed}' so that they can be
+    used as snapshot_store definitions.
+    """
+    table_cols = dbc.get_table_columns([CIF_TABLE, PB_TABLE, PERSON_TABLE,
+                                        ADDRESS1_TABLE, ADDRESS2_TABLE])
+    cif_cols = cif_select(table_cols, x_cols_file)
+    vic_cols = project(VICTIM_COLS, [('p', table_cols[PERSON_TABLE]),
+                                     ('CIF', table_cols[CIF_TABLE])])
+    sus_cols = project(SUSPECT_COLS, [('pb', table_cols[PB_TABLE]),
+                                      ('p', table_cols[PERSON_TABLE])])
+    return {
+        'cif': "SELECT " + ", ".join(cif_cols) + " FROM public.dataentry_cifnepal as CIF \
+    inner join public.dataentry_personboxnepal as PB on CIF.id = PB.cif_id WHERE {changed}",
+        'vics': "SELECT " + ", ".join(vic_cols) + " FROM public.dataentry_person as p \
+    inner join public.dataentry_cifnepal as CIF on p.id = CIF.main_pv_id WHERE {changed}",
+        'sus': "SELECT " + ", ".join(sus_cols) + " FROM public.dataentry_personboxnepal as pb \
+    inner join public.dataentry_person as p on pb.person_id = p.id WHERE {changed}",
+        'add': "SELECT " + ", ".join(address_select(table_cols)) + " FROM \
+    public.dataentry_address1 as ad1 inner join public.dataentry_address2 as ad2 \
+    on ad1.id = ad2.address1_id",
+    }
@@ -1,14 +1,40 @@
 '''
-This is a module for connecting to postgresql database and executing queries.
+This is a module for connecting to postgresql database (or a local SQLite stand-in) and
+executing queries.
 '''
 
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import count
+from queue import Queue
+import os
+import re
+import sqlite3
+from tempfile import TemporaryFile
+from time import time
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 import psycopg2
 
+_cursor_ids = count(1)
+
+# Postgres type OIDs from cursor.description used to choose compact dtypes
+PG_BOOL = 16
+PG_INTS = (20, 21, 23)
+PG_FLOATS = {700: 'float32', 701: 'float64', 1700: 'float64'}
+PG_DATES = (1082, 1114)
+PG_TIMESTAMPTZ = 1184
+PG_TEXT = (18, 19, 25, 114, 1042, 1043, 3802)
+
+ISO_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}( \d{2}:\d{2}:\d{2}(\.\d+)?)?$')
+
+
 class DB_Conn(object):
     """This is a class for establishing a connection with the database."""
-    def __init__(self, db_filename, section='postgresql'):
+    def __init__(self, db_filename, section='postgresql', max_cat_ratio=0.1):
         # create a parser
         parser = ConfigParser()
         # read config file
@@ -25,18 +51,376 @@ class DB_Conn(object):
         conn = psycopg2.connect(**params)
         self.conn = conn
         self.cur = conn.cursor()
+        # Text columns with no more unique values than this share of rows become categories
+        self.max_cat_ratio = max_cat_ratio
 
-    def ex_query(self, select_query):
-        """Execute query and return dataframe."""
+    def ex_query(self, select_query, params=None):
+        """Execute query and return dataframe with compact dtypes."""
         query = select_query
         cur = self.cur
-        cur.execute(query)
+        cur.execute(query, params)
         colnames = [desc[0] for desc in cur.description]
+        type_codes = [desc[1] for desc in cur.description]
         rows = cur.fetchall()
-        return pd.DataFrame(rows, columns=colnames)
+        return type_frame(pd.DataFrame(rows, columns=colnames), type_codes, self.max_cat_ratio)
+
+    def get_table_columns(self, tables, schema='public'):
+        """Return a dictionary of column name lists, in table order, for each table."""
+        cols = self.ex_query("SELECT table_name, column_name FROM information_schema.columns \
+        WHERE table_schema = %s AND table_name IN %s ORDER BY table_name, ordinal_position",
+                             (schema, tuple(tables)))
+        return {t: cols.loc[cols.table_name == t, 'column_name'].tolist() for t in tables}
+
+    def ex_query_chunks(self, select_query, chunk_size=10000, params=None):
+        """Execute query on a server-side cursor and yield dataframes of chunk_size rows.
+
+        Only one chunk of rows is held on the client at a time, so peak memory
+        depends on chunk_size rather than on the size of the result.
+        """
+        cur = self.conn.cursor(name='cd_stream_{0}'.format(next(_cursor_ids)))
+        cur.itersize = chunk_size
+        try:
+            cur.execute(select_query, params)
+            rows = cur.fetchmany(chunk_size)
+            colnames = [desc[0] for desc in cur.description]
+            type_codes = [desc[1] for desc in cur.description]
+            while rows:
+                # concat_chunks makes categories which every chunk shares
+                yield type_frame(pd.DataFrame(rows, columns=colnames), type_codes, None)
+                rows = cur.fetchmany(chunk_size)
+        finally:
+            cur.close()
+
+    def ex_query_streamed(self, select_query, params=None, chunk_size=10000):
+        """Execute query in chunks and return a single compact dataframe."""
+        return concat_chunks(self.ex_query_chunks(select_query, chunk_size, params),
+                             self.max_cat_ratio)
+
+    def copy_query(self, select_query, params=None, out_file=None):
+        """Extract query results with COPY and parse them straight into typed columns.
+
+        Rows are streamed by the server as CSV into a temporary file which is then
+        parsed column-wise by pandas, avoiding a Python tuple per row. Column names
+        and types are taken from the query's cursor description. If out_file ends
+        in '.parquet', '.feather' or '.arrow' the dataframe is also written there.
+        """
+        cur = self.cur
+        query = select_query.strip().rstrip(';')
+        if params is not None:
+            query = cur.mogrify(query, params).decode()
+        cur.execute('SELECT * FROM ({0}) AS q LIMIT 0'.format(query))
+        colnames = [desc[0] for desc in cur.description]
+        type_codes = [desc[1] for desc in cur.description]
+        with TemporaryFile() as buf:
+            cur.copy_expert("COPY ({0}) TO STDOUT WITH (FORMAT csv, NULL '\\N')".format(query),
+                            buf)
+            buf.seek(0)
+            df = pd.read_csv(buf,
+                             header=None,
+                             names=list(range(len(colnames))),
+                             dtype={i: str for i, t in enumerate(type_codes) if t in PG_TEXT},
+                             na_values=['\\N'],
+                             keep_default_na=False,
+                             true_values=['t'],
+                             false_values=['f'],
+                             low_memory=False)
+        df = type_frame(df, type_codes, self.max_cat_ratio)
+        df.columns = colnames
+        if out_file is not None:
+            write_columnar(df, out_file)
+        return df
 
     def close_conn(self):
         """Close the cursor and the connection."""
         self.cur.close()
         self.conn.close()
         print("PostgreSQL connection is closed")
+
+
+class DB_Pool(object):
+    """This is a class for running independent queries concurrently on a pool of connections."""
+    def __init__(self, db_filename, size=4, section='postgresql', max_cat_ratio=0.1):
+        self.size = size
+        self.all_conns = [DB_Conn(db_filename, section, max_cat_ratio) for _ in range(size)]
+        self.idle_conns = Queue()
+        for dbc in self.all_conns:
+            self.idle_conns.put(dbc)
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the exclusive use of the calling thread."""
+        dbc = self.idle_conns.get()
+        try:
+            yield dbc
+        finally:
+            self.idle_conns.put(dbc)
+
+    def ex_query(self, select_query, params=None):
+        """Execute query on the next free connection and return dataframe."""
+        with self.connection() as dbc:
+            return dbc.ex_query(select_query, params)
+
+    def ex_query_streamed(self, select_query, params=None, chunk_size=10000):
+        """Execute query in chunks on the next free connection and return dataframe."""
+        with self.connection() as dbc:
+            return dbc.ex_query_streamed(select_query, params, chunk_size)
+
+    def copy_query(self, select_query, params=None, out_file=None):
+        """Extract query results with COPY on the next free connection."""
+        with self.connection() as dbc:
+            return dbc.copy_query(select_query, params, out_file)
+
+    def get_table_columns(self, tables, schema='public'):
+        """Return a dictionary of column name lists, in table order, for each table."""
+        with self.connection() as dbc:
+            return dbc.get_table_columns(tables, schema)
+
+    def ex_concurrent(self, tasks):
+        """Run tasks concurrently, each on its own connection, and return all of their results.
+
+        Args:
+            tasks: Dictionary of functions taking a DB_Conn, keyed by name.
+
+        Returns:
+            A dictionary of the functions' return values with the same keys.
+        """
+        def run(task):
+            with self.connection() as dbc:
+                return task(dbc)
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            futures = {name: executor.submit(run, task) for name, task in tasks.items()}
+            return {name: future.result() for name, future in futures.items()}
+
+    def ex_queries(self, queries, method='ex_query'):
+        """Execute a dictionary of independent queries concurrently and return their dataframes."""
+        return self.ex_concurrent(
+            {name: lambda dbc, q=query: getattr(dbc, method)(q) for name, query in queries.items()})
+
+    def close_conn(self):
+        """Close every connection in the pool."""
+        for dbc in self.all_conns:
+            dbc.close_conn()
+
+
+class SQLite_Conn(DB_Conn):
+    """This is a class for running the Case Dispatcher's queries against a local SQLite file,
+    e.g. one written by synth_data, in place of the Searchlight database.
+
+    The file is attached as schema 'public' so queries can be run unchanged. Parameters
+    in psycopg2 style are converted, COPY and server-side cursors fall back to ordinary
+    queries and dtypes are inferred from the values rather than from type OIDs.
+    """
+    def __init__(self, db_file, max_cat_ratio=0.1):
+        if not os.path.exists(db_file):
+            raise Exception('SQLite database {0} not found'.format(db_file))
+        self.conn = sqlite3.connect(':memory:', check_same_thread=False)
+        self.conn.execute('ATTACH DATABASE ? AS public', (db_file,))
+        self.cur = self.conn.cursor()
+        self.max_cat_ratio = max_cat_ratio
+
+    def execute(self, cur, select_query, params=None):
+        """Execute a query written with psycopg2 style parameters on an SQLite cursor."""
+        query = re.sub(r'%\((\w+)\)s', r':\1', select_query).replace('%s', '?')
+        if isinstance(params, dict):
+            params = {k: to_sqlite(v) for k, v in params.items()}
+        elif params is not None:
+            params = [to_sqlite(v) for v in params]
+        cur.execute(query, params if params is not None else [])
+
+    def ex_query(self, select_query, params=None):
+        """Execute query and return dataframe with compact dtypes."""
+        self.execute(self.cur, select_query, params)
+        colnames = [desc[0] for desc in self.cur.description]
+        df = pd.DataFrame(self.cur.fetchall(), columns=colnames)
+        return compact_dtypes(parse_sqlite_dates(df), self.max_cat_ratio)
+
+    def get_table_columns(self, tables, schema='public'):
+        """Return a dictionary of column name lists, in table order, for each table."""
+        return {t: self.ex_query("SELECT name FROM {0}.pragma_table_info('{1}')".format(
+            schema, t))['name'].tolist() for t in tables}
+
+    def ex_query_chunks(self, select_query, chunk_size=10000, params=None):
+        """Execute query and yield dataframes of chunk_size rows."""
+        cur = self.conn.cursor()
+        try:
+            self.execute(cur, select_query, params)
+            colnames = [desc[0] for desc in cur.description]
+            rows = cur.fetchmany(chunk_size)
+            while rows:
+                yield parse_sqlite_dates(pd.DataFrame(rows, columns=colnames))
+                rows = cur.fetchmany(chunk_size)
+        finally:
+            cur.close()
+
+    def copy_query(self, select_query, params=None, out_file=None):
+        """Execute query, as SQLite has no COPY, and optionally write it to out_file."""
+        df = self.ex_query(select_query, params)
+        if out_file is not None:
+            write_columnar(df, out_file)
+        return df
+
+    def close_conn(self):
+        """Close the cursor and the connection."""
+        self.cur.close()
+        self.conn.close()
+        print("SQLite connection is closed")
+
+
+def parse_sqlite_dates(df):
+    """Convert text columns holding ISO dates or timestamps to datetime64, as Postgres
+    date columns would be, since SQLite has no date type."""
+    for i in range(len(df.columns)):
+        col = df.iloc[:, i]
+        if col.dtype == object:
+            first = col.dropna().head(1)
+            if len(first) and isinstance(first.iloc[0], str) and ISO_DATE.match(first.iloc[0]):
+                df.isetitem(i, pd.to_datetime(col, errors='coerce'))
+    return df
+
+
+def to_sqlite(value):
+    """Convert datetimes to the text format the synthetic tables store them in."""
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+
+def to_small_int(col):
+    """Convert a column of integers to the smallest nullable integer dtype which fits."""
+    col = pd.to_numeric(col)
+    lo, hi = col.min(), col.max()
+    for dtype in ['Int8', 'Int16', 'Int32']:
+        info = np.iinfo(dtype.lower())
+        if pd.isna(lo) or (lo >= info.min and hi <= info.max):
+            return col.astype(dtype)
+    return col.astype('Int64')
+
+
+def type_column(col, type_code, max_cat_ratio=None):
+    """Convert a column of query results to a compact dtype based on its Postgres type OID.
+
+    Args:
+        col: A series of values as returned by psycopg2 or parsed from COPY output.
+        type_code: The column's type OID from cursor.description.
+        max_cat_ratio: Text columns with no more than this many unique values per row
+        are converted to categories. If None text columns are left as they are.
+
+    Returns:
+        The converted series: nullable booleans and small integers, floats, datetime64
+        for dates and timestamps and categories for low-cardinality text.
+    """
+    if type_code == PG_BOOL:
+        return col.astype('boolean')
+    elif type_code in PG_INTS:
+        return to_small_int(col)
+    elif type_code in PG_FLOATS:
+        return pd.to_numeric(col).astype(PG_FLOATS[type_code])
+    elif type_code in PG_DATES:
+        return pd.to_datetime(col, errors='coerce')
+    elif type_code == PG_TIMESTAMPTZ:
+        return pd.to_datetime(col, errors='coerce', utc=True)
+    elif type_code in PG_TEXT and max_cat_ratio is not None and len(col) > 0:
+        if col.nunique() <= max_cat_ratio * len(col):
+            return col.astype('category')
+    return col
+
+
+def type_frame(df, type_codes, max_cat_ratio=None):
+    """Convert each column of a query result according to its Postgres type OID.
+
+    The converted columns are put together in a new dataframe, since setting them one at a
+    time copies the rest of the block of columns each one came from.
+    """
+    typed = pd.DataFrame({i: type_column(df.iloc[:, i], type_code, max_cat_ratio)
+                          for i, type_code in enumerate(type_codes)}, index=df.index)
+    typed.columns = df.columns
+    return typed
+
+
+def compact_dtypes(df, max_cat_ratio=None):
+    """Downcast integer columns and optionally convert repetitive text columns to categories.
+
+    Text columns are only converted when max_cat_ratio is given, in which case any
+    column with no more than max_cat_ratio unique values per row becomes a category.
+    """
+    for i in range(len(df.columns)):
+        col = df.iloc[:, i]
+        if pd.api.types.is_integer_dtype(col) and not pd.api.types.is_bool_dtype(col):
+            df.isetitem(i, pd.to_numeric(col, downcast='integer'))
+        elif max_cat_ratio is not None and not isinstance(col.dtype, pd.CategoricalDtype) \
+                and pd.api.types.infer_dtype(col, skipna=True) == 'string':
+            if col.nunique() <= max_cat_ratio * len(col):
+                df.isetitem(i, col.astype('category'))
+    return df
+
+
+def concat_chunks(chunks, max_cat_ratio=None):
+    """Compact each chunk as it arrives and concatenate them into one dataframe.
+
+    When max_cat_ratio is given, every text column of a chunk is converted to a category
+    on arrival so that only compact chunks are held, and the chunks' categories are
+    combined with their union. Columns with more than max_cat_ratio unique values per row
+    overall are turned back into text.
+    """
+    frames = [compact_dtypes(chunk, None if max_cat_ratio is None else 1)
+              for chunk in chunks]
+    if not frames:
+        return pd.DataFrame()
+    columns = {}
+    for i in range(len(frames[0].columns)):
+        parts = [frame.iloc[:, i] for frame in frames]
+        if max_cat_ratio is None \
+                or not all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            columns[i] = pd.concat(parts, ignore_index=True)
+            continue
+        col = pd.Series(union_categoricals(parts, ignore_order=True))
+        n_categories = len(col.cat.categories)
+        if n_categories == 0 or n_categories > max_cat_ratio * len(col):
+            col = col.astype(object)
+        columns[i] = col
+    df = pd.DataFrame(columns)
+    df.columns = frames[0].columns
+    del frames, columns
+    # Columns which were text in only some of the chunks
+    return compact_dtypes(df, max_cat_ratio)
+
+
+def unique_colnames(colnames):
+    """Suffix repeated column names (e.g. 'id' from both sides of a join) with a count."""
+    seen = {}
+    new_names = []
+    for name in colnames:
+        if name in seen:
+            seen[name] += 1
+            new_names.append('{0}_{1}'.format(name, seen[name]))
+        else:
+            seen[name] = 0
+            new_names.append(name)
+    return new_names
+
+
+def write_columnar(df, out_file):
+    """Write dataframe to a Parquet or Arrow (Feather) file depending on the extension."""
+    out_df = df.copy(deep=False)
+    out_df.columns = unique_colnames([str(c) for c in df.columns])
+    if str(out_file).endswith('.parquet'):
+        out_df.to_parquet(out_file, index=False)
+    elif str(out_file).endswith(('.feather', '.arrow')):
+        out_df.reset_index(drop=True).to_feather(out_file)
+    else:
+        raise Exception('Unsupported file type for {0}, use .parquet or .feather'.format(out_file))
+
+
+def compare_extract(dbc, select_query, repeat=3):
+    """Time ex_query against copy_query for the same query and print the results."""
+    results = {}
+    for name, method in [('ex_query', dbc.ex_query), ('copy_query', dbc.copy_query)]:
+        times = []
+        for _ in range(repeat):
+            t0 = time()
+            df = method(select_query)
+            times.append(time() - t0)
+        results[name] = min(times)
+        print("%s: %d rows in %0.3fs (best of %d)" % (name, len(df), min(times), repeat))
+    print("copy_query speedup: %0.1fx" % (results['ex_query'] / results['copy_query']))
+    return results
@@ -1,17 +1,22 @@
 '''
 This is a module for working with Entity Groups (Victims, Suspects, Police).
 '''
+import os
 from datetime import date
+import numpy as np
 import pandas as pd
-from copy import deepcopy
+import case_ids as ci
+import sheet_schema as sc
 
 
 def subset_addresses(db_add):
     """Selects and renames address fields from database which will be used."""
-    addr = db_add.iloc[:, [1, 6, 7]]
     acols = ['address_1',
              'address2_id',
              'address_2']
+    if list(db_add.columns) == acols:
+        return db_add
+    addr = db_add.iloc[:, [1, 6, 7]]
     addr.columns = acols
     return addr
 
@@ -23,96 +28,225 @@ class GetAttr:
 
 
 class Entity_Group(GetAttr):
-    """This is a class for Victims, Suspects, and Police entity groups with corresponding sheets."""
-    sheets = []
+    """This is a class for Victims, Suspects, and Police entity groups with corresponding sheets.
 
+    Rows closed during a run are kept aside and only added to the closed sheet when it is
+    next read, so closing rows doesn't copy the whole closed history each time."""
     def __init__(self, uid, new_cases, active_gsheet, closed_gsheet, name):
-        Entity_Group.sheets.append(self)
         self.uid = uid
         self.new = new_cases
         self.gsheet = active_gsheet
         self.closed = closed_gsheet
         self.name = name
 
-    @classmethod
-    def merge_addresses(cls, addr):
+    @property
+    def closed(self):
+        if self.closing:
+            self._closed = pd.concat([self._closed] + self.closing, sort=False)
+            self.closing = []
+        return self._closed
+
+    @closed.setter
+    def closed(self, closed_gsheet):
+        self._closed = closed_gsheet
+        self.closing = []
+
+    def align(self, rows):
+        """Return rows of new case data with the columns of the sheet. The new data's
+        columns are followed by the sheet's and the first five dropped, so the five columns
+        of new data made by set_vic_id and set_sus_id are matched to the sheet's by name."""
+        columns = (rows.columns.tolist() + self.gsheet.columns.tolist())[5:]
+        return rows.reindex(columns=columns)
+
+    def combine(self):
+        """Adds the new cases whose ID isn't in the sheet yet to the sheet's rows, as the
+        active sheet. Only the added rows are copied and aligned to the sheet's columns."""
+        gsheet = self.gsheet
+        repeated = gsheet[self.uid].duplicated()
+        if repeated.any():
+            gsheet = gsheet[~repeated]
+        ids = self.new[self.uid]
+        added = self.new[~ids.isin(gsheet[self.uid]) & ~ids.duplicated()]
+        self.active = pd.concat([gsheet, self.align(added)], sort=False)
+
+    def close(self, rows):
+        """Moves rows to the closed sheet, apart from those whose ID is already closed, and
+        removes them from the active sheet."""
+        rows = rows.drop_duplicates(subset=self.uid)
+        rows = rows[~self.status.is_closed(rows[self.uid])]
+        if len(rows) == 0:
+            return
+        self.status.close(rows[self.uid])
+        self.closing.append(rows)
+        self.active = self.active[~self.active[self.uid].isin(rows[self.uid])]
+
+
+class Status_Index:
+    """This is a class for the status, active or closed, and the case of each ID of an Entity
+    Group, indexed by ID. It is built once per run from the group's sheets, after which
+    closing IDs and looking IDs or cases up cost as much as the IDs involved, however long
+    the closed history is.
+
+    Args:
+        active: Active sheet of the group.
+        closed: Closed sheet of the group, whose rows take precedence over active ones.
+        uid: Name of the ID column.
+    """
+    def __init__(self, active, closed, uid):
+        ids = pd.Index(closed[uid]).append(pd.Index(active[uid]))
+        first = ~ids.duplicated()
+        self.ids = ids[first]
+        # Kept as an array of the cases' dtype, so encoded cases are looked up by code
+        self.cases = pd.concat([closed['Case_ID'], active['Case_ID']],
+                               ignore_index=True).array[first]
+        self.closed = np.arange(len(ids))[first] < len(closed)
+        # Number of active IDs in each case, to tell which cases are still open. IDs without
+        # a case, factorized as -1, belong to no case.
+        codes, cases = pd.factorize(self.cases[~self.closed])
+        self.case_index = pd.Index(cases)
+        self.open_counts = np.bincount(codes[codes >= 0], minlength=len(cases))
+
+    def is_closed(self, ids):
+        """Return a boolean array of whether each ID is closed. Unknown IDs are not."""
+        pos = self.ids.get_indexer(pd.Index(ids))
+        return np.append(self.closed, False)[pos]
+
+    def has_open_case(self, cases):
+        """Return a boolean array of whether each case has an active ID in the group."""
+        pos = self.case_index.get_indexer(pd.Index(cases))
+        return np.append(self.open_counts, 0)[pos] > 0
+
+    def close(self, ids):
+        """Mark IDs as closed, updating the open cases."""
+        pos = self.ids.get_indexer(pd.Index(ids))
+        pos = np.unique(pos[pos >= 0])
+        pos = pos[~self.closed[pos]]
+        self.closed[pos] = True
+        case_pos = self.case_index.get_indexer(pd.Index(self.cases[pos]))
+        np.subtract.at(self.open_counts, case_pos[case_pos >= 0], 1)
+
+    def lookup(self, ids):
+        """Return a dataframe of the Status, 'Active' or 'Closed', and Case_ID of each ID,
+        both missing for unknown IDs."""
+        pos = self.ids.get_indexer(pd.Index(ids))
+        known = pos >= 0
+        status = np.where(self.closed[pos], 'Closed', 'Active').astype(object)
+        status[~known] = None
+        cases = self.cases[pos]
+        cases[~known] = None
+        return pd.DataFrame({'Status': status, 'Case_ID': cases}, index=pd.Index(ids))
+
+
+class Dispatch_Run:
+    """This is a class for a single run of the Case Dispatcher, which owns the Entity Groups
+    created during the run and the sheets they produce. Runs share no state, so scheduled or
+    concurrent runs in one process don't see each other's groups. Groups are released by
+    close, or on leaving a with block.
+
+    The IDs of the run are encoded with an ID_Dictionary once the new data have IDs, and
+    decoded when the sheets are written.
+
+    Args:
+        csv_dir: Directory the csvs of the sheets to upload are written to.
+    """
+    def __init__(self, csv_dir='backups'):
+        self.csv_dir = csv_dir
+        self.sheets = []
+        self.new_gsheets = []
+        self.ids = ci.ID_Dictionary()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Release the Entity Groups and sheets of the run."""
+        self.sheets = []
+        self.new_gsheets = []
+
+    def add_group(self, uid, new_cases, active_gsheet, closed_gsheet, name):
+        """Create an Entity Group belonging to this run and return it."""
+        group = Entity_Group(uid, new_cases, active_gsheet, closed_gsheet, name)
+        self.sheets.append(group)
+        return group
+
+    def merge_addresses(self, addr):
         """Adds relevant address data to new entity groups."""
-        addr = addr
-        for sheet in cls.sheets:
+        for sheet in self.sheets:
             #sheet.new.infer_objects
             if 'address1_id' in sheet.new:
                 sheet.new['address1_id'] = sheet.new['address1_id'].fillna(0).astype(int)
                 sheet.new['address2_id'] = sheet.new['address2_id'].fillna(0).astype(int)
                 sheet.new = pd.merge(sheet.new, addr, how='left', on='address2_id')
-                sheet.new['Address'] = sheet.new['address_2'].map(str) + ", " + sheet.new['address_1']
-
-    @classmethod
-    def set_case_id(cls):
-        """Creates a Case ID from the form ID stored in the database."""
-        for sheet in cls.sheets:
-            sheet.new.loc[:, 'Case_ID'] = sheet.new['Case_ID'].str.replace('.', '')
-            sheet.new['Case_ID'] = sheet.new['Case_ID'].str[:-1]
-
-    @classmethod
-    def combine_sheets(cls):
-        """Adds new case data to data already in the corresponding Google Sheet."""
-        for sheet in cls.sheets:
-            sheet.newcopy = deepcopy(sheet.new)
-            sheet.newcopy = sheet.newcopy.reindex(
-                columns=sheet.new.columns.tolist() + list(sheet.gsheet.columns))
-            sheet.newcopy = sheet.newcopy.iloc[:, 5:len(sheet.newcopy.columns)]
-            sheet.active = pd.concat([sheet.gsheet, sheet.newcopy], sort=False)
-            sheet.active.drop_duplicates(subset=sheet.uid, inplace=True)
-
-    @classmethod
-    def move_closed(cls, arrests):
-        """Moves closed cases to the closed sheet for each Entity Group instance."""
-        for sheet in cls.sheets:
-            prev_closed = sheet.newcopy[sheet.newcopy[sheet.uid].isin(arrests.suspect_id)]
+                sheet.new['Address'] = sheet.new['address_2'].astype(object).map(str) + ", " + \
+                                       sheet.new['address_1'].astype(object)
+
+    def encode_ids(self, *frames):
+        """Encode the IDs of the new data and sheets of the Entity Groups, together with those
+        of other frames they will be merged with, and return the other frames encoded."""
+        groups = [frame for sheet in self.sheets
+                  for frame in (sheet.new, sheet.gsheet, sheet.closed)]
+        encoded = self.ids.encode(*groups, *frames)
+        for sheet in self.sheets:
+            sheet.new, sheet.gsheet, sheet.closed = encoded[:3]
+            encoded = encoded[3:]
+        return encoded
+
+    def combine_sheets(self):
+        """Adds new case data to data already in the corresponding Google Sheet and indexes
+        the status of each ID, leaving IDs already in the closed sheet out of the active one."""
+        for sheet in self.sheets:
+            sheet.combine()
+            repeated = sheet.closed[sheet.uid].duplicated()
+            if repeated.any():
+                sheet.closed = sheet.closed[~repeated]
+            sheet.status = Status_Index(sheet.active, sheet.closed, sheet.uid)
+            sheet.active = sheet.active[~sheet.status.is_closed(sheet.active[sheet.uid])]
+
+    def move_closed(self, arrests):
+        """Moves closed cases, and new cases of suspects in the Arrest_Index arrests, to the
+        closed sheet for each Entity Group of the run."""
+        for sheet in self.sheets:
+            prev_closed = sheet.align(sheet.new[arrests.arrested(sheet.new[sheet.uid])])
             prev_closed['Case_Status'] = "Closed: Already in Legal Cases Sheet"
-            newly_closed = sheet.gsheet[sheet.gsheet['Date_Closed'].str.len() > 1]
-            sheet.closed = pd.concat([sheet.closed, prev_closed, newly_closed], sort=False)
-            sheet.closed.drop_duplicates(subset=sheet.uid, inplace=True)
-            sheet.active = sheet.active[~sheet.active[sheet.uid].isin(sheet.closed[sheet.uid])]
-
-    @classmethod
-    def move_other_closed(cls, suspects, police, victims):
-        """Moves cases closed in other Entity Group instances to closed sheets."""
+            date_closed = sc.format_column(sheet.gsheet['Date_Closed'], 'date')
+            newly_closed = sheet.gsheet[date_closed.str.len() > 1]
+            sheet.close(pd.concat([prev_closed, newly_closed], sort=False))
+
+    def move_other_closed(self, suspects, police, victims):
+        """Moves cases closed in other Entity Groups of the run to closed sheets: suspects
+        and police closed in the other group or without an open victims case, and victims
+        without an open suspects and police case."""
         closed_suspects = suspects.active[
-            (suspects.active['Suspect_ID'].isin(police.closed['Suspect_ID'])) |
-            (~suspects.active['Case_ID'].isin(victims.active['Case_ID']))]
+            police.status.is_closed(suspects.active['Suspect_ID']) |
+            ~victims.status.has_open_case(suspects.active['Case_ID'])]
         closed_police = police.active[
-            (police.active['Suspect_ID'].isin(suspects.closed['Suspect_ID'])) |
-            (~police.active['Case_ID'].isin(victims.active['Case_ID']))]
+            suspects.status.is_closed(police.active['Suspect_ID']) |
+            ~victims.status.has_open_case(police.active['Case_ID'])]
         closed_victims = victims.active[
-            (~victims.active['Case_ID'].isin(police.active['Case_ID'])) |
-            (~victims.active['Case_ID'].isin(suspects.active['Case_ID']))]
-        suspects.closed = pd.concat(
-            [suspects.closed, closed_suspects],
-            sort=False).drop_duplicates(subset='Suspect_ID')
-        police.closed = pd.concat(
-            [police.closed, closed_police],
-            sort=False).drop_duplicates(subset='Suspect_ID')
-        victims.closed = pd.concat(
-            [victims.closed, closed_victims],
-            sort=False).drop_duplicates(subset='Victim_ID')
-        for sheet in cls.sheets:
-            sheet.active = sheet.active[~sheet.active[sheet.uid].isin(sheet.closed[sheet.uid])]
-
-    new_gsheets = []
-
-    @classmethod
-    def save_csvs(cls):
-        """'Write csvs for active/closed in each Entity Group and return list of new gsheets."""
-        for sheet in cls.sheets:
-            sheet.active.csv = 'backups/' + sheet.name + '.csv'
-            sheet.closed.csv = 'backups/closed_' + sheet.name[:3] + '.csv'
-        for sheet in cls.sheets:
-            Entity_Group.new_gsheets.append(sheet.active)
-            Entity_Group.new_gsheets.append(sheet.closed)
-        for ngs in cls.new_gsheets:
+            ~police.status.has_open_case(victims.active['Case_ID']) |
+            ~suspects.status.has_open_case(victims.active['Case_ID'])]
+        suspects.close(closed_suspects)
+        police.close(closed_police)
+        victims.close(closed_victims)
+
+    def save_csvs(self):
+        """'Write csvs for active/closed in each Entity Group and return list of new gsheets,
+        with typed columns formatted as they are shown in the sheets."""
+        self.new_gsheets = []
+        for sheet in self.sheets:
+            active = sc.format_sheet(sheet.name.capitalize(), self.ids.decode(sheet.active))
+            closed = sc.format_sheet('Closed_' + sheet.name[:3].capitalize(),
+                                     self.ids.decode(sheet.closed))
+            active.csv = os.path.join(self.csv_dir, sheet.name + '.csv')
+            closed.csv = os.path.join(self.csv_dir, 'closed_' + sheet.name[:3] + '.csv')
+            self.new_gsheets.append(active)
+            self.new_gsheets.append(closed)
+        for ngs in self.new_gsheets:
             ngs.to_csv(ngs.csv, index=False, header=None)
-        return cls.new_gsheets
+        return self.new_gsheets
 
 
 def set_vic_id(new_victims):
@@ -121,13 +255,9 @@ def set_vic_id(new_victims):
                                'full_name',
                                'phone_contact',
                                'Address']]
-    new_victims.loc[:, 'Victim_ID'] = new_victims['cif_number']
-    replacements = {
-        'Victim_ID': {
-            r'(\.1|A$)': '.V1', r'B$': '.V2', r'C$': '.V3', r'D$': '.V4', r'E$': '.V5',
-            r'F$': '.V6', r'G$': '.V7', r'H$': '.V8', r'I$': '.V9', r'J$': '.V10'}
-    }
-    new_victims.replace(replacements, regex=True, inplace=True)
+    ids = ci.get_ids(new_victims['cif_number'])
+    new_victims['cif_number'] = ids['Case_ID']
+    new_victims['Victim_ID'] = ids['Victim_ID']
     new_victims.sort_values('full_name', inplace=True)
     new_victims = new_victims.drop_duplicates(subset='Victim_ID')
     non_blanks = new_victims['full_name'] != ""
@@ -150,15 +280,14 @@ def set_sus_id(new_suspects, db_cif):
     new_suspects = pd.merge(new_suspects, cif_ids, how='outer', on='person_id', sort=True,
                             suffixes=('x', 'y'), copy=True)
     new_suspects.loc[:, 'pb_number'] = new_suspects['pb_number'].fillna(0).astype(int)
-    new_suspects.loc[:, 'Suspect_ID'] = new_suspects.loc[:, 'cif_number'].str.replace('.', '')
-    new_suspects.loc[:, 'Suspect_ID'] = new_suspects.loc[:, 'Suspect_ID'].str[:-1] + \
-                                        ".PB" + new_suspects['pb_number'].map(str)
+    ids = ci.get_ids(new_suspects['cif_number'], new_suspects['pb_number'])
+    new_suspects['Case_ID'] = ids['Case_ID']
+    new_suspects['Suspect_ID'] = ids['Suspect_ID']
     new_suspects = new_suspects.drop_duplicates(subset='Suspect_ID')
-    new_suspects = new_suspects.iloc[:, [1, 2, 3, 4, 6]]
+    new_suspects = new_suspects[['full_name', 'phone_contact', 'Address', 'Case_ID', 'Suspect_ID']]
     new_suspects.rename(columns={
         'full_name': 'Name',
-        'phone_contact': 'Phone_Number(s)',
-        'cif_number': 'Case_ID'}, inplace=True)
+        'phone_contact': 'Phone_Number(s)'}, inplace=True)
     return new_suspects
 
 
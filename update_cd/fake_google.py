@@ -0,0 +1,560 @@
+'''
+This is a module providing an in-process stand-in for the Google Sheets (gspread) and Drive
+APIs used by gsheets, with simulated latency, quota errors and call counting, so that the
+Case Dispatcher's Google I/O can be run and measured offline.
+'''
+
+import csv
+import io
+import json
+import os
+import re
+from collections import Counter, deque
+from datetime import timedelta
+from itertools import count
+from random import Random
+from threading import Lock
+from time import monotonic, sleep
+import gspread
+from apiclient.errors import HttpError
+
+# Key of the stats spreadsheet written by gsheets.upload_stats_sheet
+STATS_KEY = '19bm_1qKNV2KI6O4KNzQYUpQzycayd09Iw1MJna43FVA'
+URL_KEY = re.compile(r'/spreadsheets/d/([a-zA-Z0-9-_]+)')
+A1_CELL = re.compile(r'^([A-Z]*)(\d*)$')
+
+
+class Fake_Response:
+    """This is a class for the parts of a requests.Response which gspread and gsheets use."""
+    def __init__(self, status_code=200, elapsed=0.0, message=''):
+        self.status_code = status_code
+        self.elapsed = timedelta(seconds=elapsed)
+        self.text = json.dumps({'error': {'code': status_code, 'message': message}})
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class Fake_Session:
+    """This is a class standing in for a client's requests session, running response hooks."""
+    def __init__(self):
+        self.hooks = {'response': []}
+
+
+def split_range(a1_range):
+    """Split an A1 range like "'Sheet 1'!B2:C3" into the sheet title and cell range."""
+    if '!' in a1_range:
+        title, cells = a1_range.rsplit('!', 1)
+    elif a1_range.startswith("'") or not A1_CELL.match(a1_range.split(':')[0]):
+        title, cells = a1_range, ''
+    else:
+        title, cells = None, a1_range
+    if title is not None and title.startswith("'"):
+        title = title[1:-1].replace("''", "'")
+    return title, cells
+
+
+def a1_to_rowcol(cell):
+    """Convert an A1 cell like 'B2' to zero-based (row, col), with None for a missing part."""
+    letters, digits = A1_CELL.match(cell).groups()
+    col = None
+    if letters:
+        col = 0
+        for letter in letters:
+            col = col * 26 + ord(letter) - 64
+        col -= 1
+    return (int(digits) - 1 if digits else None), col
+
+
+class Fake_Worksheet:
+    """This is a class for a worksheet held in memory."""
+    def __init__(self, spreadsheet, title, sheet_id, rows=1000, cols=26):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = sheet_id
+        self.row_count = rows
+        self.col_count = cols
+        self.values = []
+
+    def __repr__(self):
+        return "<Worksheet '%s' id:%s>" % (self.title, self.id)
+
+    def read(self):
+        """Return a copy of the worksheet's values without counting an API call."""
+        return [list(row) for row in self.values]
+
+    def write(self, r0, c0, values):
+        """Write a block of values with its top left cell at (r0, c0)."""
+        r1 = r0 + len(values)
+        c1 = c0 + max([len(row) for row in values] or [0])
+        if r1 > self.row_count or c1 > self.col_count:
+            raise self.spreadsheet.backend.api_error(
+                400, 'Range exceeds grid limits of %s' % self.title)
+        while len(self.values) < r1:
+            self.values.append([])
+        for i, row in enumerate(values):
+            cur = self.values[r0 + i]
+            if len(cur) < c0 + len(row):
+                cur.extend([''] * (c0 + len(row) - len(cur)))
+            cur[c0:c0 + len(row)] = [str(v) for v in row]
+        self.trim()
+
+    def trim(self):
+        """Drop trailing empty cells and rows, as the API leaves them out of responses."""
+        for row in self.values:
+            while row and row[-1] == '':
+                row.pop()
+        while self.values and not self.values[-1]:
+            self.values.pop()
+
+    def get_all_values(self):
+        """Return all values padded to the width of the longest row."""
+        self.spreadsheet.backend.call('worksheet.get_all_values')
+        values = self.read()
+        width = max([len(row) for row in values] or [0])
+        return [row + [''] * (width - len(row)) for row in values]
+
+    def resize(self, rows=None, cols=None):
+        """Change the size of the grid, dropping values outside it."""
+        self.spreadsheet.backend.call('worksheet.resize')
+        with self.spreadsheet.backend.lock:
+            self.row_count = rows or self.row_count
+            self.col_count = cols or self.col_count
+            self.values = [row[:self.col_count] for row in self.values[:self.row_count]]
+            self.trim()
+
+    def update_acell(self, label, value):
+        """Write a single cell."""
+        self.spreadsheet.backend.call('worksheet.update_acell')
+        with self.spreadsheet.backend.lock:
+            self.write(*a1_to_rowcol(label), [[value]])
+
+
+class Linked_Worksheet(Fake_Worksheet):
+    """This is a class for a worksheet which shows a header row above the first sheet of
+    another spreadsheet, like a Case Dispatcher tab filled with IMPORTRANGE."""
+    def __init__(self, spreadsheet, title, sheet_id, header, source):
+        super().__init__(spreadsheet, title, sheet_id)
+        self.header = header
+        self.source = source
+
+    def read(self):
+        return [list(self.header)] + self.source.sheet1.read()
+
+
+class Fake_Spreadsheet:
+    """This is a class for a spreadsheet held in memory."""
+    def __init__(self, backend, spreadsheet_id, title):
+        self.backend = backend
+        self.id = spreadsheet_id
+        self.title = title
+        self.sheets = []
+        self.permissions = []
+
+    def add_worksheet(self, title, rows=1000, cols=26):
+        """Add an empty worksheet without counting an API call."""
+        ws = Fake_Worksheet(self, title, len(self.sheets))
+        ws.row_count, ws.col_count = rows, cols
+        self.sheets.append(ws)
+        return ws
+
+    @property
+    def sheet1(self):
+        return self.sheets[0]
+
+    def worksheets(self):
+        """Return the list of worksheets."""
+        self.backend.call('spreadsheet.worksheets')
+        return list(self.sheets)
+
+    def worksheet(self, title):
+        """Return a worksheet by title, raising a 400 error if there isn't one."""
+        for ws in self.sheets:
+            if ws.title == title:
+                return ws
+        raise self.backend.api_error(400, 'Unable to parse range: %s' % title)
+
+    def resolve(self, a1_range):
+        """Return the worksheet and zero-based top left cell of an A1 range."""
+        title, cells = split_range(a1_range)
+        ws = self.sheet1 if title is None else self.worksheet(title)
+        r0, c0 = a1_to_rowcol(cells.split(':')[0]) if cells else (0, 0)
+        return ws, r0 or 0, c0 or 0
+
+    def values_batch_get(self, ranges, params=None):
+        """Return the values of several whole worksheets or ranges starting at A1."""
+        self.backend.call('spreadsheet.values_batch_get')
+        value_ranges = []
+        for a1_range in ranges:
+            ws, r0, c0 = self.resolve(a1_range)
+            values = [row[c0:] for row in ws.read()[r0:]]
+            entry = {'range': a1_range, 'majorDimension': 'ROWS'}
+            if values:
+                entry['values'] = values
+            value_ranges.append(entry)
+        return {'spreadsheetId': self.id, 'valueRanges': value_ranges}
+
+    def values_batch_update(self, body):
+        """Write several ranges of values in one call."""
+        self.backend.call('spreadsheet.values_batch_update')
+        with self.backend.lock:
+            for vr in body['data']:
+                ws, r0, c0 = self.resolve(vr['range'])
+                ws.write(r0, c0, vr['values'])
+        return {'spreadsheetId': self.id, 'totalUpdatedCells': sum(
+            len(row) for vr in body['data'] for row in vr['values'])}
+
+    def values_update(self, a1_range, params=None, body=None):
+        """Write one range of values."""
+        self.backend.call('spreadsheet.values_update')
+        with self.backend.lock:
+            ws, r0, c0 = self.resolve(a1_range)
+            ws.write(r0, c0, body['values'])
+        return {'spreadsheetId': self.id}
+
+
+class Fake_Client:
+    """This is a class standing in for an authorized gspread client."""
+    def __init__(self, backend):
+        self.backend = backend
+        self.session = backend.session
+
+    def open(self, title):
+        """Open a spreadsheet by title."""
+        self.backend.call('client.open')
+        for sh in self.backend.spreadsheets.values():
+            if sh.title == title:
+                return sh
+        raise gspread.exceptions.SpreadsheetNotFound(title)
+
+    def open_by_key(self, key):
+        """Open a spreadsheet by id."""
+        self.backend.call('client.open_by_key')
+        if key not in self.backend.spreadsheets:
+            raise self.backend.api_error(404, 'Requested entity was not found.')
+        return self.backend.spreadsheets[key]
+
+    def open_by_url(self, url):
+        """Open a spreadsheet by URL."""
+        match = URL_KEY.search(url)
+        if match is None:
+            raise gspread.exceptions.NoValidUrlKeyFound(url)
+        return self.open_by_key(match.group(1))
+
+    def list_spreadsheet_files(self):
+        """Return the id and name of every spreadsheet."""
+        self.backend.call('client.list_spreadsheet_files')
+        return [{'id': sh.id, 'name': sh.title} for sh in self.backend.spreadsheets.values()]
+
+    def import_csv(self, file_id, data):
+        """Replace the contents of a spreadsheet with a csv."""
+        self.backend.call('client.import_csv')
+        if file_id not in self.backend.spreadsheets:
+            raise self.backend.api_error(404, 'Requested entity was not found.')
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        rows = list(csv.reader(io.StringIO(data)))
+        with self.backend.lock:
+            sh = self.backend.spreadsheets[file_id]
+            ws = sh.sheet1
+            sh.sheets = [ws]
+            ws.values = []
+            ws.row_count = max(len(rows), 1)
+            ws.col_count = max([len(row) for row in rows] or [1])
+            ws.write(0, 0, rows)
+
+
+class Fake_Request:
+    """This is a class for an unexecuted Drive API request."""
+    def __init__(self, backend, name, fn):
+        self.backend = backend
+        self.name = name
+        self.fn = fn
+
+    def execute(self):
+        self.backend.call(self.name)
+        return self.fn()
+
+
+class Fake_Batch:
+    """This is a class standing in for a Drive batch request: one HTTP call whose inner
+    requests each count against the quota."""
+    def __init__(self, backend, callback):
+        self.backend = backend
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id or str(len(self.requests)), request))
+
+    def execute(self):
+        self.backend.call('drive.batch')
+        for request_id, request in self.requests:
+            try:
+                self.backend.call(request.name, http=False)
+                response, exception = request.fn(), None
+            except HttpError as e:
+                response, exception = None, e
+            self.callback(request_id, response, exception)
+
+
+class Fake_Drive:
+    """This is a class standing in for a Drive v3 service object."""
+    def __init__(self, backend):
+        self.backend = backend
+
+    def files(self):
+        return self
+
+    def permissions(self):
+        return Fake_Permissions(self.backend)
+
+    def create(self, body=None, fields=None):
+        """Return a request creating an empty spreadsheet."""
+        def create_file():
+            with self.backend.lock:
+                sh = self.backend.add_spreadsheet(body['name'])
+            return {'id': sh.id}
+        return Fake_Request(self.backend, 'drive.files.create', create_file)
+
+    def list(self, q=None, fields=None):
+        """Return a request listing the spreadsheets with the name a query asks for."""
+        name = re.search(r"name = '([^']*)'", q).group(1)
+
+        def list_files():
+            with self.backend.lock:
+                return {'files': [{'id': sh.id} for sh in self.backend.spreadsheets.values()
+                                  if sh.title == name]}
+        return Fake_Request(self.backend, 'drive.files.list', list_files)
+
+    def delete(self, fileId=None):
+        """Return a request deleting a file."""
+        def delete_file():
+            with self.backend.lock:
+                if self.backend.spreadsheets.pop(fileId, None) is None:
+                    raise self.backend.http_error(404, 'File not found: %s' % fileId)
+            return ''
+        return Fake_Request(self.backend, 'drive.files.delete', delete_file)
+
+    def new_batch_http_request(self, callback=None):
+        return Fake_Batch(self.backend, callback)
+
+
+class Fake_Permissions:
+    """This is a class standing in for the Drive permissions resource."""
+    def __init__(self, backend):
+        self.backend = backend
+
+    def create(self, fileId=None, body=None, fields=None):
+        """Return a request adding a permission to a file."""
+        def create_permission():
+            with self.backend.lock:
+                if fileId not in self.backend.spreadsheets:
+                    raise self.backend.http_error(404, 'File not found: %s' % fileId)
+                self.backend.spreadsheets[fileId].permissions.append(body)
+            return {'id': str(len(self.backend.spreadsheets[fileId].permissions))}
+        return Fake_Request(self.backend, 'drive.permissions.create', create_permission)
+
+
+class Fake_Google:
+    """This is a class for an in-memory Google Sheets and Drive backend.
+
+    Every call sleeps for the configured latency, counts against an optional quota
+    and is recorded in call_counts. install() points gsheets at the fake client and
+    Drive service so the module's functions can be run unchanged.
+
+    Args:
+        latency: Seconds each HTTP call takes, or a (min, max) tuple to draw from.
+        quota: Maximum calls in any quota_window seconds before 429 errors are returned.
+        quota_window: Length of the quota window in seconds.
+        error_rate: Share of calls which fail with a 429 error regardless of the quota.
+        seed: Seed for the latency and error draws.
+    """
+    def __init__(self, latency=0.0, quota=None, quota_window=60, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.quota = quota
+        self.quota_window = quota_window
+        self.error_rate = error_rate
+        self.random = Random(seed)
+        self.spreadsheets = {}
+        self.session = Fake_Session()
+        self.client = Fake_Client(self)
+        self.drive = Fake_Drive(self)
+        self.call_counts = Counter()
+        self.error_counts = Counter()
+        self.http_calls = 0
+        self.recent = deque()
+        self.ids = count(1)
+        self.lock = Lock()
+        self.originals = {}
+
+    def add_spreadsheet(self, title, spreadsheet_id=None):
+        """Create an empty spreadsheet with one worksheet, without counting an API call."""
+        spreadsheet_id = spreadsheet_id or 'fake{0:06d}'.format(next(self.ids))
+        sh = Fake_Spreadsheet(self, spreadsheet_id, title)
+        sh.add_worksheet('Sheet1')
+        self.spreadsheets[spreadsheet_id] = sh
+        return sh
+
+    def api_error(self, status_code, message):
+        """Return a gspread APIError like those raised for an error response."""
+        return gspread.exceptions.APIError(Fake_Response(status_code, message=message))
+
+    def http_error(self, status_code, message):
+        """Return a Drive HttpError like those raised for an error response."""
+        resp = type('Response', (), {'status': status_code, 'reason': message})()
+        return HttpError(resp, json.dumps({'error': {'message': message}}).encode())
+
+    def call(self, name, http=True):
+        """Record a call, wait for its latency and raise an error if it is over quota.
+
+        Requests inside a batch are recorded with http=False, so they count against the
+        quota but not as separate HTTP calls.
+        """
+        with self.lock:
+            self.call_counts[name] += 1
+            over_quota = False
+            if self.quota is not None:
+                now = monotonic()
+                while self.recent and now - self.recent[0] > self.quota_window:
+                    self.recent.popleft()
+                over_quota = len(self.recent) >= self.quota
+                if not over_quota:
+                    self.recent.append(now)
+            failed = over_quota or self.random.random() < self.error_rate
+            if http:
+                self.http_calls += 1
+                latency = self.latency
+                if isinstance(latency, tuple):
+                    latency = self.random.uniform(*latency)
+        if http:
+            sleep(latency)
+            # Drive calls go through googleapiclient's own transport, not the gspread session
+            if not name.startswith('drive.'):
+                response = Fake_Response(429 if failed else 200, latency)
+                for hook in self.session.hooks['response']:
+                    hook(response)
+        if failed:
+            with self.lock:
+                self.error_counts[name] += 1
+            message = 'Quota exceeded for quota metric (fake)'
+            if name.startswith('drive.'):
+                raise self.http_error(429, message)
+            raise self.api_error(429, message)
+
+    def report(self):
+        """Print and return the number of calls made, by type."""
+        stats = {'http_calls': self.http_calls,
+                 'calls': dict(self.call_counts),
+                 'errors': dict(self.error_counts)}
+        print("Fake Google: %d HTTP calls, %d quota errors" % (
+            self.http_calls, sum(self.error_counts.values())))
+        for name, n in sorted(self.call_counts.items()):
+            print("  %s: %d" % (name, n))
+        return stats
+
+    def install(self, module):
+        """Point a module's (i.e. gsheets') Google entry points at this backend."""
+        if module.__name__ not in self.originals:
+            self.originals[module.__name__] = (module, {
+                name: getattr(module, name)
+                for name in ['get_auth', 'build_drive']})
+        module.get_auth = lambda credentials: self.client
+        module.build_drive = lambda credentials: self.drive
+
+    def uninstall(self):
+        """Restore the entry points of every module this backend was installed in."""
+        for module, attrs in self.originals.values():
+            for name, value in attrs.items():
+                setattr(module, name, value)
+        self.originals = {}
+
+    @classmethod
+    def from_dfs(cls, workbook_name, dfs, linked_titles=None, **kwargs):
+        """Create a backend holding a Case Dispatcher workbook and its source spreadsheets.
+
+        Args:
+            workbook_name: Name of the workbook, e.g. 'Case Dispatcher 2.0'.
+            dfs: Dictionary of worksheet dataframes, e.g. from synth_data.read_worksheets.
+            linked_titles: Worksheets which show the contents of a separate spreadsheet of
+            the same name below their header row, as gsheets.upload_sheets expects. All
+            gsheets.SHEET_TITLES in dfs if None.
+            kwargs: Arguments for Fake_Google.
+
+        Returns:
+            A Fake_Google instance.
+        """
+        import gsheets as gs
+        if linked_titles is None:
+            linked_titles = [t for t in gs.SHEET_TITLES if t in dfs]
+        backend = cls(**kwargs)
+        workbook = backend.add_spreadsheet(workbook_name)
+        workbook.sheets = []
+        for title, df in dfs.items():
+            rows = df.astype(str).values.tolist()
+            cols = max(len(df.columns), 26)
+            if title in linked_titles:
+                source = backend.add_spreadsheet(title)
+                source.sheet1.row_count = max(len(rows), 1)
+                source.sheet1.col_count = cols
+                source.sheet1.write(0, 0, rows)
+                ws = Linked_Worksheet(workbook, title, len(workbook.sheets),
+                                      [str(c) for c in df.columns], source)
+            else:
+                ws = Fake_Worksheet(workbook, title, len(workbook.sheets),
+                                    rows=max(len(rows) + 1, 1000), cols=cols)
+                ws.write(0, 0, [[str(c) for c in df.columns]] + rows)
+            workbook.sheets.append(ws)
+        stats = backend.add_spreadsheet('Case Dispatcher Stats', STATS_KEY)
+        stats.sheet1.write(0, 0, [['Last updated', '']])
+        return backend
+
+    def to_dfs(self, workbook_name):
+        """Return the workbook's worksheets as dataframes, as gsheets.get_dfs would."""
+        import gsheets as gs
+        for sh in self.spreadsheets.values():
+            if sh.title == workbook_name:
+                return {ws.title: gs.values_to_df(ws.get_all_values()) for ws in sh.sheets}
+        raise gspread.exceptions.SpreadsheetNotFound(workbook_name)
+
+    def save(self, data_dir):
+        """Write every spreadsheet to a JSON file in data_dir."""
+        os.makedirs(data_dir, exist_ok=True)
+        with self.lock:
+            for sh in self.spreadsheets.values():
+                with open(os.path.join(data_dir, sh.id + '.json'), 'w') as f:
+                    json.dump({'title': sh.title, 'permissions': sh.permissions,
+                               'sheets': [{'title': ws.title, 'rows': ws.row_count,
+                                           'cols': ws.col_count, 'values': ws.values,
+                                           'link': getattr(ws, 'source', None) and
+                                           {'header': ws.header, 'source': ws.source.id}}
+                                          for ws in sh.sheets]}, f)
+
+    @classmethod
+    def load(cls, data_dir, **kwargs):
+        """Create a backend from the JSON files written by save."""
+        backend = cls(**kwargs)
+        links = []
+        for f in sorted(os.listdir(data_dir)):
+            if not f.endswith('.json'):
+                continue
+            with open(os.path.join(data_dir, f)) as fh:
+                data = json.load(fh)
+            sh = Fake_Spreadsheet(backend, f[:-5], data['title'])
+            sh.permissions = data['permissions']
+            for i, s in enumerate(data['sheets']):
+                if s['link']:
+                    ws = Linked_Worksheet(sh, s['title'], i, s['link']['header'], None)
+                    links.append((ws, s['link']['source']))
+                else:
+                    ws = Fake_Worksheet(sh, s['title'], i, s['rows'], s['cols'])
+                    ws.values = s['values']
+                sh.sheets.append(ws)
+            backend.spreadsheets[sh.id] = sh
+        for ws, source in links:
+            ws.source = backend.spreadsheets[source]
+        # Continue numbering after the loaded ids so new spreadsheets don't replace them
+        numbers = [int(k[4:]) for k in backend.spreadsheets if re.match(r'fake\d+$', k)]
+        backend.ids = count(max(numbers, default=0) + 1)
+        return backend
+
@@ -4,18 +4,33 @@ This is a module for working with Google Sheets.
 
 import json
 import logging
-import zipfile
+import os
 import re
 import gspread
-from datetime import date, timedelta
-from gspread_dataframe import set_with_dataframe
+import httplib2
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+from random import random
+from threading import Lock
+from time import monotonic, sleep, time
 
 from oauth2client.client import SignedJwtAssertionCredentials
 from apiclient.discovery import build
+from apiclient.errors import HttpError
+import numpy as np
 import pandas as pd
 
+import api_meter as apm
+import backup_store as bs
+import sheet_schema as sc
+
 
 def get_gs_cred(cred_file):
+    """Return the credentials in a service account key file, loading each file once."""
+    return clients.credentials(cred_file)
+
+
+def load_gs_cred(cred_file):
     json_key = json.load(open(cred_file))
     scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
     credentials = SignedJwtAssertionCredentials(json_key['client_email'],
@@ -24,12 +39,91 @@ def get_gs_cred(cred_file):
     return credentials
 
 
+class Discovery_Cache:
+    """This is a class for keeping API discovery documents on disk between runs, using the
+    get/set cache interface of googleapiclient's build."""
+    def __init__(self, cache_dir='discovery_cache'):
+        self.cache_dir = cache_dir
+
+    def path(self, url):
+        return os.path.join(self.cache_dir, re.sub(r'[^A-Za-z0-9_.-]', '_', url) + '.json')
+
+    def get(self, url):
+        try:
+            with open(self.path(url)) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self, url, content):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.path(url), 'w') as f:
+            f.write(content)
+
+
+class Client_Registry:
+    """This is a class for sharing one authorized gspread client and one Drive service per
+    set of credentials, so that authorization and discovery happen once per process.
+
+    Args:
+        cache_dir: Directory in which discovery documents are cached.
+        refresh_margin: Seconds before its expiry at which an access token is refreshed.
+    """
+    def __init__(self, cache_dir='discovery_cache', refresh_margin=300):
+        self.discovery_cache = Discovery_Cache(cache_dir)
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self.creds = {}
+        self.clients = {}
+        self.drives = {}
+        self.lock = Lock()
+
+    def credentials(self, cred_file):
+        """Return the credentials loaded from cred_file, loading them on first use."""
+        with self.lock:
+            if cred_file not in self.creds:
+                self.creds[cred_file] = load_gs_cred(cred_file)
+            return self.creds[cred_file]
+
+    def expiring(self, credentials):
+        """Return True if the credentials' access token expires within refresh_margin."""
+        expiry = getattr(credentials, 'token_expiry', None)
+        return expiry is not None and expiry - datetime.utcnow() < self.refresh_margin
+
+    def gspread(self, credentials):
+        """Return the gspread client for credentials, authorizing it on first use."""
+        with self.lock:
+            client = self.clients.get(id(credentials))
+            if client is None:
+                client = gspread.authorize(credentials)
+                self.clients[id(credentials)] = client
+            elif self.expiring(credentials):
+                credentials.refresh(httplib2.Http())
+                client.login()
+            return client
+
+    def drive(self, credentials):
+        """Return the Drive v3 service for credentials, building it on first use."""
+        with self.lock:
+            if id(credentials) not in self.drives:
+                self.drives[id(credentials)] = build('drive', 'v3', credentials=credentials,
+                                                     cache=self.discovery_cache)
+            return self.drives[id(credentials)]
+
+
+clients = Client_Registry()
+
+
 def get_auth(credentials):
-    """Authorize credentials for opening individual Google worksheets."""
-    auth = gspread.authorize(credentials)
-    return auth
+    """Return an authorized gspread client for opening individual Google worksheets."""
+    return clients.gspread(credentials)
+
 
+def build_drive(credentials):
+    """Return a Drive v3 service object."""
+    return clients.drive(credentials)
 
+
+@apm.track
 def get_gsheets(workbook_name, auth): #remember to share new sheets with client email
     """Return a list of Google worksheets from the name of a Google Sheet."""
     workbook = auth.open(workbook_name)
@@ -37,17 +131,26 @@ def get_gsheets(workbook_name, auth): #remember to share new sheets with client
     return gsheets
 
 
+def values_to_df(values):
+    """Convert a worksheet's values, with column names in the first row, to a dataframe."""
+    if not values:
+        return pd.DataFrame()
+    # The API leaves out trailing empty cells, so pad short rows as get_all_values does
+    df = pd.DataFrame(values).fillna('')
+    df.columns = df.iloc[0]
+    df.drop(0, inplace=True)
+    return df
+
+
 class GSheet:
     """This is a class for Google Worksheets."""
     def __init__(self, wrksht):
         self.wrksht = wrksht
         self.name = re.findall(r"'(.*?)'", str(wrksht))[0]
-        df = pd.DataFrame(self.wrksht.get_all_values())
-        df.columns = df.iloc[0]
-        df.drop(0, inplace=True)
-        self.df = df
+        self.df = values_to_df(self.wrksht.get_all_values())
 
 
+@apm.track
 def get_dfs(cdws):
     """Completes conversion of Google Sheets to Dataframes."""
     all_sheets = []
@@ -58,47 +161,221 @@ def get_dfs(cdws):
     return dfs
 
 
-def save_backups(dfs):
-    """Saves backup files with existing Google Sheet (Case Dispatcher) data."""
-    today = date.today().strftime("%m-%d-%Y")
-    zip_name = "backups/" + today + "_Backup_Sheets.zip"
-    with zipfile.ZipFile(zip_name, 'w') as csv_zip:
-        for k, v in dfs.items():
-            fname = k + "_" + today + ".csv"
-            csv_zip.writestr(fname, pd.DataFrame(v).to_csv())
-
-
-def upload_sheets(new_gsheets, auth):
-    """Uploads csv files to Google Sheets."""
-    up_sheets = []
-    for sheet in new_gsheets:
-        up_sheet = open(sheet.csv, 'r').read()
-        up_sheets.append(up_sheet)
-
-        vs = auth.open("Victims")
-        cvs = auth.open("Closed_Vic")
-        ss = auth.open("Suspects")
-        css = auth.open("Closed_Sus")
-        ps = auth.open("Police")
-        cps = auth.open("Closed_Pol")
-
-        gs = [vs,
-              cvs,
-              ss,
-              css,
-              ps,
-              cps]
-
-        sheet_dict = {k: v for k, v in zip(gs, up_sheets)}
-        last = len(list(sheet_dict))
-        for i in range(0, last):
-            auth.import_csv(
-                list(
-                    sheet_dict.keys())[i].id,
-                list(
-                    sheet_dict.values())[i].encode('utf-8'))
+class Call_Counter:
+    """This is a class for counting and timing the HTTP requests made by a gspread client.
+
+    Used as a context manager, it adds a response hook to the client's session for the
+    duration of the block.
+    """
+    def __init__(self, auth):
+        self.session = auth.session
+        self.calls = 0
+        self.api_time = 0.0
+        self.start = None
+        self.elapsed = None
+
+    def count(self, response, *args, **kwargs):
+        """Response hook recording one request and its round trip time."""
+        self.calls += 1
+        self.api_time += response.elapsed.total_seconds()
+
+    def __enter__(self):
+        self.session.hooks['response'].append(self.count)
+        self.start = time()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time() - self.start
+        self.session.hooks['response'].remove(self.count)
+
+
+@apm.track
+def get_dfs_batched(workbook_name, auth):
+    """Read every worksheet of a Google Sheet with a single values.batchGet request.
+
+    Args:
+        workbook_name: Name of the Google Sheet, e.g. 'Case Dispatcher 2.0'.
+        auth: An authorized gspread client.
+
+    Returns:
+        A dictionary of dataframes keyed by worksheet name, like get_dfs, and a dictionary
+        with the number of HTTP calls made and the time taken.
+    """
+    with Call_Counter(auth) as counter:
+        workbook = auth.open(workbook_name)
+        titles = [ws.title for ws in workbook.worksheets()]
+        ranges = ["'{0}'".format(t.replace("'", "''")) for t in titles]
+        value_ranges = workbook.values_batch_get(ranges)['valueRanges']
+        dfs = {t: values_to_df(vr.get('values', [])) for t, vr in zip(titles, value_ranges)}
+    stats = {'worksheets': len(dfs), 'calls': counter.calls,
+             'api_time': counter.api_time, 'elapsed': counter.elapsed}
+    print("Read %(worksheets)d worksheets in %(calls)d API calls "
+          "(%(api_time)0.2fs waiting on the API, %(elapsed)0.2fs in total)" % stats)
+    return dfs, stats
+
+
+def save_backups(dfs, store=None):
+    """Saves a backup of existing Google Sheet (Case Dispatcher) data to a Backup_Store,
+    'backups' by default, and prunes backups outside its retention policy."""
+    store = store or bs.Backup_Store()
+    store.save('sheets', dfs)
+    store.prune()
+
+
+# Spreadsheets written by upload_sheets, in the order of Dispatch_Run.save_csvs
+SHEET_TITLES = ['Victims', 'Closed_Vic', 'Suspects', 'Closed_Sus', 'Police', 'Closed_Pol']
+
+
+def read_upload_csv(csv_file, n_cols):
+    """Read a csv written by Dispatch_Run.save_csvs as the strings import_csv would upload."""
+    if os.path.getsize(csv_file) == 0:
+        return np.empty((0, n_cols), dtype=object)
+    return pd.read_csv(csv_file, header=None, dtype=str, keep_default_na=False).to_numpy()
 
 
+def diff_ranges(old, new, title):
+    """Find the cell ranges of a headerless worksheet which differ between old and new values.
+
+    Consecutive changed rows are grouped into one range spanning their changed columns.
+    Rows beyond the end of the old values are appended and rows beyond the end of the
+    new values are blanked.
+
+    Args:
+        old: 2D array of the worksheet's current values as strings.
+        new: 2D array of the values to upload, with the same number of columns.
+        title: Worksheet title used in the A1 ranges.
+
+    Returns:
+        A list of value ranges for values.batchUpdate and a dictionary of counts.
+    """
+    n_old, n_new, n_cols = len(old), len(new), new.shape[1]
+    common = min(n_old, n_new)
+    changed = old[:common] != new[:common]
+    changed_rows = np.flatnonzero(changed.any(axis=1))
+    data = []
+
+    def add_range(r0, r1, c0, c1, values):
+        a1 = '{0}:{1}'.format(gspread.utils.rowcol_to_a1(r0 + 1, c0 + 1),
+                              gspread.utils.rowcol_to_a1(r1 + 1, c1 + 1))
+        data.append({'range': "'{0}'!{1}".format(title.replace("'", "''"), a1),
+                     'values': values})
+
+    if len(changed_rows):
+        for block in np.split(changed_rows, np.flatnonzero(np.diff(changed_rows) != 1) + 1):
+            cols = np.flatnonzero(changed[block].any(axis=0))
+            r0, r1, c0, c1 = block[0], block[-1], cols[0], cols[-1]
+            add_range(r0, r1, c0, c1, new[r0:r1 + 1, c0:c1 + 1].tolist())
+    if n_new > n_old:
+        add_range(n_old, n_new - 1, 0, n_cols - 1, new[n_old:].tolist())
+    elif n_old > n_new:
+        add_range(n_new, n_old - 1, 0, n_cols - 1, [[''] * n_cols] * (n_old - n_new))
+    stats = {'changed_cells': int(changed.sum()),
+             'changed_rows': len(changed_rows),
+             'appended_rows': max(n_new - n_old, 0),
+             'removed_rows': max(n_old - n_new, 0),
+             'ranges': len(data)}
+    return data, stats
+
+
+def upload_sheet_diff(spreadsheet_id, title, sheet, old, auth):
+    """Upload only the cells of a sheet which differ from the values downloaded at the start
+    of the run. The sheet is re-imported in full if its columns no longer match.
+
+    Args:
+        spreadsheet_id: Id of the spreadsheet to write to.
+        title: Name of the spreadsheet, used in messages.
+        sheet: Dataframe returned by Dispatch_Run.save_csvs, with the csv it was written to.
+        old: Dataframe of the sheet's values downloaded by get_dfs_batched.
+        auth: An authorized gspread client.
+    """
+    if old is None or len(old.columns) != len(sheet.columns):
+        auth.import_csv(spreadsheet_id, open(sheet.csv, 'r').read().encode('utf-8'))
+        return "columns changed, re-imported in full"
+    spreadsheet = auth.open_by_key(spreadsheet_id)
+    worksheet = spreadsheet.sheet1
+    new = read_upload_csv(sheet.csv, len(sheet.columns))
+    data, stats = diff_ranges(old.to_numpy(dtype=str), new, worksheet.title)
+    if len(new) > worksheet.row_count:
+        worksheet.resize(rows=len(new))
+    if data:
+        spreadsheet.values_batch_update({'valueInputOption': 'USER_ENTERED', 'data': data})
+    return ("%(changed_cells)d cells changed in %(changed_rows)d rows, %(appended_rows)d rows "
+            "appended, %(removed_rows)d rows removed, %(ranges)d ranges sent" % stats)
+
+
+@apm.track
+def get_spreadsheet_ids(titles, auth, id_cache='sheet_ids.json', refresh=False):
+    """Return a dictionary of spreadsheet ids keyed by title.
+
+    Ids are kept in id_cache between runs. Titles which aren't in the cache, or are to be
+    refreshed, are looked up with a single listing of the account's spreadsheets.
+    """
+    ids = {}
+    if os.path.exists(id_cache):
+        with open(id_cache) as f:
+            ids = json.load(f)
+    if refresh:
+        for t in titles:
+            ids.pop(t, None)
+    missing = [t for t in titles if t not in ids]
+    if missing:
+        for f in auth.list_spreadsheet_files():
+            if f['name'] in missing and f['name'] not in ids:
+                ids[f['name']] = f['id']
+        not_found = [t for t in missing if t not in ids]
+        if not_found:
+            raise Exception('Spreadsheets not found: {0}'.format(', '.join(not_found)))
+        with open(id_cache, 'w') as f:
+            json.dump(ids, f)
+    return {t: ids[t] for t in titles}
+
+
+@apm.track
+def upload_sheets(new_gsheets, auth, dfs=None, max_workers=3, id_cache='sheet_ids.json'):
+    """Uploads csv files to Google Sheets, each spreadsheet once and several at a time.
+
+    Args:
+        new_gsheets: Dataframes returned by Dispatch_Run.save_csvs, in SHEET_TITLES order.
+        auth: An authorized gspread client.
+        dfs: Dictionary of dataframes downloaded at the start of the run. If given only
+        changed cells are uploaded, otherwise each csv is re-imported in full.
+        max_workers: Maximum number of spreadsheets uploaded at the same time.
+        id_cache: File in which spreadsheet ids are kept between runs.
+
+    Returns:
+        A dictionary of upload times in seconds keyed by spreadsheet title.
+    """
+    def upload(title, spreadsheet_id, sheet):
+        t0 = time()
+        if dfs is None:
+            auth.import_csv(spreadsheet_id, open(sheet.csv, 'r').read().encode('utf-8'))
+            result = "re-imported in full"
+        else:
+            result = upload_sheet_diff(spreadsheet_id, title, sheet, dfs.get(title), auth)
+        return time() - t0, result
+
+    sheets = dict(zip(SHEET_TITLES, new_gsheets))
+    ids = get_spreadsheet_ids(list(sheets), auth, id_cache)
+    t0 = time()
+    timings = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {t: apm.submit(executor, upload, t, ids[t], sheet)
+                   for t, sheet in sheets.items()}
+        for title, future in futures.items():
+            try:
+                timings[title], result = future.result()
+            except gspread.exceptions.APIError as e:
+                if e.response.status_code != 404:
+                    raise
+                # The cached id is stale, e.g. the spreadsheet was recreated
+                ids[title] = get_spreadsheet_ids([title], auth, id_cache, refresh=True)[title]
+                timings[title], result = upload(title, ids[title], sheets[title])
+            print("%s: %s in %0.2fs" % (title, result, timings[title]))
+    print("Uploaded %d sheets in %0.2fs" % (len(timings), time() - t0))
+    return timings
+
+
+@apm.track
 def upload_stats_sheet(auth):
     """"""
     today = date.today().strftime("%m/%d/%Y")
@@ -108,76 +385,71 @@ def upload_stats_sheet(auth):
     print("Google Sheet Case Dispatcher updated ", today)
 
 
-def new_relationship_gsheets(sus, x, credentials):
-    """Generate new google sheets for relationship data of top x number of suspects."""
-    high_priority = sus[['Suspect_ID', 'Name', 'Relationships']]
-    high_priority = high_priority.iloc[0:x,:]
-    for index, row in high_priority.iterrows():
-        if row['Relationships'] == "":
-            row['Relationships'] = create_google_spreadsheet(
-                str(row['Suspect_ID']) + "_relationships",
-                sus_name=row['Name'],
-                share_domains=['lovejustice.ngo', 'tinyhands.org'],
-                credentials=credentials)
-        else:
-            continue
+@apm.track
+def new_relationship_gsheets(sus, x, credentials, auth=None, max_workers=8, rate=5):
+    """Generate new google sheets for relationship data of top x number of suspects.
+
+    Sheets are provisioned together by provision_relationship_sheets, so x can be large.
+    Suspects whose sheet couldn't be created keep an empty 'Relationships' cell and are
+    tried again on the next run.
+    """
+    if auth is None:
+        auth = get_auth(credentials)
+    top = sus.iloc[0:x]
+    missing = np.flatnonzero(top['Relationships'].fillna('').eq('').to_numpy())
+    if len(missing) == 0:
+        return sus
+    suspect_ids = top['Suspect_ID'].iloc[missing].map(str).tolist()
+    urls = provision_relationship_sheets(list(zip(suspect_ids, top['Name'].iloc[missing])),
+                                         credentials,
+                                         auth,
+                                         share_domains=['lovejustice.ngo', 'tinyhands.org'],
+                                         max_workers=max_workers,
+                                         bucket=Token_Bucket(rate))
     y = sus.columns.get_loc('Relationships')
-    sus.iloc[0:x, y] = high_priority.iloc[0:x,2]
+    sus.iloc[missing, y] = [urls.get(sid, '') for sid in suspect_ids]
     return sus
 
 logger = logging.getLogger(__name__)
 
+# Requests per Drive batch request, the maximum the API accepts
+DRIVE_BATCH_SIZE = 100
 
-def open_google_spreadsheet(spreadsheet_id: str, credentials):
-    """Open sheet using gspread.
-    :param spreadsheet_id: Grab spreadsheet id from URL to open.
-    Adapted from https://gist.github.com/miohtama/f988a5a83a301dd27469
-    """
-    gc = gspread.authorize(credentials)
-    return gc.open_by_key(spreadsheet_id)
+# Response codes for which a Google API call is retried
+RETRY_CODES = {429, 500, 502, 503, 504}
 
 
-def create_google_spreadsheet(title, sus_name, share_domains, credentials):
-    """Create a new spreadsheet and open gspread object for it.
-    :param title: Spreadsheet title
-    :param share_domains: Example:: ``["lovejustice.ngo"]``.
+class Token_Bucket:
+    """This is a class for limiting the rate of API calls made from several threads.
+
+    Tokens are added at rate per second up to capacity and each call takes one. A
+    request for more tokens than the capacity is let through once the bucket is full
+    and leaves it in debt, so batches are limited to the same average rate.
     """
-    drive_api = build('drive', 'v3', credentials=credentials)
-    logger.info("Creating Sheet %s", title)
-    body = {
-        'name': title,
-        'mimeType': 'application/vnd.google-apps.spreadsheet',
-    }
-    req = drive_api.files().create(body=body)
-    new_sheet = req.execute()
-
-    # Get id of fresh sheet
-    spread_id = new_sheet["id"]
-
-    # Grant permissions
-    if share_domains:
-        for domain in share_domains:
-
-            # https://developers.google.com/drive/v3/web/manage-sharing#roles
-            # https://developers.google.com/drive/v3/reference/permissions#resource-representations
-            domain_permission = {
-                'type': 'domain',
-                'role': 'writer',
-                'domain': domain,
-                # Magic almost undocumented variable which makes files appear in your Google Drive
-                'allowFileDiscovery': True,
-            }
-
-            req = drive_api.permissions().create(
-                fileId=spread_id,
-                body=domain_permission,
-                fields="id"
-            )
-
-            req.execute()
-
-    worksheet = open_google_spreadsheet(spread_id, credentials).sheet1
-    rel_headers = pd.DataFrame(
+    def __init__(self, rate=5, capacity=10):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def acquire(self, tokens=1):
+        """Block until tokens are available and take them."""
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= min(tokens, self.capacity):
+                    self.tokens -= tokens
+                    return
+                wait = (min(tokens, self.capacity) - self.tokens) / self.rate
+            sleep(wait)
+
+
+def relationship_headers(title, sus_name):
+    """Return the first rows of a new relationship sheet as a dataframe."""
+    return pd.DataFrame(
         {"Name": [str(sus_name)],
          "Relationship_Type": [""],
          "Source": [""],
@@ -192,10 +464,172 @@ def create_google_spreadsheet(title, sus_name, share_domains, credentials):
                  "Target_Label",
                  "Case_ID",
                  "Suspect_Case_ID"])
-    set_with_dataframe(worksheet, rel_headers)
 
-    spreadsheet_url = "https://docs.google.com/spreadsheets/d/%s" % spread_id
-    return spreadsheet_url
+
+def domain_permission(domain):
+    """Return a Drive permission giving everyone in a domain write access."""
+    # https://developers.google.com/drive/v3/web/manage-sharing#roles
+    # https://developers.google.com/drive/v3/reference/permissions#resource-representations
+    return {
+        'type': 'domain',
+        'role': 'writer',
+        'domain': domain,
+        # Magic almost undocumented variable which makes files appear in your Google Drive
+        'allowFileDiscovery': True,
+    }
+
+
+def execute_batches(drive_api, requests, bucket, retries=3, base_wait=1, max_wait=32,
+                    retry_codes=RETRY_CODES):
+    """Execute Drive requests in batch requests of up to DRIVE_BATCH_SIZE.
+
+    Requests failing with a rate limit or server error are retried in later batches, with
+    exponential backoff as in with_backoff, up to retries times. Requests which aren't
+    idempotent should only be retried on errors that mean they weren't carried out.
+
+    Args:
+        drive_api: A Drive v3 service object.
+        requests: Dictionary of unexecuted requests keyed by a unique string id.
+        bucket: Token_Bucket which each request in a batch takes a token from.
+        retries: Maximum number of times a failed request is retried.
+        retry_codes: HTTP status codes of the errors which are retried.
+
+    Returns:
+        A dictionary of responses and a dictionary of exceptions, keyed by request id.
+    """
+    responses, errors = {}, {}
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            errors[request_id] = exception
+        else:
+            responses[request_id] = response
+
+    items = list(requests.items())
+    for attempt in range(retries + 1):
+        for i in range(0, len(items), DRIVE_BATCH_SIZE):
+            chunk = items[i:i + DRIVE_BATCH_SIZE]
+            bucket.acquire(len(chunk))
+            batch = drive_api.new_batch_http_request(callback=callback)
+            for request_id, request in chunk:
+                batch.add(request, request_id=request_id)
+            try:
+                batch.execute()
+            except HttpError as e:
+                # The whole batch failed, so each of its requests is retried
+                if e.resp.status not in RETRY_CODES:
+                    raise
+                errors.update({request_id: e for request_id, _ in chunk})
+        items = [(request_id, requests[request_id]) for request_id, e in errors.items()
+                 if getattr(getattr(e, 'resp', None), 'status', None) in retry_codes]
+        if not items or attempt == retries:
+            break
+        for request_id, _ in items:
+            del errors[request_id]
+            apm.record_retry()
+        sleep(min(max_wait, base_wait * 2 ** attempt) * (0.5 + random()))
+    return responses, errors
+
+
+@apm.track
+def provision_relationship_sheets(suspects, credentials, auth, share_domains, max_workers=8,
+                                  bucket=None):
+    """Create and share a relationship sheet for each of a list of suspects.
+
+    The files and their permissions are created with Drive batch requests on one Drive
+    client, then the header rows are written concurrently, all under a shared rate limit.
+    Failed requests are retried, except that files are only created again after a rate
+    limit error, as a server error may come after the file was created. A sheet for which
+    any request still fails is logged, deleted and left out, so its suspect is tried again
+    on the next run. Files whose creation failed otherwise are looked up by name to be
+    deleted too.
+
+    Args:
+        suspects: List of (Suspect_ID, Name) tuples.
+        credentials: Google credentials for the Drive API.
+        auth: An authorized gspread client for writing the header rows.
+        share_domains: Domains given write access to each sheet, e.g. ['lovejustice.ngo'].
+        max_workers: Maximum number of header rows written at the same time.
+        bucket: Token_Bucket shared by all calls. A default Token_Bucket if None.
+
+    Returns:
+        A dictionary of spreadsheet URLs keyed by Suspect_ID for the sheets created, shared
+        with every domain and with their header rows written.
+    """
+    bucket = bucket or Token_Bucket()
+    names = dict(suspects)
+    drive_api = apm.wrap_drive(build_drive(credentials))
+    t0 = time()
+    files, errors = execute_batches(
+        drive_api,
+        {sid: drive_api.files().create(body={'name': sid + "_relationships",
+                                             'mimeType': 'application/vnd.google-apps.spreadsheet'},
+                                       fields='id')
+         for sid in names},
+        bucket, retry_codes={429})
+    ids = {sid: f['id'] for sid, f in files.items()}
+    lost = [sid for sid, e in errors.items()
+            if getattr(getattr(e, 'resp', None), 'status', None) != 429]
+    found, _ = execute_batches(
+        drive_api,
+        {sid: drive_api.files().list(
+            q="name = '{0}_relationships' and trashed = false".format(sid), fields='files(id)')
+         for sid in lost},
+        bucket)
+    _, perm_errors = execute_batches(
+        drive_api,
+        {'{0}|{1}'.format(sid, domain): drive_api.permissions().create(
+            fileId=spread_id, body=domain_permission(domain), fields='id')
+         for sid, spread_id in ids.items() for domain in share_domains},
+        bucket)
+    errors.update(perm_errors)
+    shared = [sid for sid in ids
+              if not any('{0}|{1}'.format(sid, domain) in perm_errors for domain in share_domains)]
+
+    def write_headers(sid):
+        bucket.acquire(2)
+        headers = relationship_headers(sid + "_relationships", names[sid])
+        auth.open_by_key(ids[sid]).values_update(
+            'A1', params={'valueInputOption': 'RAW'},
+            body={'values': [headers.columns.tolist()] + headers.values.tolist()})
+
+    provisioned = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {sid: apm.submit(executor, with_backoff, lambda sid=sid: write_headers(sid))
+                   for sid in shared}
+        for sid, future in futures.items():
+            if future.exception() is not None:
+                errors[sid + '|headers'] = future.exception()
+            else:
+                provisioned[sid] = "https://docs.google.com/spreadsheets/d/%s" % ids[sid]
+    for request_id, e in errors.items():
+        logger.error("Relationship sheet request %s failed: %s", request_id, e)
+    unprovisioned = {ids[sid]: sid for sid in ids if sid not in provisioned}
+    unprovisioned.update((f['id'], sid) for sid, response in found.items()
+                         for f in response['files'])
+    for spread_id, sid in unprovisioned.items():
+        logger.error("Relationship sheet %s of %s was not fully provisioned and is deleted",
+                     spread_id, sid)
+    _, delete_errors = execute_batches(
+        drive_api, {spread_id: drive_api.files().delete(fileId=spread_id)
+                    for spread_id in unprovisioned},
+        bucket)
+    for spread_id, e in delete_errors.items():
+        logger.error("Relationship sheet %s of %s could not be deleted: %s",
+                     spread_id, unprovisioned[spread_id], e)
+    print("Provisioned %d of %d relationship sheets in %0.2fs" % (
+        len(provisioned), len(names), time() - t0))
+    return provisioned
+
+
+@apm.track
+def open_google_spreadsheet(spreadsheet_id: str, credentials):
+    """Open sheet using gspread.
+    :param spreadsheet_id: Grab spreadsheet id from URL to open.
+    Adapted from https://gist.github.com/miohtama/f988a5a83a301dd27469
+    """
+    gc = get_auth(credentials)
+    return gc.open_by_key(spreadsheet_id)
 
 
 def get_edge_direction(row):
@@ -220,12 +654,39 @@ def pre_proc_links(new_link_sheet):
     return new_link_sheet
 
 
-def get_sheets_for_network_db(suspects, auth):
+def with_backoff(fn, retries=5, base_wait=1, max_wait=32):
+    """Call fn, retrying with exponential backoff and jitter on rate limit and server errors.
+
+    Args:
+        fn: Function making one or more gspread calls.
+        retries: Maximum number of retries before the error is raised.
+        base_wait: Seconds to wait before the first retry, doubled for each retry after it.
+        max_wait: Maximum number of seconds to wait before a retry.
+
+    Returns:
+        The return value of fn and the number of retries it took.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return fn(), attempt
+        except gspread.exceptions.APIError as e:
+            if e.response.status_code not in RETRY_CODES or attempt == retries:
+                raise
+            apm.record_retry()
+            sleep(min(max_wait, base_wait * 2 ** attempt) * (0.5 + random()))
+
+
+@apm.track
+def get_sheets_for_network_db(suspects, auth, max_workers=8):
     """Collect and pre-process dictionary of recently updated relationship sheets so they are
-    ready to be added to network database."""
+    ready to be added to network database.
+
+    Sheets are downloaded concurrently by up to max_workers threads and each is
+    pre-processed as soon as it arrives.
+    """
     new_link_sheets = suspects.active[['Relationships', 'Date_Relationships_Updated']]
-    new_link_sheets['Date_Relationships_Updated'] = pd.to_datetime(
-        new_link_sheets['Date_Relationships_Updated'])
+    new_link_sheets['Date_Relationships_Updated'] = sc.readable(
+        new_link_sheets['Date_Relationships_Updated'], 'date')
     yesterday = date.today() - timedelta(days=1)
     yesterday = yesterday.strftime("%m-%d-%Y")
     new_link_sheets = new_link_sheets[
@@ -234,9 +695,19 @@ def get_sheets_for_network_db(suspects, auth):
     new_sheets = new_sheets.reset_index(drop=True)
 
     d = {}
-    if not new_link_sheets.empty:
-        for i in range(len(new_sheets.index)):
-            d[i] = GSheet(auth.open_by_url(new_sheets[i]).sheet1)
-    for i in d:
-        d[i].df = pre_proc_links(d[i].df)
-    return d
+    if new_link_sheets.empty:
+        return d
+    t0 = time()
+    retries = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {apm.submit(executor, with_backoff,
+                              lambda url=url: GSheet(auth.open_by_url(url).sheet1)): i
+                   for i, url in new_sheets.items()}
+        for future in as_completed(futures):
+            sheet, n_retries = future.result()
+            sheet.df = pre_proc_links(sheet.df)
+            d[futures[future]] = sheet
+            retries += n_retries
+    print("Fetched %d relationship sheets in %0.2fs with %d retries" % (
+        len(d), time() - t0, retries))
+    return {i: d[i] for i in sorted(d)}
@@ -504,6 +504,9 @@ def index_multi_match(df, match_col1, match_col2, index):
     group['combID'] = group['match'].astype(str) + "-case_id-" + group['idx1'].astype(str)
     group = group.drop_duplicates(subset=['idx1', 'idx2'])
     group['count'] = 1
+    if group.empty:
+        # Nothing to group, e.g. in a new database without any relationships yet
+        return pd.DataFrame(columns=['combID', 'count', 'idx2', 'match'])
     group2 = group
     group = group.groupby('combID').apply(lambda x: pd.Series(dict(count=x['count'].sum(),
                                                            idx2=', '.join(x.astype(str)['idx2']))))
@@ -1,6 +1,8 @@
 import pandas as pd
 import numpy as np
 from datetime import date
+import case_ids as ci
+import sheet_schema as sc
 
 
 def sum_and_join(x):
@@ -17,7 +19,7 @@ def get_vics_willing_to_testify(victims):
     vics_willing = vics_willing.dropna(axis=0, subset=['willing_to_testify'])
     vics_willing['count'] = 1
     if len(vics_willing) > 0:
-        vics_willing = vics_willing.groupby('Case_ID').apply(sum_and_join)
+        vics_willing = vics_willing.groupby('Case_ID', observed=True).apply(sum_and_join)
     return vics_willing
 
 
@@ -33,7 +35,6 @@ def calc_vics_willing_scores(sus, vics_willing, Parameters):
     """Calculate scores for number of victims willing to testify and add them to suspect sheet."""
     sus = pd.merge(sus, vics_willing, how='left',on='Case_ID')
     v_multiplier = pd.DataFrame(Parameters.iloc[:10, 6:8])
-    v_multiplier.Victims_Willing_to_Testify = v_multiplier.Victims_Willing_to_Testify.astype(int)
     sus['count'] = sus['count'].fillna(0).astype(int)
     sus = pd.merge(sus,
                    v_multiplier,
@@ -42,7 +43,6 @@ def calc_vics_willing_scores(sus, vics_willing, Parameters):
                       'willing_to_testify',
                       'count'], inplace=True)
     sus['V_Multiplier'].fillna(0, inplace=True)
-    sus['V_Multiplier'] = sus['V_Multiplier'].astype('float')
     return sus
 
 
@@ -50,9 +50,7 @@ def calc_arrest_scores(sus, arrests, pol):
     """Calculate scores for the number of other suspects arrested in each case and create fields \
     for 'bio known' and for police willing to arrest."""
     sus['Bio_Known'] = np.where(sus['Bio_and_Location'].eq(''), 0, 1)
-    sus = pd.merge(sus, arrests[['Case_ID', 'Total_Arrests']], how='left', on='Case_ID')
-    sus['Total_Arrests'] = sus['Total_Arrests'].fillna(0).astype(int)
-    sus.rename(columns={'Total_Arrests': 'Others_Arrested'}, inplace=True)
+    sus['Others_Arrested'] = arrests.total_arrests(sus['Case_ID'])
     pol['Willing_to_Arrest'] = np.where(
         pol.Case_Status.str.contains("Step Complete", na=False), 1, 0)
     sus = pd.merge(sus, pol[['Case_ID', 'Willing_to_Arrest']], how='left', on='Case_ID')
@@ -61,11 +59,12 @@ def calc_arrest_scores(sus, arrests, pol):
 
 def calc_recency_scores(sus, db_cif):
     """Assign score to each case that is higher the more recent it is."""
-    today = date.today()
-    today.strftime("%m/%d/%Y")
+    today = pd.Timestamp(date.today())
     cif_dates = db_cif[['cif_number', 'interview_date']]
-    cif_dates['Days_Old'] = (today - cif_dates.loc[:, 'interview_date']) / np.timedelta64(1, 'D')
-    cif_dates['Case_ID'] = cif_dates['cif_number'].str[:-1].replace('.', '')
+    cif_dates['Days_Old'] = (today - pd.to_datetime(cif_dates.loc[:, 'interview_date'])) / \
+        np.timedelta64(1, 'D')
+    cif_dates['Case_ID'] = ci.encode_like(ci.case_ids(cif_dates['cif_number']), sus['Case_ID'])
+    cif_dates = cif_dates.dropna(subset=['Case_ID'])
     sus = pd.merge(sus, cif_dates[['Case_ID', 'Days_Old']], how='left', on='Case_ID')
     sus['Recency_Score'] = np.where(sus['Days_Old'] < 100, 1 - sus.Days_Old * .01, 0)
     sus = sus.drop_duplicates(subset='Suspect_ID')
@@ -83,18 +82,15 @@ def get_new_soc_score(sus, soc_df):
 
 def get_eminence_score(sus):
     """Get eminence score from active sheet, if blank enter '1'."""
-    sus['Em2'] = sus['Eminence'].fillna(1)
-    sus.loc[sus['Eminence'].str.len() < 1, 'Em2'] = 1
-    sus['Em2'] = sus['Em2'].astype(int)
+    sus['Em2'] = sc.readable(sus['Eminence'], 'int').fillna(1).astype(int)
     return sus
 
 
 def calculate_weights(Parameters):
     """Get current weights from Parameters Google Sheet."""
-    weights_vs = pd.Series(Parameters.iloc[0:7, 1]).replace('', 0).append(
-        pd.Series(Parameters.iloc[0:3, 5])).astype(float)
-    weights_keys = pd.Series(Parameters.iloc[0:7, 0]).append(
-        pd.Series(Parameters.iloc[0:3, 4]))
+    weights_vs = pd.concat([sc.readable(Parameters.iloc[0:7, 1], 'float').fillna(0),
+                            sc.readable(Parameters.iloc[0:3, 5], 'float')])
+    weights_keys = pd.concat([Parameters.iloc[0:7, 0], Parameters.iloc[0:3, 4]])
     weights = {k: v for k, v in zip(weights_keys, weights_vs)}
     return weights
 
@@ -120,7 +116,7 @@ def calc_priority(sus, weights, Suspects):
     ).round(decimals=3)
     sus['Priority'] = sus['Priority'].fillna(0)
     sus['Priority'].astype(float)
-    sus.sort_values('Priority', ascending=False, inplace=True)
+    sus.sort_values('Priority', ascending=False, inplace=True, kind='mergesort')
     sus = sus.iloc[:, 0:len(Suspects.columns)].fillna('')
     sus = sus.drop_duplicates(subset='Suspect_ID')
     return sus
@@ -144,6 +140,7 @@ def add_priority_to_others(sus, other_entity_group, id_type, entity_gsheet, uid)
     other_entity_group = pd.merge(other_entity_group, sus[[id_type, 'Priority']])
     other_entity_group['Priority'].astype(float)
     other_entity_group.drop_duplicates(subset=uid, inplace=True)
-    other_entity_group.sort_values('Priority', ascending=False, inplace=True)
+    other_entity_group.sort_values('Priority', ascending=False, inplace=True,
+                                   kind='mergesort')
     other_entity_group = other_entity_group.iloc[:, 0:len(entity_gsheet.columns)].fillna('')
     return other_entity_group
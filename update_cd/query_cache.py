@@ -0,0 +1,202 @@
+'''
+This is a module for caching query results on disk so that repeated runs of the Case
+Dispatcher don't re-run the same heavy queries while the source tables are unchanged.
+'''
+
+import hashlib
+import json
+import os
+import re
+from copy import copy
+from threading import Lock
+from time import time
+import pandas as pd
+
+TABLE_PATTERN = re.compile(r'\b(?:from|join)\s+([a-z_][\w.]*)', re.IGNORECASE)
+
+
+def normalize_query(select_query):
+    """Collapse whitespace and drop a trailing semicolon so equivalent queries share a key."""
+    return re.sub(r'\s+', ' ', select_query).strip().rstrip(';').strip()
+
+
+def get_source_tables(select_query):
+    """Return the tables a query selects from, without schema prefixes."""
+    tables = [t.split('.')[-1].lower() for t in TABLE_PATTERN.findall(select_query)]
+    return sorted(set(tables))
+
+
+class Query_Cache:
+    """This is a class which wraps a DB_Conn or DB_Pool and caches query results on disk.
+
+    Results are stored as Parquet files keyed by the normalized query text. Before a
+    cached result is used, the row count and latest update time of each source table
+    are compared with those recorded when the result was stored, which costs a single
+    small query.
+    """
+    def __init__(self, dbc, cache_dir='query_cache', ttl=24 * 60 * 60, max_bytes=512 * 2**20,
+                 freshness_col='date_time_last_updated'):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.dbc = dbc
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.freshness_col = freshness_col
+        self.index_file = os.path.join(cache_dir, 'index.json')
+        self.index = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+        self.table_cols = {}
+        self.stats = {'hits': 0, 'misses': 0, 'stale': 0, 'expired': 0, 'evictions': 0}
+        self.lock = Lock()
+
+    def bind(self, dbc):
+        """Return a cache sharing this cache's index and statistics but using another
+        connection, e.g. one checked out of a DB_Pool."""
+        bound = copy(self)
+        bound.dbc = dbc
+        return bound
+
+    def get_fingerprint(self, tables):
+        """Return the row count and latest update time of each table as a list."""
+        if not tables:
+            return []
+        missing = [t for t in tables if t not in self.table_cols]
+        if missing:
+            self.table_cols.update(self.dbc.get_table_columns(missing))
+        selects = []
+        for t in tables:
+            latest = 'CAST(max({0}) AS TEXT)'.format(self.freshness_col) \
+                if self.freshness_col in self.table_cols[t] else 'NULL'
+            selects.append("SELECT '{0}', count(*), {1} FROM public.{0}".format(t, latest))
+        fingerprint = self.dbc.ex_query(' UNION ALL '.join(selects))
+        return [[str(v) for v in row] for row in fingerprint.itertuples(index=False)]
+
+    def get_key(self, select_query, params):
+        """Return the cache key for a query and its parameters."""
+        key_text = normalize_query(select_query) + '\n' + repr(params)
+        return hashlib.sha1(key_text.encode('utf-8')).hexdigest()
+
+    def lookup(self, key, fingerprint):
+        """Return the cached dataframe for a key if it is still fresh, otherwise None."""
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            if time() - entry['created'] > self.ttl:
+                self.stats['expired'] += 1
+                self.remove(key)
+                return None
+            if entry['fingerprint'] != fingerprint:
+                self.stats['stale'] += 1
+                self.remove(key)
+                return None
+            entry['last_used'] = time()
+        path = os.path.join(self.cache_dir, entry['file'])
+        try:
+            if entry['file'].endswith('.parquet'):
+                df = pd.read_parquet(path)
+            else:
+                df = pd.read_pickle(path)
+        except FileNotFoundError:
+            # Evicted by another thread's store since the lock was released
+            with self.lock:
+                self.stats['misses'] += 1
+            return None
+        with self.lock:
+            self.stats['hits'] += 1
+        df.columns = entry['columns']
+        return df
+
+    def store(self, key, select_query, df, fingerprint):
+        """Write a query result to the cache and evict old entries if it is too large."""
+        stored = df.copy(deep=False)
+        stored.columns = [str(i) for i in range(len(df.columns))]
+        file_name = key + '.parquet'
+        try:
+            stored.to_parquet(os.path.join(self.cache_dir, file_name), index=False)
+        except (ImportError, ValueError, TypeError):
+            # No parquet engine, or columns of mixed Python objects which Arrow can't convert
+            file_name = key + '.pkl'
+            stored.to_pickle(os.path.join(self.cache_dir, file_name))
+        with self.lock:
+            self.index[key] = {'query': normalize_query(select_query),
+                               'file': file_name,
+                               'columns': [str(c) for c in df.columns],
+                               'fingerprint': fingerprint,
+                               'bytes': os.path.getsize(os.path.join(self.cache_dir, file_name)),
+                               'created': time(),
+                               'last_used': time()}
+            self.evict()
+
+    def remove(self, key):
+        """Delete a cache entry and its file. Must be called holding the lock."""
+        entry = self.index.pop(key)
+        path = os.path.join(self.cache_dir, entry['file'])
+        if os.path.exists(path):
+            os.remove(path)
+
+    def evict(self):
+        """Remove expired entries, then least recently used entries until the cache fits
+        within max_bytes. Must be called holding the lock."""
+        now = time()
+        for key in [k for k, e in self.index.items() if now - e['created'] > self.ttl]:
+            self.remove(key)
+            self.stats['evictions'] += 1
+        by_last_used = sorted(self.index, key=lambda k: self.index[k]['last_used'])
+        while by_last_used and sum(e['bytes'] for e in self.index.values()) > self.max_bytes:
+            self.remove(by_last_used.pop(0))
+            self.stats['evictions'] += 1
+        with open(self.index_file, 'w') as f:
+            json.dump(self.index, f)
+
+    def cached(self, method, select_query, params=None):
+        """Return the result of a DB_Conn method from the cache, running it on a miss."""
+        key = self.get_key(select_query, params)
+        fingerprint = self.get_fingerprint(get_source_tables(select_query))
+        df = self.lookup(key, fingerprint)
+        if df is None:
+            df = getattr(self.dbc, method)(select_query, params)
+            self.store(key, select_query, df, fingerprint)
+        return df
+
+    def ex_query(self, select_query, params=None):
+        """Execute query, or reuse its cached result, and return dataframe."""
+        return self.cached('ex_query', select_query, params)
+
+    def ex_query_streamed(self, select_query, params=None):
+        """Execute query in chunks, or reuse its cached result, and return dataframe."""
+        return self.cached('ex_query_streamed', select_query, params)
+
+    def copy_query(self, select_query, params=None):
+        """Extract query results with COPY, or reuse the cached result, and return dataframe."""
+        return self.cached('copy_query', select_query, params)
+
+    def get_table_columns(self, tables, schema='public'):
+        """Return a dictionary of column name lists, in table order, for each table."""
+        return self.dbc.get_table_columns(tables, schema)
+
+    def ex_concurrent(self, tasks):
+        """Run tasks concurrently on a DB_Pool, each with the cache bound to its connection.
+        Tasks are run one after another if the wrapped connection is a single DB_Conn."""
+        if not hasattr(self.dbc, 'ex_concurrent'):
+            return {name: task(self) for name, task in tasks.items()}
+        return self.dbc.ex_concurrent(
+            {name: lambda dbc, task=task: task(self.bind(dbc)) for name, task in tasks.items()})
+
+    def report(self):
+        """Print and return the cache's hit/miss statistics."""
+        with self.lock:
+            stats = dict(self.stats,
+                         entries=len(self.index),
+                         bytes=sum(e['bytes'] for e in self.index.values()))
+        print("Query cache: %(hits)d hits, %(misses)d misses, %(stale)d stale, "
+              "%(expired)d expired, %(evictions)d evictions, %(entries)d entries "
+              "(%(bytes)d bytes)" % stats)
+        return stats
+
+    def close_conn(self):
+        """Close the wrapped connection(s)."""
+        self.dbc.close_conn()
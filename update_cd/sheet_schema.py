@@ -0,0 +1,138 @@
+'''
+This is a module for parsing the Case Dispatcher worksheets into typed columns once, when
+they are downloaded, and formatting typed columns back to the strings shown in the sheets
+when they are written.
+'''
+
+import re
+import numpy as np
+import pandas as pd
+
+# Format of the dates entered in and written to the sheets
+DATE_FORMAT = '%m/%d/%Y'
+
+ENTITY_SCHEMA = {'Date_Closed': 'date'}
+SUSPECT_SCHEMA = dict(ENTITY_SCHEMA, **{
+    'Eminence': 'int',
+    'Strength_of_Case': 'float',
+    'Solvability': 'float',
+    'Priority': 'float',
+    'Date_Relationships_Updated': 'date'})
+
+# Column types by worksheet title. Keys are column names, regular expressions matching
+# repeated column groups, or positions for columns only ever read by position. Types are
+# 'int', 'float', 'date' and 'category'; columns not listed stay as strings. Ints with
+# blanks are kept as floats with NaN, as read_csv does.
+SCHEMAS = {
+    'Arrests': {
+        'Outcome (Arrest)': 'int',
+        r'PB\d+ Arrested': 'category',
+        r'PB\d+ Arrest Date': 'date'},
+    'Parameters': {
+        1: 'float',
+        5: 'float',
+        'Victims_Willing_to_Testify': 'int',
+        'V_Multiplier': 'float'},
+    'Suspects': SUSPECT_SCHEMA,
+    'Closed_Sus': SUSPECT_SCHEMA,
+    'Victims': ENTITY_SCHEMA,
+    'Closed_Vic': ENTITY_SCHEMA,
+    'Police': ENTITY_SCHEMA,
+    'Closed_Pol': ENTITY_SCHEMA,
+}
+
+
+def column_types(title, columns):
+    """Return the types of the columns of a worksheet in its schema, keyed by position."""
+    types = {}
+    for key, col_type in SCHEMAS.get(title, {}).items():
+        if isinstance(key, int):
+            if key < len(columns):
+                types[key] = col_type
+            continue
+        for i, col in enumerate(columns):
+            if col == key or re.fullmatch(key, str(col)):
+                types[i] = col_type
+    return types
+
+
+def parse_dates(values):
+    """Parse sheet dates, trying DATE_FORMAT before inferring the format of the rest."""
+    values = values.replace('', None)
+    dates = pd.to_datetime(values, format=DATE_FORMAT, errors='coerce')
+    retry = dates.isna() & values.notna()
+    if retry.any():
+        dates[retry] = pd.to_datetime(values[retry], errors='coerce')
+    return dates
+
+
+def parse_column(values, col_type):
+    """Convert a column of strings to col_type, with blanks and unparseable values missing.
+    parse_sheet puts the strings of unparseable values back."""
+    if col_type == 'date':
+        return parse_dates(values)
+    if col_type == 'category':
+        return values.astype('category')
+    numbers = pd.to_numeric(values.replace('', None), errors='coerce')
+    if col_type == 'int' and numbers.notna().all():
+        return numbers.astype(np.int64)
+    return numbers.astype(float)
+
+
+def parse_sheet(title, df):
+    """Return a copy of a worksheet dataframe with the columns in its schema typed.
+
+    Values which can't be read as their column's type are kept as the strings entered in the
+    sheet, leaving the column as objects, so they are written back unchanged.
+    """
+    typed = df.copy()
+    for i, col_type in column_types(title, df.columns).items():
+        values = df.iloc[:, i]
+        parsed = parse_column(values, col_type)
+        lost = parsed.isna() & values.ne('') & values.notna()
+        if lost.any():
+            print("%s: %d values in column %s could not be read as %s" % (
+                title, lost.sum(), df.columns[i], col_type))
+            parsed = parsed.astype(object).where(~lost, values)
+        typed.isetitem(i, parsed)
+    return typed
+
+
+def parse_sheets(dfs):
+    """Return a dictionary of worksheet dataframes, e.g. from gsheets.get_dfs, typed."""
+    return {title: parse_sheet(title, df) for title, df in dfs.items()}
+
+
+def readable(values, col_type):
+    """Return the values of a typed column with any kept as unreadable strings missing."""
+    if col_type == 'date':
+        return pd.to_datetime(values, errors='coerce')
+    return pd.to_numeric(values, errors='coerce')
+
+
+def format_value(value, col_type):
+    """Format a value of a typed column as it is written in the sheet."""
+    if value is None or value is pd.NaT or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    if isinstance(value, str):
+        return value
+    if col_type == 'date':
+        return pd.Timestamp(value).strftime(DATE_FORMAT)
+    if col_type == 'int' or (col_type == 'float' and float(value).is_integer()):
+        # As the sheets show whole numbers
+        return str(int(value))
+    return str(value)
+
+
+def format_column(values, col_type):
+    """Return a typed column as the strings shown in the sheet."""
+    return values.astype(object).map(lambda value: format_value(value, col_type))
+
+
+def format_sheet(title, df):
+    """Return a copy of a dataframe to be written to a worksheet with the columns in the
+    worksheet's schema formatted as strings."""
+    formatted = df.copy()
+    for i, col_type in column_types(title, df.columns).items():
+        formatted.isetitem(i, format_column(df.iloc[:, i], col_type))
+    return formatted
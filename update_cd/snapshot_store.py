@@ -0,0 +1,203 @@
+'''
+This is a module for keeping local snapshots of Searchlight query results which are
+updated incrementally using a watermark for each source table.
+'''
+
+import json
+import os
+from datetime import datetime
+from functools import partial
+from threading import Lock
+import pandas as pd
+from pandas.api.types import union_categoricals
+import db_connect as dc
+
+
+def changed_since(table, alias=None, col='date_time_last_updated'):
+    """Return the condition selecting rows of a table updated since its last watermark."""
+    col = col if alias is None else alias + '.' + col
+    return "({0} > %({1}_since)s AND {0} <= %({1}_until)s)".format(col, table)
+
+
+# Queries returning the current maximum last-updated time of each source table
+WATERMARKS = {
+    'cif': "SELECT max(date_time_last_updated) FROM public.dataentry_cifnepal",
+    'pb': "SELECT max(date_time_last_updated) FROM public.dataentry_personboxnepal",
+    'person': "SELECT max(date_time_last_updated) FROM public.dataentry_person",
+}
+
+# Each snapshot's query has a '{changed}' placeholder for the condition selecting rows
+# updated since the last run. Rows in the snapshot sharing a key with a changed row are
+# replaced, so the key should identify the form the rows were entered on and the condition
+# should select every row of a form if any table the query joins changed for it. Each
+# table joined is watermarked separately, as editing a person or Person Box doesn't
+# update the CIF they belong to.
+CD_SNAPSHOTS = {
+    'cif': {
+        'query': "SELECT * FROM dataentry_cifnepal as CIF inner join \
+    dataentry_personboxnepal as PB on CIF.id = PB.cif_id WHERE {changed}",
+        'key': 'cif_id',
+        'changed': changed_since('cif', 'CIF') + " OR CIF.id IN (SELECT cif_id FROM \
+    public.dataentry_personboxnepal WHERE " + changed_since('pb') + ")",
+        'watermark': {t: WATERMARKS[t] for t in ('cif', 'pb')},
+        'method': 'ex_query_streamed'},
+    'vics': {
+        'query': "SELECT * FROM public.dataentry_person as p inner join \
+    dataentry_cifnepal as CIF on p.id = CIF.main_pv_id WHERE {changed}",
+        'key': 'cif_number',
+        'changed': changed_since('cif', 'CIF') + " OR " + changed_since('person', 'p'),
+        'watermark': {t: WATERMARKS[t] for t in ('cif', 'person')},
+        'method': 'copy_query'},
+    'sus': {
+        'query': "SELECT * FROM public.dataentry_personboxnepal as pb inner join \
+    public.dataentry_person as p on pb.person_id = p.id WHERE {changed}",
+        'key': 'cif_id',
+        'changed': "pb.cif_id IN (SELECT id FROM public.dataentry_cifnepal WHERE "
+                   + changed_since('cif') + ") OR pb.cif_id IN (SELECT PB2.cif_id FROM \
+    public.dataentry_personboxnepal as PB2 inner join public.dataentry_person as P2 on \
+    PB2.person_id = P2.id WHERE " + changed_since('pb', 'PB2') + " OR "
+                   + changed_since('person', 'P2') + ")",
+        'watermark': {t: WATERMARKS[t] for t in ('cif', 'pb', 'person')},
+        'method': 'copy_query'},
+    'add': {
+        'query': "SELECT * FROM public.dataentry_address1 as ad1 inner join \
+    public.dataentry_address2 as ad2 on ad1.id = ad2.address1_id",
+        'method': 'copy_query'},
+}
+
+
+def merge_snapshot(snapshot, delta, max_cat_ratio=None):
+    """Append changed rows to the rows kept from a snapshot.
+
+    Concatenating categories with different categories gives object columns, so columns
+    which are categories on either side are combined with the union of their categories.
+    If the columns of the two don't match, the result is compacted again instead.
+    """
+    merged = pd.concat([snapshot, delta], ignore_index=True, sort=False)
+    if not snapshot.columns.equals(delta.columns):
+        return dc.compact_dtypes(merged, max_cat_ratio)
+    for i in range(len(merged.columns)):
+        old, new = snapshot.iloc[:, i], delta.iloc[:, i]
+        if any(isinstance(col.dtype, pd.CategoricalDtype) for col in (old, new)):
+            merged.isetitem(i, pd.Series(union_categoricals(
+                [old.astype('category'), new.astype('category')], ignore_order=True)))
+    return merged
+
+
+class Snapshot_Store:
+    """This is a class for storing query results locally and merging in changed rows."""
+    def __init__(self, store_dir='snapshots'):
+        os.makedirs(store_dir, exist_ok=True)
+        self.store_dir = store_dir
+        self.wm_file = os.path.join(store_dir, 'watermarks.json')
+        self.watermarks = {}
+        self.queries = {}
+        self.lock = Lock()
+        if os.path.exists(self.wm_file):
+            with open(self.wm_file) as f:
+                for k, v in json.load(f).items():
+                    # Snapshots watermarked on the CIF table alone are reloaded in full
+                    if not isinstance(v['watermark'], dict):
+                        continue
+                    self.watermarks[k] = {t: datetime.fromisoformat(w)
+                                          for t, w in v['watermark'].items()}
+                    self.queries[k] = v['query']
+
+    def snapshot_path(self, name):
+        """Return the file path of a snapshot."""
+        return os.path.join(self.store_dir, name + '.pkl')
+
+    def load(self, name, query):
+        """Return the stored snapshot, or None if there isn't one for this query yet."""
+        if os.path.exists(self.snapshot_path(name)) and name in self.watermarks \
+                and self.queries.get(name) == query:
+            return pd.read_pickle(self.snapshot_path(name))
+        return None
+
+    def save(self, name, df, watermark, query):
+        """Write snapshot to disk and record the query and the watermark of each source
+        table it is current up to."""
+        df.to_pickle(self.snapshot_path(name))
+        if watermark is not None:
+            with self.lock:
+                self.watermarks[name] = watermark
+                self.queries[name] = query
+                with open(self.wm_file, 'w') as f:
+                    json.dump({k: {'watermark': {t: w.isoformat() for t, w in v.items()},
+                                   'query': self.queries[k]}
+                               for k, v in self.watermarks.items()}, f)
+
+    def reset(self, name):
+        """Forget the watermark for a snapshot so that the next update reloads it in full,
+        e.g. after rows have been deleted from the source tables."""
+        self.watermarks.pop(name, None)
+
+    def update(self, dbc, name, query, key=None, changed=None, watermark=None,
+               method='ex_query'):
+        """Pull rows changed since the last update, merge them into the snapshot and return it.
+
+        Args:
+            dbc: An open DB_Conn.
+            name: Name under which the snapshot is stored.
+            query: Select query with a '{changed}' placeholder for the change condition. A
+            stored snapshot made with a different query is replaced in full.
+            key: Column identifying the rows to replace when any of them change.
+            changed: Condition on %(<table>_since)s and %(<table>_until)s for each table in
+            watermark selecting changed rows. If None the whole query result replaces the
+            snapshot on every update.
+            watermark: Dictionary of queries returning the current maximum last-updated time
+            of each source table, keyed by the table name used in changed.
+            method: Name of the DB_Conn method used to run the query.
+
+        Returns:
+            A dataframe with the full, updated query result.
+        """
+        fetch = getattr(dbc, method)
+        if changed is None:
+            df = fetch(query)
+            self.save(name, df, None, query)
+            return df
+        until = {}
+        for table, wm_query in watermark.items():
+            latest = dbc.ex_query(wm_query).iloc[0, 0]
+            # SQLite stand-ins return timestamps as text
+            until[table] = datetime.min if pd.isna(latest) \
+                else pd.Timestamp(latest).to_pydatetime()
+        snapshot = self.load(name, query)
+        since = {table: datetime.min.replace(tzinfo=t.tzinfo) for table, t in until.items()}
+        if snapshot is not None:
+            since.update((t, w) for t, w in self.watermarks[name].items() if t in since)
+        if snapshot is not None and all(until[t] <= since[t] for t in until):
+            print("Snapshot %s is up to date" % name)
+            return snapshot
+        params = {}
+        for table in until:
+            params[table + '_since'] = since[table]
+            params[table + '_until'] = until[table]
+        delta = fetch(query.format(changed=changed), params)
+        print("Snapshot %s: %d changed rows since %s" % (name, len(delta), min(since.values())))
+        if snapshot is not None:
+            snapshot = snapshot[~snapshot[key].isin(delta[key].unique())]
+            delta = merge_snapshot(snapshot, delta, getattr(dbc, 'max_cat_ratio', None))
+        self.save(name, delta, until, query)
+        return delta
+
+    def update_all(self, dbc, snapshots=CD_SNAPSHOTS, queries=None):
+        """Update each snapshot in a dictionary of snapshot definitions.
+
+        If dbc is a DB_Pool the snapshots are updated concurrently on separate connections.
+
+        Args:
+            dbc: An open DB_Conn or DB_Pool.
+            snapshots: Dictionary of keyword arguments to 'update' keyed by snapshot name.
+            queries: Optional dictionary of queries, e.g. from col_manifest.get_queries,
+            replacing the queries in the snapshot definitions.
+        """
+        tasks = {}
+        for name, snap in snapshots.items():
+            if queries is not None and name in queries:
+                snap = dict(snap, query=queries[name])
+            tasks[name] = partial(self.update, name=name, **snap)
+        if hasattr(dbc, 'ex_concurrent'):
+            return dbc.ex_concurrent(tasks)
+        return {name: task(dbc) for name, task in tasks.items()}
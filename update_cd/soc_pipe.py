@@ -14,16 +14,18 @@ from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.model_selection import train_test_split
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.model_selection import GridSearchCV
+import case_ids as ci
 
 
 def pre_proc(soc_df):
     """Takes data from DB and removes columns that won't be used."""
-    dfcols = list(soc_df.columns)
-    dfcols[16] = 'pv_occupation'
-    soc_df.columns = dfcols
+    if 'pv_occupation' not in soc_df.columns:
+        # Unprojected queries return the CIF's occupation column under its own name
+        dfcols = list(soc_df.columns)
+        dfcols[16] = 'pv_occupation'
+        soc_df.columns = dfcols
     soc_df['pb_number'] = soc_df['pb_number'].fillna(0).astype(int)
-    soc_df['suspect_id'] = soc_df['cif_number'].str.replace('.', '')
-    soc_df['suspect_id'] = soc_df['suspect_id'].str[:-1] + ".PB" + soc_df['pb_number'].map(str)
+    soc_df['suspect_id'] = ci.get_ids(soc_df['cif_number'], soc_df['pb_number'])['Suspect_ID']
     soc_df = soc_df.drop_duplicates(subset='suspect_id')
 
     #Remove columns that won't be used
@@ -67,7 +69,7 @@ def pre_proc(soc_df):
     for x in soc_df.columns:
         if "contact" in x[:] or "_lb" in x[:] or "guardian" in x[:]:
             drop_cols.append(x)
-    soc_df = soc_df.drop(columns=drop_cols)
+    soc_df = soc_df.drop(columns=drop_cols, errors='ignore')
     return soc_df
 
 
@@ -128,10 +130,24 @@ def organize_dtypes(soc_df):
         set(num_features) -
         set(cat_features) -
         set(['suspect_id', 'interview_date']))
+    for f in boolean_features:
+        # Give the nullable and categorical columns from db_connect the same truth values
+        # as the Python objects they replace (None is False, a missing number is True).
+        if isinstance(soc_df[f].dtype, pd.CategoricalDtype):
+            soc_df[f] = soc_df[f].astype(object)
+        elif isinstance(soc_df[f].dtype, pd.BooleanDtype):
+            soc_df[f] = soc_df[f].fillna(False)
+        elif pd.api.types.is_extension_array_dtype(soc_df[f]) and \
+                pd.api.types.is_numeric_dtype(soc_df[f]):
+            soc_df[f] = soc_df[f].astype(float)
     soc_df[boolean_features] = soc_df[boolean_features].astype(bool)
     soc_df[num_features] = soc_df[num_features].fillna(0).astype(float)
 
     for f in cat_features:
+        if pd.api.types.is_extension_array_dtype(soc_df[f]) and \
+                pd.api.types.is_numeric_dtype(soc_df[f]):
+            # Keep the float category names (e.g. 'station_id_3.0') the model was trained on
+            soc_df[f] = soc_df[f].astype(float)
         soc_df[f] = soc_df[f].astype("category")
 
     for cf in cat_features:
@@ -192,9 +208,8 @@ def build_transformer():
 
 def remove_recent(df, cutoff_days):
     """Eliminates cases more recent than the cutoff date."""
-    today = date.today()
-    today.strftime("%m/%d/%Y")
-    df['Days'] = (today - df.loc[:, 'interview_date']) / np.timedelta64(1, 'D')
+    today = pd.Timestamp(date.today())
+    df['Days'] = (today - pd.to_datetime(df.loc[:, 'interview_date'])) / np.timedelta64(1, 'D')
     sub_df = df[(df['Days'] > cutoff_days) | (df['Arrest'] == True)]
     return sub_df
 
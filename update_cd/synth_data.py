@@ -0,0 +1,378 @@
+'''
+This is a module for generating synthetic Searchlight tables and Case Dispatcher worksheets
+at a configurable scale, so that the Case Dispatcher can be run and benchmarked offline.
+'''
+
+import os
+import pickle
+import sqlite3
+from io import StringIO
+from datetime import date, datetime
+import numpy as np
+import pandas as pd
+import case_ids as ci
+import col_manifest as cm
+
+FIRST_NAMES = ['Sita', 'Gita', 'Ram', 'Hari', 'Maya', 'Anita', 'Bikash', 'Sunita', 'Raju',
+               'Kamala', 'Prakash', 'Sarita', 'Dipak', 'Laxmi', 'Suresh', 'Puja']
+LAST_NAMES = ['Tamang', 'Gurung', 'Rai', 'Magar', 'Shrestha', 'Thapa', 'Karki', 'Yadav',
+              'Sharma', 'Adhikari', 'Lama', 'Chaudhary']
+STATIONS = ['BHD', 'BRT', 'KTM', 'NPJ', 'DNG', 'MUS', 'TKP', 'BTW']
+DISTRICTS = ['Kathmandu', 'Morang', 'Sunsari', 'Jhapa', 'Kailali', 'Rupandehi', 'Banke',
+             'Sindhupalchok']
+DESTINATIONS = ['Delhi', 'Mumbai', 'Kolkata', 'Dubai', 'Kuwait', 'Gorakhpur', 'Banaras',
+                "Don't know", 'Saudi Arabia', 'Kathmandu']
+EDUCATION = ['Primary', 'Secondary', 'None/Illiterate', 'University', None]
+ROLES = ['Broker', 'Companion', 'Trafficker', 'Agent', 'Husband', 'Host', 'Manpower', None]
+OCCUPATIONS = ['farmer', 'student', 'wage laborer', 'housewife', 'domestic work', 'driver',
+               'business owner', 'unemployed', '']
+CASE_STATUSES = ['', 'Step Complete', 'In Progress', 'No Response']
+NUM_FEATURES = ['number_of_victims', 'number_of_traffickers', 'known_broker_years',
+                'known_broker_months', 'married_broker_years', 'married_broker_months',
+                'reported_blue_flags', 'total_blue_flags', 'suspected_trafficker_count']
+
+SUSPECT_COLS = ['Suspect_ID', 'Case_ID', 'Name', 'Phone_Number(s)', 'Address',
+                'Bio_and_Location', 'Eminence', 'Strength_of_Case', 'Solvability', 'Priority',
+                'Case_Status', 'Relationships', 'Date_Relationships_Updated', 'Date_Closed']
+POLICE_COLS = ['Suspect_ID', 'Case_ID', 'Suspect_Name', 'Phone_Number(s)', 'Address',
+               'Victims_Willing_to_Testify', 'Case_Status', 'Date_Closed']
+VICTIM_COLS = ['Victim_ID', 'Case_ID', 'Name', 'Phone_Number(s)', 'Address', 'Case_Status',
+               'Date_Closed']
+
+
+def get_plain_features(x_cols_file='X_cols.txt'):
+    """Split the model's raw features into CIF booleans, numbers and Person Box fields."""
+    features = cm.get_feature_columns(x_cols_file)
+    skip = set(cm.CIF_ID_COLS + cm.CAT_FEATURES + NUM_FEATURES)
+    pb_fields = [f for f in features if f.endswith('_pb')]
+    cif_bools = [f for f in features if f not in skip and f not in pb_fields]
+    return cif_bools, pb_fields
+
+
+def random_names(rng, n):
+    """Return an array of n random full names."""
+    return np.char.add(np.char.add(rng.choice(FIRST_NAMES, n), ' '), rng.choice(LAST_NAMES, n))
+
+
+def random_phones(rng, n):
+    """Return an array of n random mobile numbers, about a fifth of them blank."""
+    phones = np.char.add('98', rng.integers(10**7, 10**8, n).astype(str))
+    phones[rng.random(n) < 0.2] = ''
+    return phones
+
+
+def make_addresses(rng, n_address2=200):
+    """Make the address1 (district) and address2 (VDC/municipality) tables."""
+    address1 = pd.DataFrame({'id': np.arange(1, len(DISTRICTS) + 1),
+                             'name': DISTRICTS,
+                             'completed': True,
+                             'latitude': rng.uniform(26.5, 30, len(DISTRICTS)),
+                             'longitude': rng.uniform(80, 88, len(DISTRICTS)),
+                             'level': 'District'})
+    address2 = pd.DataFrame({'id': np.arange(1, n_address2 + 1),
+                             'name': np.char.add('Ward ', np.arange(1, n_address2 + 1).astype(str)),
+                             'address1_id': rng.integers(1, len(DISTRICTS) + 1, n_address2),
+                             'latitude': rng.uniform(26.5, 30, n_address2),
+                             'longitude': rng.uniform(80, 88, n_address2),
+                             'level': 'VDC',
+                             'completed': True})
+    return address1, address2
+
+
+def make_searchlight_tables(n_cifs=1000, seed=0, x_cols_file='X_cols.txt'):
+    """Generate Searchlight tables with realistic relationships between them.
+
+    Args:
+        n_cifs: Number of Case Information Forms to generate. Cases have one CIF per
+        victim (suffixes A, B, ...) and each CIF has one to four Person Boxes.
+        seed: Seed for the random number generator.
+        x_cols_file: Model feature list used to choose the CIF and Person Box columns.
+
+    Returns:
+        A dictionary of dataframes keyed by table name.
+    """
+    rng = np.random.default_rng(seed)
+    cif_bools, pb_fields = get_plain_features(x_cols_file)
+    address1, address2 = make_addresses(rng)
+
+    victims_per_case = rng.choice([1, 1, 1, 2, 3], size=n_cifs)
+    victims_per_case = victims_per_case[np.cumsum(victims_per_case) <= n_cifs]
+    n_cifs = int(victims_per_case.sum())
+    case_idx = np.repeat(np.arange(len(victims_per_case)), victims_per_case)
+    letters = np.concatenate([np.arange(n) for n in victims_per_case])
+    stations = rng.choice(STATIONS, len(victims_per_case))
+    case_ids = np.char.add(stations, (np.arange(len(victims_per_case)) + 100).astype(str))
+    cif_numbers = np.char.add(case_ids[case_idx], np.array(list('ABCDEFGHIJ'))[letters])
+
+    pbs_per_cif = rng.integers(1, 5, n_cifs)
+    n_pbs = int(pbs_per_cif.sum())
+    n_people = n_cifs + n_pbs
+    person = pd.DataFrame({'id': np.arange(1, n_people + 1),
+                           'full_name': random_names(rng, n_people),
+                           'phone_contact': random_phones(rng, n_people),
+                           'address1_id': rng.integers(1, len(address1) + 1, n_people),
+                           'address2_id': rng.integers(1, len(address2) + 1, n_people),
+                           'gender': rng.choice(['F', 'M'], n_people),
+                           'age': rng.integers(12, 60, n_people)})
+
+    interview = pd.Timestamp(date.today()) - pd.to_timedelta(rng.integers(0, 1100, n_cifs),
+                                                             unit='D')
+    updated = interview + pd.to_timedelta(rng.integers(0, 30 * 24 * 3600, n_cifs), unit='s')
+    updated = updated.where(updated < pd.Timestamp.now(), pd.Timestamp.now().floor('s'))
+    cif = pd.DataFrame({'id': np.arange(1, n_cifs + 1),
+                        'cif_number': cif_numbers,
+                        'status': 'approved',
+                        'location': rng.choice(DISTRICTS, n_cifs),
+                        'date_time_entered_into_system': interview.strftime('%Y-%m-%d %H:%M:%S'),
+                        'date_time_last_updated': updated.strftime('%Y-%m-%d %H:%M:%S'),
+                        'staff_name': random_names(rng, n_cifs),
+                        'interview_date': interview.strftime('%Y-%m-%d'),
+                        'station_id': rng.integers(0, 31, n_cifs),
+                        'main_pv_id': np.arange(1, n_cifs + 1),
+                        'form_entered_by_id': rng.integers(1, 50, n_cifs),
+                        'planned_destination': rng.choice(DESTINATIONS, n_cifs),
+                        'number_of_victims': victims_per_case[case_idx],
+                        'number_of_traffickers': pbs_per_cif,
+                        'education': rng.choice(EDUCATION, n_cifs),
+                        'case_notes': '',
+                        # Index 16, which soc_pipe.pre_proc renames for unprojected queries
+                        'occupation': rng.choice(OCCUPATIONS, n_cifs)})
+    features = {f: rng.integers(0, 12, n_cifs) for f in NUM_FEATURES[2:]}
+    features.update({f: rng.random(n_cifs) < 0.2 for f in cif_bools})
+    cif = pd.concat([cif, pd.DataFrame(features)], axis=1)
+
+    pb_cif = np.repeat(np.arange(n_cifs), pbs_per_cif)
+    pb = pd.DataFrame({'id': np.arange(1, n_pbs + 1),
+                       'cif_id': pb_cif + 1,
+                       'person_id': np.arange(n_cifs + 1, n_people + 1),
+                       'pb_number': np.concatenate([np.arange(1, n + 1) for n in pbs_per_cif]),
+                       'role': rng.choice(ROLES, n_pbs),
+                       'occupation': rng.choice(OCCUPATIONS, n_pbs),
+                       'appearance': '',
+                       'relation_to_pv': ''})
+    pb['date_time_last_updated'] = cif['date_time_last_updated'].values[pb_cif]
+    person['date_time_last_updated'] = np.concatenate([cif['date_time_last_updated'].values,
+                                                       pb['date_time_last_updated'].values])
+    # Person Box fields hold the number(s) of the Person Boxes they apply to
+    pb = pd.concat([pb, pd.DataFrame({f: np.where(rng.random(n_pbs) < 0.3,
+                                                  pb['pb_number'].astype(str), '')
+                                      for f in pb_fields})], axis=1)
+
+    return {cm.CIF_TABLE: cif,
+            cm.PB_TABLE: pb,
+            cm.PERSON_TABLE: person,
+            cm.ADDRESS1_TABLE: address1,
+            cm.ADDRESS2_TABLE: address2}
+
+
+def get_entity_ids(tables):
+    """Return dataframes of the suspects and victims the Case Dispatcher will derive."""
+    cif = tables[cm.CIF_TABLE]
+    pb = tables[cm.PB_TABLE].merge(cif[['id', 'cif_number']], left_on='cif_id', right_on='id')
+    pb = pb.merge(tables[cm.PERSON_TABLE], left_on='person_id', right_on='id')
+    pb_ids = ci.get_ids(pb['cif_number'], pb['pb_number'])
+    sus = pd.DataFrame({'Suspect_ID': pb_ids['Suspect_ID'],
+                        'Case_ID': pb_ids['Case_ID'],
+                        'Name': pb['full_name'],
+                        'Phone_Number(s)': pb['phone_contact']}).drop_duplicates('Suspect_ID')
+    vics = cif.merge(tables[cm.PERSON_TABLE], left_on='main_pv_id', right_on='id')
+    vic_ids = ci.get_ids(vics['cif_number'])
+    vics = pd.DataFrame({'Victim_ID': vic_ids['Victim_ID'],
+                         'Case_ID': vic_ids['Case_ID'],
+                         'Name': vics['full_name'],
+                         'Phone_Number(s)': vics['phone_contact']})
+    return sus.reset_index(drop=True), vics
+
+
+def sheet_frame(df, columns):
+    """Format a dataframe like GSheet.df: all strings, given columns, index starting at 1."""
+    df = df.reindex(columns=columns).fillna('').astype(str)
+    df.index = np.arange(1, len(df) + 1)
+    return df
+
+
+def make_arrests(rng, sus, share=0.2, n_pbs=7):
+    """Make an Arrests sheet with a row per case and n_pbs Person Box column groups."""
+    cases = sus['Case_ID'].drop_duplicates()
+    cases = cases[rng.random(len(cases)) < share].reset_index(drop=True)
+    arrests = pd.DataFrame({'IRF#': cases,
+                            'Outcome (Arrest)': rng.choice(['1', '0'], len(cases), p=[0.8, 0.2])})
+    for n in range(1, n_pbs + 1):
+        arrested = rng.random(len(cases)) < 0.6 / n
+        arrests['PB%d Name' % n] = np.where(arrested, random_names(rng, len(cases)), '')
+        arrests['PB%d Arrested' % n] = np.where(arrested, 'Yes', '')
+        dates = pd.Timestamp(date.today()) - pd.to_timedelta(rng.integers(0, 700, len(cases)),
+                                                             unit='D')
+        arrests['PB%d Arrest Date' % n] = np.where(arrested, dates.strftime('%m/%d/%Y'), '')
+    return arrests
+
+
+def make_parameters():
+    """Make a Parameters sheet with the weights read by priority_calc."""
+    return pd.DataFrame({
+        'Solvability_Factor': ['Victim Willing to Testify', 'Bio and Location of Suspect',
+                               'Other Suspect(s) Arrested', 'Police Willing to Arrest',
+                               'Recency of Case', '', '', '', '', ''],
+        'Solvability_Weight': ['3', '2', '2', '3', '1', '', '', '', '', ''],
+        'Notes': '',
+        'Blank': '',
+        'Priority_Factor': ['Solvability', 'Strength of Case', 'Eminence'] + [''] * 7,
+        'Priority_Weight': ['4', '5', '1'] + [''] * 7,
+        'Victims_Willing_to_Testify': [str(n) for n in range(10)],
+        'V_Multiplier': ['0', '0.5', '0.7', '0.8', '0.9', '1', '1', '1', '1', '1']})
+
+
+def make_worksheet_dfs(tables, seed=0, share_existing=0.6, share_closed=0.1):
+    """Generate Case Dispatcher worksheets consistent with the synthetic Searchlight tables.
+
+    Args:
+        tables: Dictionary of tables from make_searchlight_tables.
+        seed: Seed for the random number generator.
+        share_existing: Share of cases already in the active sheets.
+        share_closed: Share of cases already in the closed sheets.
+
+    Returns:
+        A dictionary of all-string dataframes keyed by worksheet name, like gsheets.get_dfs.
+    """
+    rng = np.random.default_rng(seed)
+    sus, vics = get_entity_ids(tables)
+    cases = sus['Case_ID'].drop_duplicates()
+    draw = pd.Series(rng.random(len(cases)), index=cases.values)
+    closed_cases = draw.index[draw < share_closed]
+    active_cases = draw.index[(draw >= share_closed) & (draw < share_closed + share_existing)]
+    today = date.today().strftime('%m/%d/%Y')
+
+    dfs = {}
+    for name, ids, cols in [('Suspects', sus, SUSPECT_COLS),
+                            ('Police', sus.rename(columns={'Name': 'Suspect_Name'}), POLICE_COLS),
+                            ('Victims', vics, VICTIM_COLS)]:
+        active = ids[ids['Case_ID'].isin(active_cases)].copy()
+        active['Case_Status'] = rng.choice(CASE_STATUSES, len(active))
+        # A few cases are marked closed in the sheet and will be moved on the next run
+        active['Date_Closed'] = np.where(rng.random(len(active)) < 0.05, today, '')
+        closed = ids[ids['Case_ID'].isin(closed_cases)].copy()
+        closed['Case_Status'] = 'Closed'
+        closed['Date_Closed'] = today
+        if name == 'Suspects':
+            active['Eminence'] = rng.choice(['', '3', '5', '8'], len(active))
+            active['Bio_and_Location'] = rng.choice(['', 'Known'], len(active))
+        dfs[name] = sheet_frame(active, cols)
+        dfs['Closed_' + name[:3]] = sheet_frame(closed, cols)
+    dfs['Arrests'] = sheet_frame(make_arrests(rng, sus), None)
+    dfs['Parameters'] = sheet_frame(make_parameters(), None)
+    return dfs
+
+
+def load_sqlite(tables, db_file):
+    """Write the tables to a SQLite database file for use with db_connect.SQLite_Conn."""
+    with sqlite3.connect(db_file) as conn:
+        for name, df in tables.items():
+            df.to_sql(name, conn, if_exists='replace', index=False)
+
+
+def load_postgres(tables, db_filename, section='postgresql'):
+    """Create the tables in the public schema of a scratch Postgres database and fill them
+    with COPY. Existing tables with the same names are replaced."""
+    import db_connect as dc
+    dbc = dc.DB_Conn(db_filename, section)
+    for name, df in tables.items():
+        df = df.copy()
+        for col in df.columns:
+            if col.startswith('date_time') or col == 'interview_date':
+                df[col] = pd.to_datetime(df[col])
+        dbc.cur.execute('DROP TABLE IF EXISTS public.{0}'.format(name))
+        bools = {c: 'BOOLEAN' for c in df.columns if df[c].dtype == bool}
+        dbc.cur.execute(pd.io.sql.get_schema(df, name, dtype=bools).replace(
+            'CREATE TABLE "{0}"'.format(name), 'CREATE TABLE public.{0}'.format(name)))
+        buf = StringIO()
+        df.to_csv(buf, index=False, header=False, na_rep='\\N')
+        buf.seek(0)
+        dbc.cur.copy_expert("COPY public.{0} FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(
+            name), buf)
+    dbc.conn.commit()
+    dbc.close_conn()
+
+
+def write_worksheets(dfs, sheets_dir):
+    """Write worksheet dataframes to csv files which read_worksheets can load."""
+    os.makedirs(sheets_dir, exist_ok=True)
+    for name, df in dfs.items():
+        df.to_csv(os.path.join(sheets_dir, name + '.csv'), index=False)
+
+
+def read_worksheets(sheets_dir):
+    """Read csv files written by write_worksheets into all-string dataframes."""
+    dfs = {}
+    for f in sorted(os.listdir(sheets_dir)):
+        if f.endswith('.csv'):
+            df = pd.read_csv(os.path.join(sheets_dir, f), dtype=str, keep_default_na=False)
+            df.index = np.arange(1, len(df) + 1)
+            dfs[f[:-4]] = df
+    return dfs
+
+
+def fit_model(out_dir, dfs, x_cols_file='X_cols.txt'):
+    """Fit a classifier to the synthetic data and save it with its feature list in out_dir.
+
+    The CIF data is extracted and engineered the same way as in __main__.main, so that
+    the saved feature list matches the columns the Case Dispatcher will predict with.
+    """
+    import arrest_module as am
+    import db_connect as dc
+    import sheet_schema as sc
+    import soc_pipe as sp
+    dbc = dc.SQLite_Conn(os.path.join(out_dir, 'searchlight.db'))
+    db_cif = dbc.ex_query(cm.get_queries(dbc, x_cols_file)['cif'].format(changed='1 = 1'))
+    dbc.close_conn()
+    soc_df = sp.pre_proc(db_cif)
+    arrests = am.Arrest_Index(None).update(sc.parse_sheet('Arrests', dfs['Arrests']))
+    soc_df = arrests.join(soc_df)
+    soc_df.Arrest = soc_df.Arrest.fillna('0').astype(int)
+    soc_df = soc_df.dropna(axis=0, subset=['cif_number'])
+    soc_df = sp.en_features(soc_df)
+    soc_df['Days'] = 0
+    X = soc_df.drop(columns=['Arrest', 'Days', 'interview_date', 'suspect_id'])
+    cls_pipeline = sp.get_cls_pipe()
+    cls_pipeline.fit(X, soc_df.Arrest)
+    with open(os.path.join(out_dir, 'soc_model.sav'), 'wb') as f:
+        pickle.dump(cls_pipeline, f)
+    with open(os.path.join(out_dir, 'X_cols.txt'), 'w') as f:
+        for item in X.columns:
+            f.write("%s\n" % item)
+
+
+def make_offline_env(out_dir, n_cifs=1000, seed=0, x_cols_file='X_cols.txt'):
+    """Create a directory from which the Case Dispatcher can be run without network access.
+
+    It contains a SQLite stand-in for Searchlight ('searchlight.db'), the worksheets
+    ('sheets/*.csv'), a model fitted to the synthetic data and an empty backups folder.
+    Run main(offline=True) from out_dir, i.e. with out_dir as the working directory.
+    """
+    os.makedirs(os.path.join(out_dir, 'backups'), exist_ok=True)
+    t0 = datetime.now()
+    tables = make_searchlight_tables(n_cifs, seed, x_cols_file)
+    dfs = make_worksheet_dfs(tables, seed)
+    load_sqlite(tables, os.path.join(out_dir, 'searchlight.db'))
+    write_worksheets(dfs, os.path.join(out_dir, 'sheets'))
+    fit_model(out_dir, dfs, x_cols_file)
+    print("Offline environment with %d CIFs written to %s in %s" % (
+        len(tables[cm.CIF_TABLE]), out_dir, datetime.now() - t0))
+    return tables, dfs
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Generate synthetic Case Dispatcher data')
+    parser.add_argument('out_dir', help="Directory to write the offline environment to")
+    parser.add_argument('--n_cifs', dest='n_cifs', type=int, default=1000,
+                        help="Number of CIFs to generate")
+    parser.add_argument('--seed', dest='seed', type=int, default=0,
+                        help="Seed for the random number generator")
+    parser.add_argument('--x_cols', dest='x_cols_file', default='X_cols.txt',
+                        help="Model feature list used to choose the generated columns")
+    parser.add_argument('--pg_cred_file', dest='pg_cred', default=None,
+                        help="Also load the tables into the scratch Postgres database in this file")
+    args = parser.parse_args()
+    tables, _ = make_offline_env(args.out_dir, args.n_cifs, args.seed, args.x_cols_file)
+    if args.pg_cred is not None:
+        load_postgres(tables, args.pg_cred)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The Case Dispatcher's modules import each other by bare name, as when it is run from the
+# update_cd directory, so that directory is put on the path for the tests as well.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
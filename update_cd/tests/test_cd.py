@@ -1,6 +1,6 @@
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-import update_cd.network_db as ndb
+import update_cd.net_db.network_db as ndb
 import update_cd.gsheets as gs
 import pandas as pd
 import numpy as np
@@ -0,0 +1,225 @@
+import update_cd.api_meter as apm
+import update_cd.arrest_module as am
+import update_cd.backup_store as bs
+import update_cd.case_ids as ci
+import update_cd.db_connect as dc
+import update_cd.entity_groups as eg
+import update_cd.gsheets as gs
+import update_cd.query_cache as qc
+import update_cd.sheet_schema as sc
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from types import SimpleNamespace
+import pandas as pd
+import numpy as np
+
+
+def test_values_to_df():
+    """Make sure that rows returned without their trailing empty cells by values.batchGet
+    are padded to the width of the header row."""
+    output = gs.values_to_df([['Victim_ID', 'Name', 'Date_Closed'], ['BHD100.V1'], ['', 'Sita']])
+    assert list(output.columns) == ['Victim_ID', 'Name', 'Date_Closed']
+    assert output.loc[1, 'Date_Closed'] == ''
+    assert output.loc[2, 'Name'] == 'Sita'
+
+
+def test_diff_ranges():
+    """Make sure that only changed cells and appended rows are sent when uploading."""
+    old = np.array([['a', 'b', 'c'], ['d', 'e', 'f'], ['g', 'h', 'i']], dtype=object)
+    new = np.array([['a', 'b', 'c'], ['d', 'X', 'f'], ['g', 'h', 'Y'], ['j', 'k', 'l']],
+                   dtype=object)
+    data, stats = gs.diff_ranges(old, new, 'Sheet1')
+    assert data[0] == {'range': "'Sheet1'!B2:C3", 'values': [['X', 'f'], ['h', 'Y']]}
+    assert data[1]['range'] == "'Sheet1'!A4:C4"
+    assert stats['changed_cells'] == 2 and stats['appended_rows'] == 1
+
+
+def test_sheet_schema_round_trip():
+    """Make sure typed sheet columns are written back as they were read."""
+    sheet = pd.DataFrame({'Suspect_ID': ['A1.PB1', 'A1.PB2'],
+                          'Eminence': ['3', ''],
+                          'Priority': ['2', '0.523'],
+                          'Date_Closed': ['', '10/05/2026']})
+    typed = sc.parse_sheet('Suspects', sheet)
+    assert typed['Eminence'].isna()[1] and typed['Date_Closed'][1].day == 5
+    assert sc.format_sheet('Suspects', typed).equals(sheet)
+
+
+
+def test_sheet_schema_unreadable():
+    """Make sure values which can't be read as their column's type are written back as they
+    were entered."""
+    sheet = pd.DataFrame({'Suspect_ID': ['A1.PB1', 'A1.PB2'],
+                          'Eminence': ['high', '2'],
+                          'Date_Closed': ['closed 5th Oct', '10/05/2026']})
+    typed = sc.parse_sheet('Suspects', sheet)
+    assert typed['Eminence'].tolist() == ['high', 2]
+    assert sc.readable(typed['Date_Closed'], 'date').isna().tolist() == [True, False]
+    assert sc.format_sheet('Suspects', typed).equals(sheet)
+
+def test_get_arrests():
+    """Make sure arrested Person Boxes are found for any number of Person Boxes."""
+    sheet = pd.DataFrame({'IRF#': ['A1', 'B2', 'C3'], 'Outcome (Arrest)': [1, 1, 0]})
+    for n in [1, 10]:
+        sheet['PB%d Name' % n] = ['Ram', 'Hari', 'Sita']
+        sheet['PB%d Arrested' % n] = ['Yes', '', 'Yes']
+        sheet['PB%d Arrest Date' % n] = '01/02/2020'
+    arrests = am.get_arrests(sheet)
+    assert arrests['suspect_id'].tolist() == ['A1.PB1', 'A1.PB10']
+    assert arrests['Total_Arrests'].tolist() == [2, 2]
+    sheet.loc[3] = [None, 1] + ['Gita', 'Yes', '01/02/2020'] * 2
+    arrests = am.get_arrests(sheet)
+    assert arrests['suspect_id'].tolist() == ['A1.PB1', 'A1.PB10']
+
+
+def test_arrest_index_update():
+    """Make sure the arrest index only reshapes changed cases and answers lookups."""
+    sheet = pd.DataFrame({'IRF#': ['A1', 'B2'], 'Outcome (Arrest)': [1, 1],
+                          'PB1 Name': ['Ram', 'Hari'], 'PB1 Arrested': ['Yes', ''],
+                          'PB1 Arrest Date': ['01/02/2020', '']})
+    index = am.Arrest_Index(None).update(sheet)
+    sheet.loc[1, 'PB1 Arrested'] = 'Yes'
+    index.update(sheet.drop(index=0))
+    assert index.arrested(['A1.PB1', 'B2.PB1']).tolist() == [False, True]
+    assert index.total_arrests(['B2', 'C3']).tolist() == [1, 0]
+
+
+def test_get_ids():
+    ids = ci.get_ids(pd.Series(['BHD12A', 'BHD12K', 'BHD12.1', 'BHD12.12', None]), [1, 2, 3, 10, 0])
+    assert ids['Case_ID'].tolist()[:4] == ['BHD12'] * 4
+    assert ids['Victim_ID'].tolist()[:4] == ['BHD12.V1', 'BHD12.V11', 'BHD12.V1', 'BHD12.V12']
+    assert ids['Suspect_ID'].tolist()[:4] == ['BHD12.PB1', 'BHD12.PB2', 'BHD12.PB3', 'BHD12.PB10']
+    assert ids.iloc[4].isna().all()
+
+
+
+def test_remap_legacy_ids():
+    """Make sure IDs derived by earlier runs are replaced unless that would be ambiguous."""
+    maps = ci.legacy_id_maps(pd.Series(['BHD12.12', 'BHD13K', 'BHD121A']),
+                             pd.Series(['BHD12.12', 'BHD13K']), pd.Series([2, 1]))
+    victims = pd.DataFrame({'Victim_ID': ['BHD12.V12', 'BHD13K', 'BHD121.V1'],
+                            'Case_ID': ['BHD121', 'BHD13', 'BHD121'],
+                            'Name': ['BHD121', 'BHD13K', '']})
+    victims = ci.remap_legacy_ids('Victims', victims, maps)
+    assert victims['Victim_ID'].tolist() == ['BHD12.V12', 'BHD13.V11', 'BHD121.V1']
+    # BHD121 is both the old Case_ID of BHD12.12 and the current one of BHD121A
+    assert victims['Case_ID'].tolist() == ['BHD121', 'BHD13', 'BHD121']
+    assert victims['Name'].tolist() == ['BHD121', 'BHD13K', '']
+    suspects = pd.DataFrame({'Suspect_ID': ['BHD121.PB2', 'BHD13.PB1']})
+    suspects = ci.remap_legacy_ids('Suspects', suspects, maps)
+    assert suspects['Suspect_ID'].tolist() == ['BHD12.PB2', 'BHD13.PB1']
+
+def test_id_dictionary():
+    ids = ci.ID_Dictionary()
+    sus = pd.DataFrame({'Suspect_ID': ['A.PB1', 'B.PB1', None], 'Case_ID': ['A', 'B', None]})
+    pol = pd.DataFrame({'Suspect_ID': ['B.PB1', 'C.PB1'], 'Case_ID': ['B', 'C']})
+    enc_sus, enc_pol = ids.encode(sus, pol)
+    assert enc_sus['Suspect_ID'].dtype == enc_pol['Suspect_ID'].dtype
+    merged = pd.merge(enc_sus, enc_pol, how='left', on='Suspect_ID')
+    assert isinstance(merged['Suspect_ID'].dtype, pd.CategoricalDtype)
+    assert merged['Case_ID_y'].isna().tolist() == [True, False, True]
+    assert ids.decode(enc_sus.fillna('')).equals(sus.fillna(''))
+
+
+def test_status_index():
+    active = pd.DataFrame({'Suspect_ID': ['A.PB1', 'A.PB2', 'B.PB1'], 'Case_ID': ['A', 'A', 'B']})
+    closed = pd.DataFrame({'Suspect_ID': ['C.PB1', 'B.PB1'], 'Case_ID': ['C', 'B']})
+    status = eg.Status_Index(active, closed, 'Suspect_ID')
+    assert status.is_closed(['A.PB1', 'B.PB1', 'C.PB1', 'D.PB1']).tolist() == [False, True, True, False]
+    assert status.has_open_case(['A', 'B', 'C']).tolist() == [True, False, False]
+    status.close(['A.PB1'])
+    assert status.has_open_case(['A']).tolist() == [True]
+    status.close(['A.PB2', 'A.PB2'])
+    assert status.has_open_case(['A']).tolist() == [False]
+    assert status.lookup(['A.PB2', 'D.PB1'])['Status'].tolist() == ['Closed', None]
+
+
+def test_status_index_missing_case():
+    """Make sure IDs without a Case_ID are indexed without opening or closing any case."""
+    active = pd.DataFrame({'Victim_ID': ['A.V1', 'X'], 'Case_ID': ['A', None]})
+    closed = pd.DataFrame({'Victim_ID': ['Y'], 'Case_ID': [np.nan]})
+    status = eg.Status_Index(active, closed, 'Victim_ID')
+    assert status.has_open_case(['A', None]).tolist() == [True, False]
+    status.close(['X', 'A.V1'])
+    assert status.is_closed(['X', 'Y']).tolist() == [True, True]
+    assert status.has_open_case(['A']).tolist() == [False]
+
+
+def test_concat_chunks():
+    """Make sure text chunks categorized on arrival share their categories once combined
+    and that text with too many distinct values overall stays text."""
+    chunks = [pd.DataFrame({'id': [1, 2], 'district': ['Jhapa', 'Morang'],
+                            'name': ['Sita', 'Ram']}),
+              pd.DataFrame({'id': [3, 4], 'district': ['Jhapa', 'Ilam'],
+                            'name': ['Hari', 'Gita']})]
+    output = dc.concat_chunks(iter(chunks), max_cat_ratio=0.75)
+    assert set(output['district'].cat.categories) == {'Ilam', 'Jhapa', 'Morang'}
+    assert list(output['district']) == ['Jhapa', 'Morang', 'Jhapa', 'Ilam']
+    assert output['name'].dtype == object
+    assert list(output['id']) == [1, 2, 3, 4]
+
+
+def test_backup_store_resorted(tmp_path):
+    """Make sure re-sorting a sheet only stores its new row order and that it is restored
+    in the order it was backed up in."""
+    store = bs.Backup_Store(str(tmp_path), block_rows=10)
+    sheet = pd.DataFrame({'Suspect_ID': ['A%d.PB1' % i for i in range(200)],
+                          'Priority': [str(i % 7) for i in range(200)]})
+    first = store.save('sheets', {'Suspects': sheet}, day=date(2026, 1, 1))
+    resorted = sheet.sort_values('Priority', kind='stable').reset_index(drop=True)
+    second = store.save('sheets', {'Suspects': resorted}, day=date(2026, 1, 2))
+    assert second == {'blocks': first['blocks'], 'written': 1}
+    restored = store.restore('sheets', day=date(2026, 1, 2))['Suspects']
+    assert restored.values.tolist() == resorted.values.tolist()
+
+
+def test_query_cache_fingerprint(tmp_path):
+    """Make sure source tables are fingerprinted through the SQLite stand-in database."""
+    db_file = str(tmp_path / 'searchlight.db')
+    conn = sqlite3.connect(db_file)
+    conn.execute('CREATE TABLE cases (id INTEGER, date_time_last_updated TEXT)')
+    conn.execute("INSERT INTO cases VALUES (1, '2026-01-02 03:04:05')")
+    conn.commit()
+    cache = qc.Query_Cache(dc.SQLite_Conn(db_file), cache_dir=str(tmp_path / 'cache'))
+    before = cache.get_fingerprint(['cases'])
+    assert before[0][:2] == ['cases', '1']
+    conn.execute("UPDATE cases SET date_time_last_updated = '2026-02-03 04:05:06'")
+    conn.commit()
+    assert cache.get_fingerprint(['cases']) != before
+
+
+def test_query_cache_evicted_file(tmp_path):
+    """Make sure a cached file removed after its entry was looked up counts as a miss."""
+    db_file = str(tmp_path / 'searchlight.db')
+    sqlite3.connect(db_file).close()
+    cache = qc.Query_Cache(dc.SQLite_Conn(db_file), cache_dir=str(tmp_path / 'cache'))
+    cache.store('key', 'SELECT 1', pd.DataFrame({'a': [1]}), [])
+    assert cache.lookup('key', [])['a'].tolist() == [1]
+    os.remove(str(tmp_path / 'cache' / cache.index['key']['file']))
+    assert cache.lookup('key', []) is None
+    assert cache.stats['hits'] == 1 and cache.stats['misses'] == 1
+
+
+def test_api_meter_per_run(tmp_path):
+    """Make sure runs in separate threads record their calls, including those made by their
+    worker threads, with their own meters."""
+    response = SimpleNamespace(request=None, elapsed=timedelta(seconds=0.1), content=b'',
+                               status_code=200)
+
+    @apm.track
+    def step(n):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            for _ in range(n):
+                apm.submit(executor, apm.hook, response).result()
+
+    def run(n):
+        meter = apm.API_Meter(str(tmp_path / ('report%d.json' % n))).start()
+        step(n)
+        return meter.report()['steps']
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        reports = list(executor.map(run, [1, 2]))
+    assert [r['step']['requests'] for r in reports] == [1, 2]
+    assert apm.current.get() is None